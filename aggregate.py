@@ -0,0 +1,90 @@
+import time
+
+
+STATS = ("count", "min", "max", "mean", "last")
+OPTIONAL_STATS = ("variance", "stddev")
+
+
+class FieldAggregate:
+  """Count, min, max, mean, last and variance of a stream in constant space"""
+
+  __slots__ = ("count", "min", "max", "mean", "m2", "last")
+
+  def __init__(self):
+    self.count = 0
+    self.min = None
+    self.max = None
+    self.mean = 0.0
+    self.m2 = 0.0
+    self.last = None
+
+  def add(self, value):
+    self.count += 1
+    if self.count == 1 or value < self.min:
+      self.min = value
+    if self.count == 1 or value > self.max:
+      self.max = value
+    # Welford's update keeps the variance numerically stable
+    delta = value - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (value - self.mean)
+    self.last = value
+
+  @property
+  def variance(self):
+    return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+  @property
+  def stddev(self):
+    return self.variance ** 0.5
+
+  def stat(self, name):
+    return getattr(self, name)
+
+
+class WindowAggregator:
+  """
+  Folds every reading of a device into the current publish window, per
+  field, instead of keeping only the last one. `flush` sets the window's
+  aggregates as gauges labeled with `agg` and starts a new window, so
+  spikes between publishes still show up in the min and max.
+  """
+
+  def __init__(self, observer, stats=STATS):
+    unknown = set(stats) - set(STATS) - set(OPTIONAL_STATS)
+    if unknown:
+      raise ValueError(f"Unknown aggregates: {sorted(unknown)}")
+
+    self.observer = observer
+    self.stats = tuple(stats)
+    self.fields = {}
+    self.gauges = {}
+
+  def add(self, readings):
+    for field, value in readings.items():
+      agg = self.fields.get(field)
+      if agg is None:
+        agg = self.fields[field] = FieldAggregate()
+      agg.add(value)
+
+  def _gauges_(self, field):
+    gauges = self.gauges.get(field)
+    # Evicted by the registry if the field went unreported for the TTL
+    if gauges is None or not all(self.observer.registry.holds(g) for _, g in gauges):
+      gauge = self.observer.gauge(field)
+      gauges = self.gauges[field] = tuple(
+        (stat, gauge.labeled("agg", stat)) for stat in self.stats
+      )
+    return gauges
+
+  def flush(self, at=None):
+    """Publish the window's aggregates and start a new window"""
+    at = at or time.time()
+    fields, self.fields = self.fields, {}
+
+    for field, agg in fields.items():
+      for stat, gauge in self._gauges_(field):
+        value = agg.stat(stat)
+        gauge.set(round(value, 3) if isinstance(value, float) else value, at)
+
+    return len(fields)
@@ -4,13 +4,52 @@ from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 
 
+# Advertising data types (Bluetooth assigned numbers) used in scan patterns
+AD_SERVICE_DATA_16 = 0x16
+AD_MANUFACTURER_DATA = 0xFF
+
+
+class Field:
+  """What a decoded field measures, for Home Assistant discovery"""
+
+  __slots__ = ("device_class", "unit", "state_class", "value_template")
+
+  def __init__(self, device_class=None, unit=None, state_class="measurement",
+      value_template=None):
+    self.device_class = device_class
+    self.unit = unit
+    self.state_class = state_class
+    self.value_template = value_template
+
+
 class BeaconDecoder:
   """Decodes the BLE advertisement data into a key-value dict"""
 
-  def __init__(self, name):
+  # Publish order when the broker budget is tight, highest first
+  priority = 0
+
+  # Service UUIDs this decoder's device always advertises, if any
+  service_uuids = ()
+
+  # Fields computed from the decoded ones, {field: expression}; see derived.py
+  derived = {}
+
+  # What the decoded and derived fields are, {field: Field}. Only these are
+  # announced to Home Assistant
+  fields = {}
+  manufacturer = None
+  model = None
+
+  def __init__(self, name, publish_interval_s=None, priority=None):
     self.throttle_expire = 0
     self.throttle_s = 0
     self.name = name
+    self.publish_interval_s = publish_interval_s
+    if priority is not None:
+      self.priority = priority
+
+    # What this decoder was configured with; equal specs decode alike
+    self.spec = (type(self).__name__, name, publish_interval_s, self.priority)
 
   def should_throttle(self):
     now = time.time()
@@ -19,6 +58,13 @@ class BeaconDecoder:
       return False
     return True
 
+  def scan_patterns(self):
+    """
+    (ad_type, offset, bytes) patterns that the adverts this decoder can use
+    match. They are handed to BlueZ for matching in the controller.
+    """
+    return ()
+
   def decode(self, device: BLEDevice, adv_data: AdvertisementData):
     """Decode the advertisement data from the device into a dict"""
     raise NotImplementedError
@@ -28,36 +74,79 @@ class VTDecoder(BeaconDecoder):
   VT_MFG_HEX = 0x02E1
   VT_DATA_PREFIX = b"\x10"
 
-  def __init__(self, name, vt_device_class, key):
-    super().__init__(name)
+  # Battery and charger data matter more than room climate
+  priority = 10
+
+  derived = {"power": "current * voltage"}
+
+  manufacturer = "Victron"
+  # The union of what the supported Victron devices report; only the ones
+  # a device actually sends are announced
+  fields = {
+    "battery_charging_current": Field("current", "A"),
+    "battery_voltage": Field("voltage", "V"),
+    "solar_power": Field("power", "W"),
+    "yield_today": Field("energy", "Wh", "total_increasing"),
+    "current": Field("current", "A"),
+    "voltage": Field("voltage", "V"),
+    "power": Field("power", "W"),
+    "soc": Field("battery", "%"),
+    "remaining_mins": Field("duration", "min"),
+    "consumed_ah": Field(None, "Ah"),
+  }
+
+  def __init__(self, name, vt_device_class, key, **kwargs):
+    super().__init__(name, **kwargs)
     self.vt_ble = vt_device_class(key)
+    self.model = vt_device_class.__name__
+    self.spec += (vt_device_class.__name__, key)
+
+  def scan_patterns(self):
+    mfg_id = struct.pack("<H", self.VT_MFG_HEX)
+    return ((AD_MANUFACTURER_DATA, 0, mfg_id + self.VT_DATA_PREFIX),)
 
   def decode(self, device: BLEDevice, adv_data: AdvertisementData):
     vt_data = adv_data.manufacturer_data.get(self.VT_MFG_HEX)
     if vt_data and vt_data.startswith(self.VT_DATA_PREFIX):
-      data_dict = self.vt_ble.parse(vt_data)._data
-      # why tf doesn't it do this automatically?
-      if "current" and "voltage" in data_dict:
-        data_dict["power"] = float(data_dict["current"]) * float(data_dict["voltage"])
-      return data_dict
+      return self.vt_ble.parse(vt_data)._data
 
     return {}
 
 
 class MokoH4Decoder(BeaconDecoder):
   SVC_DATA_KEY = "0000feab-0000-1000-8000-00805f9b34fb"
+  SVC_UUID16 = 0xFEAB
   DATA_PREFIX = b"\x70"
 
-  def __init__(self, name):
-    super().__init__(name)
+  service_uuids = (SVC_DATA_KEY,)
+
+  derived = {
+    "temperature_f": "c_to_f(temperature_c)",
+    "dew_point_c": "dew_point(temperature_c, humidity_pc)",
+  }
+
+  manufacturer = "Moko"
+  model = "H4"
+  fields = {
+    "temperature_c": Field("temperature", "°C"),
+    "temperature_f": Field("temperature", "°F"),
+    "humidity_pc": Field("humidity", "%"),
+    "dew_point_c": Field("temperature", "°C"),
+  }
+
+  def __init__(self, name, **kwargs):
+    super().__init__(name, **kwargs)
+
+  def scan_patterns(self):
+    uuid = struct.pack("<H", self.SVC_UUID16)
+    return ((AD_SERVICE_DATA_16, 0, uuid + self.DATA_PREFIX),)
 
   def decode(self, device: BLEDevice, adv_data: AdvertisementData):
     sd = adv_data.service_data.get(self.SVC_DATA_KEY)
     if sd and sd.startswith(self.DATA_PREFIX):
       t = round(struct.unpack(">H", sd[3:5])[0] / 10.0, 1)
       h = round(struct.unpack(">H", sd[5:7])[0] / 10.0, 1)
-      tf = (t * 1.8) + 32.0
 
-      return {"temperature_c": t, "humidity_pc": h, "temperature_f": tf}
+      return {"temperature_c": t, "humidity_pc": h}
 
     return {}
@@ -1,7 +1,16 @@
 import json
+import random
+import asyncio
+import aiohttp
 import aiomqtt
 
-from obs.data import MetricKind
+from obs.data import ObsKind
+from obs.metric import HistSample
+from obs.observer import NullObserver
+from spool import Spool
+from payloads import codec_for, SCHEMA_SUFFIX, BULK_SUFFIX, pack_bulk
+from remote_write import encode_timeseries, encode_write_request, snappy_block
+from stream import ReadingStream
 from aiohttp import web
 from enum import Enum, Flag
 import time
@@ -14,97 +23,368 @@ def adjust_value(val):
       return round(val, 2)
     case Enum() | Flag():
       return val.name.lower()
+    case HistSample():
+      return val.as_dict()
     case _:
       return val
 
 
+def record_to_om_family(rec):
+  om_name = '_'.join(rec.scope)
+  if rec.kind == ObsKind.COUNTER and om_name.endswith('_total'):
+    om_name = om_name[:-6]
+  return om_name
+
+
 def record_to_om_name(rec):
-  om_name = '_'.join(rec.path.parts)
-  if rec.kind == MetricKind.COUNTER and not om_name.endswith('_total'):
+  om_name = record_to_om_family(rec)
+  if rec.kind == ObsKind.COUNTER:
     om_name = om_name + "_total"
   return om_name
 
 
+def om_label_value(v):
+  return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
 def record_to_om_string(rec):
   om_name = record_to_om_name(rec)
   value = str(rec.value)
   ts = f" {round(rec.at)}" if rec.at > 1 else ""
-  labels = rec.labels
+  labels = dict(rec.labels)
 
   match rec.kind:
-    case MetricKind.COUNTER:
+    case ObsKind.COUNTER:
       pass
-    case MetricKind.GAUGE:
+    case ObsKind.GAUGE:
       pass
-    case MetricKind.STATE:
-      labels = labels.labeled('state', value)
+    case ObsKind.STATE:
+      labels[om_name] = value
       value = "1"
-    case MetricKind.STAT:
+    case ObsKind.STAT:
       pass
-    case MetricKind.INFO:
-      for k, v in rec.items():
-        labels = labels.labeled(k, v)
+    case ObsKind.INFO:
+      labels.update(rec.value)
       value = "1"
+    case ObsKind.HIST:
+      # One line per cumulative bucket, then the sum and count
+      lines = [
+        om_sample(f"{om_name}_bucket", dict(labels, le=le), str(count), ts)
+        for le, count in rec.value.buckets()
+      ]
+      lines.append(om_sample(f"{om_name}_sum", labels, str(rec.value.sum), ts))
+      lines.append(om_sample(f"{om_name}_count", labels, str(rec.value.count), ts))
+      return "\n".join(lines)
     case _ :
       pass
 
-  labels_part = labels.as_str()
+  return om_sample(om_name, labels, value, ts)
+
+
+def om_sample(om_name, labels, value, ts):
+  labels_part = ""
+  if labels:
+    labels_part = "{" + ",".join(
+      f'{k}="{om_label_value(v)}"' for k, v in sorted(labels.items())
+    ) + "}"
 
   return ''.join((om_name, labels_part, ' ', value, ts))
 
 def record_to_om_help(rec):
-  return f"# HELP {rec.desc}"
+  return f"# HELP {record_to_om_family(rec)} {rec.desc}"
 
 def record_to_om_type(rec):
   typestr = 'unknown'
   match rec.kind:
-    case MetricKind.COUNTER:
+    case ObsKind.COUNTER:
       typestr = "counter"
-    case MetricKind.GAUGE:
+    case ObsKind.GAUGE:
       typestr = "gauge"
-    case MetricKind.STATE:
+    case ObsKind.STATE:
       typestr = "stateset"
-    case MetricKind.STAT:
+    case ObsKind.STAT | ObsKind.HIST:
       typestr = "histogram"
-    case MetricKind.INFO:
+    case ObsKind.INFO:
       typestr = "info"
     case _ :
       pass
 
-  return f"# TYPE {typestr}"
+  return f"# TYPE {record_to_om_family(rec)} {typestr}"
 
 
-class MqttPublisher:
-  def __init__(self, broker, username, password, prefix, registry):
-    self.registry = registry
+class MqttSink:
+  """
+  One broker. Batches are queued and sent by the sink's own task over its
+  own connection, so a slow or unreachable broker only delays itself.
+  When the queue is full, the oldest batch is spilled to the sink's spool;
+  so are messages that could not be sent. Spooled messages are drained,
+  at most `drain_rate_per_s` at a time, once the broker is back.
+
+  With `retain`, readings are retained so subscribers get them at once on
+  connecting. With `hass_prefix`, Home Assistant discovery configs are
+  sent to this sink, under that prefix, and `on_config_sent(sink, topic,
+  payload)` is called for each the broker accepted.
+  """
+
+  def __init__(self, name, broker, username=None, password=None, topic_prefix=None,
+      qos=0, codec="json", bulk=False, spool=None, max_batches=16,
+      drain_rate_per_s=10, drain_budget_s=10, retry_s=5, retain=False,
+      hass_prefix=None, observer=None):
+    if hass_prefix and (codec != "json" or bulk):
+      raise ValueError(f"Sink {name}: Home Assistant discovery needs json, non-bulk payloads")
+
+    self.name = name
+    self.retain_state = retain
+    self.hass_prefix = hass_prefix
     self.mqtt_client = aiomqtt.Client(
       hostname=broker,
       username=username,
       password=password,
     )
+    self.topic_prefix = topic_prefix
+    self.qos = qos
+    self.codec = codec
+    self.bulk = bulk
+    self.spool = spool if spool is not None else Spool()
+    self.queue = asyncio.Queue()
+    self.max_batches = max_batches
+    self.drain_rate_per_s = drain_rate_per_s
+    self.drain_budget_s = drain_budget_s
+    self.retry_s = retry_s
+    self.task = None
+    self.on_config_sent = None
+
+    if observer:
+      observer = observer.labeled("sink", name)
+      self.spool.observe(observer)
+      mode = observer.labeled("codec", codec).labeled("mode", "bulk" if bulk else "group")
+    else:
+      observer = mode = NullObserver()
+
+    self.log = observer.log("sink")
+    self.bytes_ctr = mode.counter("published_bytes", "Payload bytes published")
+    self.msgs_ctr = mode.counter("published_messages", "Messages published")
+    self.spilled_ctr = observer.counter(
+      "spilled_batches", "Batches spooled because the sink's queue was full"
+    )
+    self.lag = observer.gauge("lag_s", "How long the last batch waited in the queue")
+    self.latency = observer.gauge("latency_s", "How long the last batch took to send")
+    observer.gauge("queue_batches", "Batches waiting to be sent").set_fn(self.queue.qsize)
+
+  @property
+  def format(self):
+    """Sinks with the same format share one rendering of each batch"""
+    return (self.codec, self.bulk, self.topic_prefix)
+
+  def enqueue(self, rendered):
+    if self.task is None or self.task.done():
+      self.task = asyncio.get_running_loop().create_task(self.run())
+
+    while self.queue.qsize() >= self.max_batches:
+      _, spilled = self.queue.get_nowait()
+      self.spill(spilled)
+      self.spilled_ctr.inc()
+    self.queue.put_nowait((time.time(), rendered))
+
+  def spill(self, messages):
+    for key, payload, at in messages:
+      # A bulk frame only holds the groups that changed, so it is not state
+      self.spool.put(key, payload, at, state=not key.endswith(BULK_SUFFIX))
+    self.spool.sync()
+
+  async def run(self):
+    while True:
+      queued_at, batch = await self.queue.get()
+      pending = list(batch)
+      try:
+        async with self.mqtt_client as mqtt:
+          while True:
+            start = time.time()
+            self.lag.set(round(start - queued_at, 3))
+            while pending:
+              key, payload, _ = pending[0]
+              await self.send(mqtt, key, payload)
+              self.spool.supersede(key)
+              pending.pop(0)
+            self.latency.set(round(time.time() - start, 3))
+            self.spool.sync()
+
+            await self.drain(mqtt)
+            queued_at, batch = await self.queue.get()
+            pending = list(batch)
+      except asyncio.CancelledError:
+        self.spill(pending)
+        raise
+      except Exception as e:
+        if not isinstance(e, aiomqtt.MqttError):
+          # Not the broker going away, but no reason for the sink to die
+          self.log.err("Sink {} failed: {!r}", self.name, e)
+        self.spill(pending)
+        while not self.queue.empty():
+          self.spill(self.queue.get_nowait()[1])
+        await asyncio.sleep(self.retry_s)
+
+  def is_config(self, key):
+    return self.hass_prefix is not None and key.startswith(self.hass_prefix + "/")
+
+  def retained(self, key):
+    """Schemas and discovery configs always, readings if `retain` is set"""
+    if key.endswith(SCHEMA_SUFFIX) or self.is_config(key):
+      return True
+    return self.retain_state and not key.endswith(BULK_SUFFIX)
+
+  async def send(self, mqtt, key, payload):
+    await mqtt.publish(key, payload=payload, qos=self.qos, retain=self.retained(key))
+    self.msgs_ctr.inc()
+    self.bytes_ctr.inc(len(payload))
+    if self.on_config_sent and self.is_config(key):
+      self.on_config_sent(self, key, payload)
+
+  async def drain(self, mqtt):
+    """Send spooled messages, oldest first, until empty or out of budget"""
+    deadline = time.time() + self.drain_budget_s
+    pause_s = 1.0 / self.drain_rate_per_s
+
+    while time.time() < deadline and self.queue.empty():
+      entry = self.spool.peek()
+      if entry is None:
+        break
+
+      await self.send(mqtt, entry.topic, entry.payload)
+      self.spool.pop(entry)
+      await asyncio.sleep(pause_s)
+    self.spool.sync()
+
+  async def close(self):
+    """Stop sending, and spool whatever was still queued"""
+    if self.task:
+      self.task.cancel()
+      try:
+        await self.task
+      except asyncio.CancelledError:
+        pass
+      self.task = None
+    while not self.queue.empty():
+      self.spill(self.queue.get_nowait()[1])
+    self.spool.close()
+
+
+class MqttPublisher:
+  """
+  Publishes every group of readings that changed since the last publish as
+  one message per group, or all of them as a single compressed message on
+  `<prefix>/$bulk` for sinks with `bulk` set, to every sink. Each batch is
+  rendered once per distinct sink format and the same messages are queued
+  to every sink with that format.
+  """
+
+  def __init__(self, sinks, prefix, registry, observer=None, discovery=None):
+    self.registry = registry
+    self.sinks = sinks
+    self.discovery = discovery
     self.prefix = prefix
     self.last_publish_at = 0
+    self.published_at = {}
+    self.codecs = {sink.format: codec_for(sink.codec) for sink in sinks}
+    if discovery:
+      for sink in sinks:
+        if sink.hass_prefix:
+          sink.on_config_sent = discovery.sent
 
-  async def publish(self):
-    prefix_str = "/".join(self.prefix)
-    readings = self.registry.read(
-      prefix=self.prefix,
-      after=self.last_publish_at
-    ).as_dict()
+    observer = observer or NullObserver()
+    self.interval_gauges = {
+      sink.name: (
+        observer.labeled("sink", sink.name).gauge(
+          "interval_messages", "Messages queued at the last publish interval"
+        ),
+        observer.labeled("sink", sink.name).gauge(
+          "interval_bytes", "Payload bytes queued at the last publish interval"
+        ),
+      )
+      for sink in sinks
+    }
 
-    self.last_publish_at = time.time()
+  def render(self, groups, format):
+    codec_name, bulk, topic_prefix = format
+    codec = self.codecs[format]
+    prefix_str = topic_prefix if topic_prefix is not None else "/".join(self.prefix)
 
     rendered = []
-    for group, values in readings.items():
+    for group, values, at in groups:
       path_str = f"{prefix_str}/" + "/".join(group)
+      rendered.append((path_str, codec.encode(path_str, values), at))
+
+    if bulk and rendered:
+      frame = pack_bulk((key, payload) for key, payload, _ in rendered)
+      rendered = [(prefix_str + BULK_SUFFIX, frame, self.last_publish_at)]
+
+    return [
+      (key, payload, self.last_publish_at) for key, payload in codec.announcements()
+    ] + rendered
+
+  async def publish(self, include=None):
+    """
+    Queue the groups with readings newer than their last publish to every
+    sink, limited to those accepted by `include(group)` if given. Returns
+    the messages rendered for the first sink as (topic, payload, at).
+    """
+    await self.registry.refresh(self.prefix)
+    readings = self.registry.read(prefix=self.prefix).as_dict()
+
+    self.last_publish_at = time.time()
+
+    groups = []
+    for group, values in readings.items():
+      if include and not include(group):
+        continue
+
+      at = max(r.at for r in values.values())
+      if at <= self.published_at.get(group, 0):
+        continue
+      self.published_at[group] = at
+
       for k in values.keys():
         values[k] = adjust_value(values[k].value)
+      # Lets consumers tell a replayed message from a fresh one
+      values["ts"] = round(at)
+      groups.append((group, values, at))
 
-      rendered.append((path_str, json.dumps(values)))
+    by_format = {}
+    for sink in self.sinks:
+      rendered = by_format.get(sink.format)
+      if rendered is None:
+        rendered = by_format[sink.format] = self.render(groups, sink.format)
+      if self.discovery and sink.hass_prefix:
+        # Configs go first, so Home Assistant knows the state topics
+        prefix_str = sink.topic_prefix if sink.topic_prefix is not None else "/".join(self.prefix)
+        rendered = self.discovery.messages(
+          sink, prefix_str, groups, self.last_publish_at
+        ) + rendered
+      if rendered:
+        sink.enqueue(rendered)
+      msgs, nbytes = self.interval_gauges[sink.name]
+      msgs.set(len(rendered))
+      nbytes.set(sum(len(payload) for _, payload, _ in rendered))
 
-    async with self.mqtt_client as mqtt:
-      for key, payload in rendered:
-        await mqtt.publish(key, payload=payload)
+    return by_format.get(self.sinks[0].format, []) if self.sinks else []
+
+  def state(self):
+    """What was published when, for a warm restart"""
+    return json.dumps({
+      "last_publish_at": self.last_publish_at,
+      "published_at": [[list(group), at] for group, at in self.published_at.items()],
+    }).encode()
+
+  def restore_state(self, blob):
+    state = json.loads(blob)
+    self.last_publish_at = state["last_publish_at"]
+    self.published_at = {tuple(group): at for group, at in state["published_at"]}
+
+  async def close(self):
+    for sink in self.sinks:
+      await sink.close()
+    if self.discovery:
+      await self.discovery.flush()
 
 
 class OpenMetricPublisher:
@@ -113,18 +393,22 @@ class OpenMetricPublisher:
       aiohttp_app=web.Application(),
       port=8088,
       inc_help_type=True,
-      om_strict=True
+      om_strict=True,
+      observer=None,
     ):
     self.registry = registry
     self.port = port
     self.app = aiohttp_app
     self.runner = None
     self.extras = inc_help_type
+    self.stream = ReadingStream(registry, observer=observer)
 
     async def handle_stats(request):
+      await self.registry.refresh()
       return web.Response(text="\n".join(self.collect()))
 
     self.app.add_routes([web.get('/stats', handle_stats)])
+    self.app.add_routes(self.stream.routes())
 
   def setup_aiohttp(self, loop):
     # set up aiohttp - like run_app, but non-blocking
@@ -132,6 +416,7 @@ class OpenMetricPublisher:
     loop.run_until_complete(runner.setup())
     site = web.TCPSite(runner, port=self.port)
     loop.run_until_complete(site.start())
+    self.runner = runner
 
   async def stop(self):
     await self.runner.cleanup()
@@ -140,12 +425,211 @@ class OpenMetricPublisher:
     readings = self.registry.read()
     prev_path = None
     for r in readings:
+      # Metrics which were created but never set have nothing to say
+      if r.value is None:
+        continue
+
       # Output the TYPE/HELP if this is the first of this thing's path
       if self.extras:
-        if prev_path != r.path:
+        if prev_path != r.scope:
           yield record_to_om_type(r)
           if r.desc:
             yield record_to_om_help(r)
 
-      prev_path = r.path
+      prev_path = r.scope
       yield record_to_om_string(r)
+
+
+def influx_escape(s):
+  return str(s).replace("\\", "\\\\").replace(",", "\\,").replace(" ", "\\ ").replace("=", "\\=")
+
+
+def record_to_points(rec):
+  """(name, labels, numeric value) of each number in a reading"""
+  labels = dict(rec.labels)
+  value = rec.value
+
+  match rec.kind:
+    case ObsKind.STATE:
+      labels[record_to_om_family(rec)] = value
+      value = 1
+    case ObsKind.HIST:
+      name = record_to_om_family(rec)
+      for le, count in value.buckets():
+        yield f"{name}_bucket", dict(labels, le=le), count
+      yield f"{name}_sum", labels, value.sum
+      yield f"{name}_count", labels, value.count
+      return
+    case _:
+      pass
+
+  if isinstance(value, bool):
+    value = int(value)
+  if isinstance(value, (int, float)):
+    yield record_to_om_name(rec), labels, value
+
+
+def point_to_influx_line(name, labels, value, at):
+  tags = "".join(f",{influx_escape(k)}={influx_escape(v)}" for k, v in sorted(labels.items()))
+  return f"{influx_escape(name)}{tags} value={float(value)} {int(at * 1e9)}"
+
+
+class PushExporter:
+  """
+  Pushes registry changes to a time-series database over HTTP, either as
+  InfluxDB line protocol or as a snappy-compressed Prometheus remote-write
+  request. Changed readings are batched and flushed once `max_batch` points
+  are waiting or `flush_interval_s` has passed since the oldest of them.
+  Failed flushes keep their batch and are retried with exponential backoff.
+  A batch the server rejects outright (a 4xx other than 429) is dropped
+  instead, and the next one goes without waiting. Beyond `max_buffer`
+  points, the oldest are dropped.
+  """
+
+  FORMATS = ("influx", "remote_write")
+
+  def __init__(self, url, registry, format="influx", headers=None,
+      collect_interval_s=10, flush_interval_s=30, max_batch=5000, max_buffer=50000,
+      max_backoff_s=300, timeout_s=10, observer=None):
+    if format not in self.FORMATS:
+      raise ValueError(f"Unknown push format {format}, expected one of {self.FORMATS}")
+
+    self.url = url
+    self.registry = registry
+    self.format = format
+    self.headers = dict(headers or {})
+    self.collect_interval_s = collect_interval_s
+    self.flush_interval_s = flush_interval_s
+    self.max_batch = max_batch
+    self.max_buffer = max_buffer
+    self.max_backoff_s = max_backoff_s
+    self.timeout_s = timeout_s
+
+    self.session = None
+    self.buffer = []
+    self.oldest_at = 0
+    self.last_generation = 0
+    self.last_collect_at = 0
+    self.ahead = {}
+    self.failures_in_row = 0
+    self.retry_at = 0
+
+    obs = observer.labeled("format", format) if observer else NullObserver()
+    self.points_ctr = obs.counter("pushed_points", "Points pushed")
+    self.bytes_ctr = obs.counter("pushed_bytes", "Request body bytes pushed")
+    self.fail_ctr = obs.counter("push_failures", "Push requests that failed")
+    self.drop_ctr = obs.counter("push_dropped", "Points dropped with the buffer full")
+    self.latency = obs.gauge("push_latency_s", "Duration of the last successful push")
+    obs.gauge("push_buffered", "Points waiting to be pushed").set_fn(lambda: len(self.buffer))
+
+  def collect(self):
+    """Buffer every reading that changed since the last collect"""
+    readings = self.registry.read(after=self.last_collect_at, after_gen=self.last_generation)
+    now = time.time()
+    ahead = {}
+
+    for r in readings:
+      key = (r.scope, r.labels)
+      # Written while the last snapshot was taken, so already pushed by it
+      if self.ahead.get(key) == r.generation:
+        continue
+      if readings.generation and r.generation > readings.generation:
+        ahead[key] = r.generation
+      if r.value is not None and r.at:
+        self.buffer.extend(point + (r.at,) for point in record_to_points(r))
+
+    # A generation stamped snapshot picks up from its own generation instead
+    self.ahead = ahead
+    self.last_generation = readings.generation
+    self.last_collect_at = 0 if readings.generation else now
+
+    if self.buffer and not self.oldest_at:
+      self.oldest_at = now
+
+    overflow = len(self.buffer) - self.max_buffer
+    if overflow > 0:
+      del self.buffer[:overflow]
+      self.drop_ctr.inc(overflow)
+
+  def encode(self, points):
+    if self.format == "influx":
+      body = "\n".join(point_to_influx_line(*p) for p in points).encode()
+      return body, {"Content-Type": "text/plain; charset=utf-8"}
+
+    series = {}
+    for name, labels, value, at in points:
+      key = (name,) + tuple(sorted(labels.items()))
+      series.setdefault(key, []).append((float(value), int(at * 1000)))
+
+    body = encode_write_request(
+      encode_timeseries([("__name__", key[0])] + list(key[1:]), sorted(samples, key=lambda s: s[1]))
+      for key, samples in series.items()
+    )
+    return snappy_block(body), {
+      "Content-Type": "application/x-protobuf",
+      "Content-Encoding": "snappy",
+      "X-Prometheus-Remote-Write-Version": "0.1.0",
+    }
+
+  def should_flush(self, now):
+    if not self.buffer or now < self.retry_at:
+      return False
+    return len(self.buffer) >= self.max_batch or now - self.oldest_at >= self.flush_interval_s
+
+  async def flush(self):
+    if self.session is None:
+      self.session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=2, keepalive_timeout=120),
+        timeout=aiohttp.ClientTimeout(total=self.timeout_s),
+      )
+
+    batch = self.buffer[:self.max_batch]
+    body, headers = self.encode(batch)
+    start = time.time()
+
+    try:
+      async with self.session.post(self.url, data=body, headers={**headers, **self.headers}) as resp:
+        if resp.status >= 300:
+          raise aiohttp.ClientResponseError(
+            resp.request_info, resp.history, status=resp.status, message=await resp.text()
+          )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      self.fail_ctr.inc()
+      status = getattr(e, "status", 0)
+      if 400 <= status < 500 and status != 429:
+        # The server will never take this batch, but that says nothing of
+        # the next one; drop it without backing off
+        del self.buffer[:len(batch)]
+        self.drop_ctr.inc(len(batch))
+        self.oldest_at = time.time() if self.buffer else 0
+        return True
+
+      self.failures_in_row += 1
+      backoff = min(self.max_backoff_s, 2 ** self.failures_in_row)
+      self.retry_at = time.time() + backoff * (0.5 + random.random() / 2)
+      return False
+
+    del self.buffer[:len(batch)]
+    self.oldest_at = time.time() if self.buffer else 0
+    self.failures_in_row = 0
+    self.retry_at = 0
+    self.points_ctr.inc(len(batch))
+    self.bytes_ctr.inc(len(body))
+    self.latency.set(round(time.time() - start, 4))
+    return True
+
+  async def run(self):
+    while True:
+      await self.registry.refresh()
+      self.collect()
+      while self.should_flush(time.time()):
+        if not await self.flush():
+          break
+      await asyncio.sleep(self.collect_interval_s)
+
+  async def stop(self):
+    if self.buffer:
+      self.retry_at = 0
+      await self.flush()
+    if self.session:
+      await self.session.close()
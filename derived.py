@@ -0,0 +1,237 @@
+import ast
+import heapq
+import math
+
+
+def c_to_f(c):
+  return c * 1.8 + 32.0
+
+
+def f_to_c(f):
+  return (f - 32.0) / 1.8
+
+
+def dew_point(temp_c, humidity_pc):
+  """Magnus formula; good to about 0.35C between -45C and 60C"""
+  b, c = 17.62, 243.12
+  gamma = math.log(max(humidity_pc, 0.1) / 100.0) + b * temp_c / (c + temp_c)
+  return c * gamma / (b - gamma)
+
+
+FUNCTIONS = {
+  "c_to_f": c_to_f,
+  "f_to_c": f_to_c,
+  "dew_point": dew_point,
+  "abs": abs,
+  "min": min,
+  "max": max,
+  "round": round,
+  "sqrt": math.sqrt,
+  "log": math.log,
+  "exp": math.exp,
+}
+
+ALLOWED_NODES = (
+  ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Attribute,
+  ast.Constant, ast.IfExp, ast.Compare, ast.BoolOp, ast.Load,
+  ast.operator, ast.unaryop, ast.cmpop, ast.boolop,
+)
+
+
+class _Inputs(ast.NodeTransformer):
+  """Rewrites `field` and `device.field` into lookups in the values dict"""
+
+  def __init__(self, device):
+    self.device = device
+    self.inputs = set()
+
+  def _lookup(self, node, key):
+    self.inputs.add(key)
+    sub = ast.Subscript(
+      value=ast.Name("_v", ast.Load()), slice=ast.Constant(key), ctx=ast.Load()
+    )
+    return ast.copy_location(sub, node)
+
+  def visit_Call(self, node):
+    if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+      raise ValueError(f"Unknown function in derived expression: {ast.unparse(node.func)}")
+    node.args = [self.visit(a) for a in node.args]
+    return node
+
+  def visit_Name(self, node):
+    return self._lookup(node, (self.device, node.id))
+
+  def visit_Attribute(self, node):
+    if not isinstance(node.value, ast.Name):
+      raise ValueError(f"Expected device.field, got {ast.unparse(node)}")
+    return self._lookup(node, (node.value.id, node.attr))
+
+
+class Derivation:
+  __slots__ = ("output", "source", "inputs", "fn", "rank")
+
+  def __init__(self, device, field, source):
+    tree = ast.parse(source, mode="eval")
+    for node in ast.walk(tree):
+      if not isinstance(node, ALLOWED_NODES):
+        raise ValueError(f"{type(node).__name__} not allowed in derived expression {source!r}")
+
+    rewriter = _Inputs(device)
+    body = rewriter.visit(tree).body
+    fn = ast.Expression(ast.Lambda(
+      args=ast.arguments(
+        posonlyargs=[], args=[ast.arg("_v")], kwonlyargs=[], kw_defaults=[], defaults=[]
+      ),
+      body=body,
+    ))
+    ast.fix_missing_locations(fn)
+
+    self.output = (device, field)
+    self.source = source
+    self.inputs = frozenset(rewriter.inputs)
+    self.fn = eval(compile(fn, f"<derived {device}.{field}>", "eval"), {
+      "__builtins__": {}, **FUNCTIONS
+    })
+    self.rank = 0
+
+
+class DerivedMetrics:
+  """
+  Values computed from other values: unit conversions, power from voltage
+  and current, dew point, sums across devices. Definitions are
+  {device: {field: expression}}, where a bare name is a field of the same
+  device and `other.field` a field of another one.
+
+  Expressions are compiled once, when defined. When readings arrive, only
+  the derivations that use a changed value are evaluated, in dependency
+  order, and a derivation whose result changes in turn re-evaluates only
+  what depends on it. Results are set as gauges under each device's scope.
+  """
+
+  def __init__(self, observer, metrics=None):
+    self.observer = observer
+    self.values = {}
+    self.gauges = {}
+    self.dependents = {}
+    self.derivations = {}
+    self.fed_by = {}
+
+    if metrics:
+      self.evals_ctr = metrics.counter("evals", "Derived values evaluated")
+      self.errors_ctr = metrics.counter("errors", "Derived values that failed to evaluate")
+      metrics.gauge("defined", "Derived values defined").set_fn(lambda: len(self.derivations))
+    else:
+      self.evals_ctr = self.errors_ctr = None
+
+  def define(self, definitions):
+    """
+    Replace every derivation. Nothing changes if any expression fails to
+    compile or the derivations depend on each other in a cycle.
+    """
+    self.install(self.compile(definitions))
+
+  def compile(self, definitions):
+    """Check and rank `definitions` for install(), without changing anything"""
+    derivations = {}
+    for device, fields in definitions.items():
+      for field, source in fields.items():
+        d = Derivation(device, field, source)
+        derivations[d.output] = d
+
+    dependents = {}
+    fed_by = {}
+    for d in derivations.values():
+      for key in d.inputs:
+        dependents.setdefault(key, []).append(d)
+        fed_by.setdefault(key[0], set()).add(d.output)
+
+    # Rank each derivation by its depth in the graph, so a heap on rank
+    # evaluates every input before the things computed from it
+    visiting = set()
+
+    def rank(d):
+      if d.output in visiting:
+        raise ValueError(f"Derived value {'.'.join(d.output)} depends on itself")
+      if d.rank:
+        return d.rank
+      visiting.add(d.output)
+      d.rank = 1 + max((rank(derivations[k]) for k in d.inputs if k in derivations), default=0)
+      visiting.discard(d.output)
+      return d.rank
+
+    for d in derivations.values():
+      rank(d)
+
+    return derivations, dependents, fed_by
+
+  def install(self, compiled):
+    derivations, dependents, fed_by = compiled
+    self.derivations = derivations
+    self.dependents = dependents
+    self.fed_by = fed_by
+    for key in list(self.values):
+      if key in self.gauges and key not in derivations:
+        del self.values[key]
+        del self.gauges[key]
+
+  def _gauge_(self, key):
+    gauge = self.gauges.get(key)
+    # The registry may have evicted it, when its device went quiet
+    if gauge is None or not gauge.observer.registry.holds(gauge):
+      gauge = self.gauges[key] = self.observer.scoped(key[0]).gauge(key[1])
+    return gauge
+
+  def update(self, device, readings, at=None):
+    """
+    Take new numeric readings from `device` and re-evaluate whatever they
+    feed. Returns {field: value} of the derived values of `device` that
+    were evaluated.
+    """
+    pending = []
+    queued = set()
+
+    def changed(key, value):
+      if self.values.get(key) == value:
+        return
+      self.values[key] = value
+      for d in self.dependents.get(key, ()):
+        if d.output not in queued:
+          queued.add(d.output)
+          heapq.heappush(pending, (d.rank, d.output))
+
+    for field, value in readings.items():
+      changed((device, field), value)
+
+    # Values that didn't change are still current; keep their gauges fresh
+    for key in self.fed_by.get(device, ()):
+      if key not in queued and key in self.gauges:
+        self._gauge_(key).set(self.values[key], at)
+
+    out = {}
+    while pending:
+      _, key = heapq.heappop(pending)
+      queued.discard(key)
+      d = self.derivations[key]
+
+      try:
+        value = d.fn(self.values)
+      except KeyError:
+        # Some input hasn't been seen yet
+        continue
+      except (ArithmeticError, ValueError, TypeError):
+        if self.errors_ctr:
+          self.errors_ctr.inc()
+        continue
+
+      if self.evals_ctr:
+        self.evals_ctr.inc()
+      if isinstance(value, bool) or not isinstance(value, (int, float)):
+        continue
+
+      value = round(value, 3)
+      self._gauge_(key).set(value, at)
+      if key[0] == device:
+        out[key[1]] = value
+      changed(key, value)
+
+    return out
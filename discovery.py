@@ -0,0 +1,213 @@
+import json
+import time
+import zlib
+import array
+from collections import OrderedDict
+from aiohttp import web
+
+
+class CountMinSketch:
+  """Approximate counts in fixed memory; never undercounts"""
+
+  def __init__(self, width=1024, depth=4):
+    self.width = width
+    self.depth = depth
+    self.rows = [array.array("L", [0]) * width for _ in range(depth)]
+
+  def _slots(self, item):
+    raw = item.encode()
+    h1 = zlib.crc32(raw)
+    h2 = zlib.adler32(raw) | 1
+    return ((h1 + i * h2) % self.width for i in range(self.depth))
+
+  def add(self, item, n=1):
+    for row, slot in zip(self.rows, self._slots(item)):
+      row[slot] += n
+
+  def estimate(self, item):
+    return min(row[slot] for row, slot in zip(self.rows, self._slots(item)))
+
+
+class RssiSummary:
+  """Running count, min, max and mean RSSI in constant space"""
+
+  __slots__ = ("count", "min", "max", "total", "last")
+
+  def __init__(self):
+    self.count = 0
+    self.min = 0
+    self.max = -200
+    self.total = 0
+    self.last = None
+
+  def add(self, rssi):
+    if self.count == 0 or rssi < self.min:
+      self.min = rssi
+    if rssi > self.max:
+      self.max = rssi
+    self.count += 1
+    self.total += rssi
+    self.last = rssi
+
+  def as_dict(self):
+    mean = round(self.total / self.count, 1) if self.count else None
+    return {"min": self.min, "max": self.max, "mean": mean, "last": self.last}
+
+
+class Advertiser:
+  __slots__ = ("address", "name", "count", "error", "first_at", "last_at", "rssi",
+    "mfg_ids", "services")
+
+  def __init__(self, address, count, error, at):
+    self.address = address
+    self.name = None
+    self.count = count
+    self.error = error
+    self.first_at = at
+    self.last_at = at
+    self.rssi = RssiSummary()
+    self.mfg_ids = set()
+    self.services = set()
+
+  def rate_per_min(self, now):
+    span = max(now - self.first_at, 1.0)
+    return round(self.count * 60 / span, 2)
+
+  def as_dict(self, now):
+    return {
+      "address": self.address,
+      "name": self.name,
+      "count": self.count,
+      "count_error": self.error,
+      "per_min": self.rate_per_min(now),
+      "last_seen_s": round(now - self.last_at, 1),
+      "rssi": self.rssi.as_dict(),
+      "mfg_ids": sorted(f"0x{m:04X}" for m in self.mfg_ids),
+      "services": sorted(self.services),
+    }
+
+
+class Discovery:
+  """
+  Aggregates every advertiser in range in bounded memory. The heaviest
+  `capacity` advertisers are tracked in full with the space-saving
+  algorithm: when a new address arrives and the table is full, it replaces
+  the entry with the lowest count, inheriting that count as its error
+  bound. Tracked entries are also kept in buckets by count, oldest first,
+  so finding that entry and counting an advert are both O(1). A count-min
+  sketch over all addresses gives an estimate of how many adverts any
+  address sent, tracked or not.
+
+  Manufacturer IDs and service UUIDs are also counted across all adverts,
+  which is what the dispatch filters are built from.
+  """
+
+  def __init__(self, capacity=256, max_ids=256):
+    self.capacity = capacity
+    self.max_ids = max_ids
+    self.tracked = {}
+    self.by_count = {}
+    self.min_count = 0
+    self.sketch = CountMinSketch()
+    self.mfg_counts = {}
+    self.service_counts = {}
+    self.total = 0
+    self.started_at = time.time()
+
+  def _count_id(self, counts, key):
+    if key in counts or len(counts) < self.max_ids:
+      counts[key] = counts.get(key, 0) + 1
+
+  def _track_(self, entry):
+    self.tracked[entry.address] = entry
+    self.by_count.setdefault(entry.count, OrderedDict())[entry.address] = entry
+    if entry.count < self.min_count or self.min_count not in self.by_count:
+      self.min_count = entry.count
+
+  def _untrack_(self, entry):
+    del self.tracked[entry.address]
+    bucket = self.by_count[entry.count]
+    del bucket[entry.address]
+    if not bucket:
+      del self.by_count[entry.count]
+
+  def on_advertise(self, device, adv):
+    now = time.time()
+    addr = device.address.upper()
+    self.total += 1
+    self.sketch.add(addr)
+
+    entry = self.tracked.get(addr)
+    if entry:
+      self._untrack_(entry)
+      entry.count += 1
+      entry.last_at = now
+    elif len(self.tracked) < self.capacity:
+      entry = Advertiser(addr, 1, 0, now)
+    else:
+      # The least seen entry that has gone longest without an advert
+      victim = next(iter(self.by_count[self.min_count].values()))
+      self._untrack_(victim)
+      entry = Advertiser(addr, victim.count + 1, victim.count, now)
+    self._track_(entry)
+
+    entry.rssi.add(adv.rssi)
+    if device.name:
+      entry.name = device.name
+
+    for mfg_id in adv.manufacturer_data:
+      if len(entry.mfg_ids) < 8:
+        entry.mfg_ids.add(mfg_id)
+      self._count_id(self.mfg_counts, mfg_id)
+
+    for uuid in list(adv.service_data) + list(adv.service_uuids):
+      if len(entry.services) < 8:
+        entry.services.add(uuid)
+      self._count_id(self.service_counts, uuid)
+
+  def top(self, n=20):
+    return sorted(self.tracked.values(), key=lambda e: e.count, reverse=True)[:n]
+
+  def estimate(self, address):
+    """Adverts seen from `address`, even if it is not tracked any more"""
+    return self.sketch.estimate(address.upper())
+
+  def report(self, n=50):
+    now = time.time()
+    return {
+      "adverts": self.total,
+      "since_s": round(now - self.started_at),
+      "advertisers": [e.as_dict(now) for e in self.top(n)],
+      "mfg_ids": {
+        f"0x{k:04X}": v for k, v in sorted(self.mfg_counts.items(), key=lambda kv: -kv[1])
+      },
+      "services": dict(sorted(self.service_counts.items(), key=lambda kv: -kv[1])),
+    }
+
+  def table(self, n=20):
+    now = time.time()
+    lines = [
+      f"{self.total} adverts from {len(self.tracked)} tracked advertisers",
+      f"{'address':<17} {'per_min':>8} {'count':>7} {'rssi':>5}  name / ids",
+    ]
+    for e in self.top(n):
+      ids = " ".join(sorted(f"0x{m:04X}" for m in e.mfg_ids) + sorted(e.services))
+      lines.append(
+        f"{e.address:<17} {e.rate_per_min(now):>8} {e.count:>7} {e.rssi.last:>5}  "
+        f"{e.name or '-'} {ids}"
+      )
+    return "\n".join(lines)
+
+  def routes(self):
+    async def handle_discover(request):
+      try:
+        n = int(request.query.get("n", 50))
+      except ValueError:
+        raise web.HTTPBadRequest(text="n must be an integer")
+      if n < 0:
+        raise web.HTTPBadRequest(text="n must not be negative")
+      return web.Response(
+        text=json.dumps(self.report(n), indent=2), content_type="application/json"
+      )
+
+    return [web.get("/discover", handle_discover)]
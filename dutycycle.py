@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+
+class DeviceCadence:
+  __slots__ = ("name", "period_s", "margin", "misses_in_row")
+
+  def __init__(self, name, period_s, margin):
+    self.name = name
+    self.period_s = period_s
+    self.margin = margin
+    self.misses_in_row = 0
+
+
+class DutyCycler:
+  """
+  Scans in windows instead of continuously. Every `period_s` (the shortest
+  publish interval of any device), the scanner runs just long enough to
+  hear each device at least once, which is its learned advert interval
+  times a safety margin. Between windows, the scanner is paused by
+  `pause_scan` and picked up again by `resume_scan`.
+
+  A device missed in a window gets a wider margin, up to scanning
+  continuously; margins shrink back while it is caught reliably. Devices
+  whose cadence isn't known yet don't size the window; until any is known,
+  windows last the whole period. Per-window coverage is exported so losing
+  a device is never silent.
+
+  A failed pause or resume is logged and counted, and tried again next
+  window. Scanning is resumed when the cycler stops.
+  """
+
+  def __init__(self, resume_scan, pause_scan, interval_of, min_window_s=2.0,
+      base_margin=2.5, max_margin=20.0, observer=None, log=None):
+    self.resume_scan = resume_scan
+    self.pause_scan = pause_scan
+    self.interval_of = interval_of
+    self.min_window_s = min_window_s
+    self.base_margin = base_margin
+    self.max_margin = max_margin
+    self.log = log
+    self.devices = {}
+    self.seen = set()
+    self.scanning = True
+
+    self.window_g = observer.gauge("window_s", "Length of the current scan window")
+    self.period_g = observer.gauge("period_s", "Time between scan window starts")
+    self.coverage_g = observer.gauge("coverage", "Fraction of devices heard in the last window")
+    self.caught_g = observer.gauge("caught", "Devices heard in the last window")
+    self.windows_ctr = observer.counter("windows", "Scan windows completed")
+    self.missed_ctr = observer.counter("missed", "Scan windows in which a device was not heard")
+    self.errors_ctr = observer.counter("errors", "Scanner pauses and resumes that failed")
+
+  def add(self, name, period_s):
+    self.devices[name] = DeviceCadence(name, period_s, self.base_margin)
+
+  def remove(self, name):
+    self.devices.pop(name, None)
+
+  def saw(self, name):
+    self.seen.add(name)
+
+  def plan(self):
+    """(window_s, period_s) for the next cycle"""
+    if not self.devices:
+      return 0, 0
+
+    period = min(d.period_s for d in self.devices.values())
+    windows = [
+      interval * d.margin
+      for d in self.devices.values() if (interval := self.interval_of(d.name))
+    ]
+    if not windows:
+      # Listen all the time until some device's cadence has been learned
+      return period, period
+
+    return min(max(self.min_window_s, *windows), period), period
+
+  def score(self):
+    """Record which devices the window caught, and adapt their margins"""
+    caught = 0
+    for d in self.devices.values():
+      if d.name in self.seen:
+        caught += 1
+        d.misses_in_row = 0
+        d.margin = max(self.base_margin, d.margin * 0.9)
+      else:
+        d.misses_in_row += 1
+        d.margin = min(self.max_margin, d.margin * 1.5)
+        self.missed_ctr.labeled("device", d.name).inc()
+        if self.log and d.misses_in_row == 3:
+          self.log.err("{} not heard in 3 scan windows in a row", d.name)
+
+    self.seen.clear()
+    self.windows_ctr.inc()
+    self.caught_g.set(caught)
+    self.coverage_g.set(round(caught / len(self.devices), 3) if self.devices else 1)
+
+  async def switch(self, scanning):
+    """Resume or pause scanning; False if that failed"""
+    try:
+      await (self.resume_scan if scanning else self.pause_scan)()
+    except Exception as e:
+      self.errors_ctr.labeled("action", "resume" if scanning else "pause").inc()
+      if self.log:
+        self.log.err("Couldn't {} scanning: {!r}", "resume" if scanning else "pause", e)
+      return False
+    self.scanning = scanning
+    return True
+
+  async def run(self):
+    try:
+      while True:
+        window, period = self.plan()
+        if not period:
+          await asyncio.sleep(self.min_window_s)
+          continue
+
+        self.window_g.set(round(window, 2))
+        self.period_g.set(round(period, 2))
+
+        if not self.scanning:
+          await self.switch(True)
+
+        started = time.time()
+        self.seen.clear()
+        await asyncio.sleep(window)
+
+        if window < period and self.scanning:
+          await self.switch(False)
+
+        self.score()
+        await asyncio.sleep(max(0.0, period - (time.time() - started)))
+    finally:
+      if not self.scanning:
+        await self.switch(True)
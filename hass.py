@@ -0,0 +1,150 @@
+import json
+import os
+import asyncio
+import hashlib
+
+from obs.observer import NullObserver
+
+
+def field_title(field):
+  return field.replace("_", " ").capitalize()
+
+
+class HassDiscovery:
+  """
+  Home Assistant MQTT discovery configs, generated from the decoders'
+  `fields`. A config is made for each field a device has actually
+  published, so a Victron charger doesn't get battery monitor sensors.
+
+  Configs are retained on the broker, so they only need sending when
+  they change. The hash of what each sink has accepted is recorded by
+  `sent()` once the sink got it through, and kept in `cache_path`; a
+  restart with the same devices sends nothing. Delete the cache to send
+  everything again, e.g. after the broker lost its retained messages.
+  """
+
+  def __init__(self, devices, cache_path=None, observer=None, save_delay_s=1):
+    self.devices = devices
+    self.cache_path = cache_path
+    self.save_delay_s = save_delay_s
+    self.seen = {}
+    self.checked = {}
+    self.hashes = self.load_cache()
+    self.dirty = False
+    self.saving = None
+
+    observer = observer or NullObserver()
+    self.sent_ctr = observer.counter("configs_sent", "Discovery configs published")
+    self.unchanged_ctr = observer.counter(
+      "configs_unchanged", "Discovery configs skipped as already published"
+    )
+    observer.gauge("fields", "Fields announced to Home Assistant").set_fn(
+      lambda: sum(len(f) for f in self.seen.values())
+    )
+
+  def load_cache(self):
+    if not self.cache_path:
+      return {}
+    try:
+      with open(self.cache_path) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def write_cache(self, text):
+    tmp = f"{self.cache_path}.tmp"
+    with open(tmp, "w") as f:
+      f.write(text)
+    os.replace(tmp, self.cache_path)
+
+  async def save_cache(self):
+    """Write the cache off the loop, taking in whatever is sent meanwhile"""
+    loop = asyncio.get_running_loop()
+    try:
+      while self.dirty:
+        await asyncio.sleep(self.save_delay_s)
+        self.dirty = False
+        text = json.dumps(self.hashes, indent=1, sort_keys=True)
+        await loop.run_in_executor(None, self.write_cache, text)
+    finally:
+      self.saving = None
+
+  async def flush(self):
+    if self.saving:
+      self.saving.cancel()
+      self.saving = None
+    if self.dirty and self.cache_path:
+      self.dirty = False
+      text = json.dumps(self.hashes, indent=1, sort_keys=True)
+      await asyncio.get_running_loop().run_in_executor(None, self.write_cache, text)
+
+  def sent(self, sink, topic, payload):
+    """`sink` got the config `payload` to its broker"""
+    digest = hashlib.sha1(payload).hexdigest()[:16]
+    sent = self.hashes.setdefault(sink.name, {})
+    if sent.get(topic) == digest:
+      return
+    sent[topic] = digest
+    self.sent_ctr.inc()
+    self.dirty = True
+    if self.cache_path and self.saving is None:
+      self.saving = asyncio.get_running_loop().create_task(self.save_cache())
+
+  def config(self, decoder, field, schema, state_topic):
+    node = f"ble2mqtt_{decoder.name}"
+    config = {
+      "name": field_title(field),
+      "unique_id": f"{node}_{field}",
+      "state_topic": state_topic,
+      "value_template": schema.value_template or f"{{{{ value_json.{field} }}}}",
+      "device": {
+        "identifiers": [node],
+        "name": decoder.name,
+      },
+    }
+    for key, value in (
+      ("device_class", schema.device_class),
+      ("unit_of_measurement", schema.unit),
+      ("state_class", schema.state_class),
+    ):
+      if value:
+        config[key] = value
+    for key, value in (("manufacturer", decoder.manufacturer), ("model", decoder.model)):
+      if value:
+        config["device"][key] = value
+    return node, config
+
+  def messages(self, sink, prefix_str, groups, at):
+    """
+    The discovery messages `sink` needs for `groups`, the (group, values,
+    at) about to be published: those whose config is new or changed, or
+    not yet accepted by the sink's broker.
+    """
+    devices = self.devices()
+    out = []
+    for group, values, _ in groups:
+      decoder = devices.get(group[0]) if len(group) == 1 else None
+      if not decoder or not decoder.fields:
+        continue
+
+      seen = self.seen.setdefault(decoder.name, set())
+      seen.update(f for f in values if f in decoder.fields)
+      # Configs only change with the fields seen, or the decoder (on reload)
+      check = (frozenset(seen), id(decoder))
+      if self.checked.get((sink.name, decoder.name)) == check:
+        continue
+      self.checked[(sink.name, decoder.name)] = check
+
+      state_topic = f"{prefix_str}/{group[0]}"
+      for field in sorted(seen):
+        node, config = self.config(decoder, field, decoder.fields[field], state_topic)
+        topic = f"{sink.hass_prefix}/sensor/{node}/{field}/config"
+        payload = json.dumps(config, sort_keys=True).encode()
+
+        digest = hashlib.sha1(payload).hexdigest()[:16]
+        if self.hashes.get(sink.name, {}).get(topic) == digest:
+          self.unchanged_ctr.inc()
+          continue
+        out.append((topic, payload, at))
+
+    return out
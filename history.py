@@ -0,0 +1,321 @@
+import os
+import json
+import math
+import mmap
+import time
+import struct
+from aiohttp import web
+
+
+# Raw sample: unix time (f64), field id (u16), value (f32)
+RAW_REC = struct.Struct("<dHf")
+
+# Rollup bucket: bucket start (u32), field id (u16), count (u32), min, max, mean
+ROLLUP_REC = struct.Struct("<IHIfff")
+
+
+class Resolution:
+  """One level of storage: its record layout, bucket size and segment span"""
+
+  def __init__(self, name, rec, bucket_s, segment_s, retention_s):
+    self.name = name
+    self.rec = rec
+    self.bucket_s = bucket_s
+    self.segment_s = segment_s
+    self.retention_s = retention_s
+
+  def segment_start(self, at):
+    return int(at // self.segment_s) * self.segment_s
+
+
+DAY_S = 86400
+
+# Largest value a record's f32 can hold
+F32_MAX = 3.4028234663852886e38
+
+RAW = Resolution("raw", RAW_REC, 0, DAY_S, 7 * DAY_S)
+MINUTE = Resolution("1m", ROLLUP_REC, 60, DAY_S, 90 * DAY_S)
+HOUR = Resolution("1h", ROLLUP_REC, 3600, 32 * DAY_S, 5 * 365 * DAY_S)
+
+ROLLUPS = (MINUTE, HOUR)
+
+
+class Bucket:
+  """Running min/max/mean of one field over one rollup bucket"""
+
+  __slots__ = ("start", "count", "min", "max", "total")
+
+  def __init__(self, start, value):
+    self.start = start
+    self.count = 1
+    self.min = value
+    self.max = value
+    self.total = value
+
+  def add(self, value):
+    self.count += 1
+    self.total += value
+    if value < self.min:
+      self.min = value
+    if value > self.max:
+      self.max = value
+
+  def as_record(self, field_id):
+    return (self.start, field_id, self.count, self.min, self.max, self.total / self.count)
+
+  def pack(self, field_id):
+    return ROLLUP_REC.pack(*self.as_record(field_id))
+
+
+class DeviceHistory:
+  """
+  Append-only storage for a single device. Every resolution gets its own
+  directory of segment files named after the unix time at which the segment
+  begins. Rollup buckets are written when they close, which happens per
+  field, so a rollup segment is only roughly in time order. The buckets
+  still open are written on close() and included in reads until then.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.fields_path = os.path.join(path, "fields.json")
+    self.files = {}
+    self.open_buckets = {}
+
+    for res in (RAW,) + ROLLUPS:
+      os.makedirs(os.path.join(path, res.name), exist_ok=True)
+
+    self.fields = {}
+    if os.path.exists(self.fields_path):
+      with open(self.fields_path) as f:
+        self.fields = json.load(f)
+    self.field_names = {i: name for name, i in self.fields.items()}
+
+  def field_id(self, name):
+    fid = self.fields.get(name)
+    if fid is None:
+      fid = len(self.fields)
+      self.fields[name] = fid
+      self.field_names[fid] = name
+      tmp = self.fields_path + ".tmp"
+      with open(tmp, "w") as f:
+        json.dump(self.fields, f)
+      os.replace(tmp, self.fields_path)
+    return fid
+
+  def segment_path(self, res, start):
+    return os.path.join(self.path, res.name, f"{start}.seg")
+
+  def append(self, res, at, data):
+    start = res.segment_start(at)
+    current = self.files.get(res.name)
+    if current is None or current[0] != start:
+      if current:
+        current[1].close()
+      current = (start, open(self.segment_path(res, start), "ab"))
+      self.files[res.name] = current
+    current[1].write(data)
+
+  def record(self, name, value, at):
+    fid = self.field_id(name)
+    self.append(RAW, at, RAW_REC.pack(at, fid, value))
+
+    for res in ROLLUPS:
+      start = int(at // res.bucket_s) * res.bucket_s
+      bkey = (res.name, fid)
+      bucket = self.open_buckets.get(bkey)
+
+      if bucket is None:
+        self.open_buckets[bkey] = Bucket(start, value)
+      elif bucket.start == start:
+        bucket.add(value)
+      elif start > bucket.start:
+        self.append(res, bucket.start, bucket.pack(fid))
+        self.open_buckets[bkey] = Bucket(start, value)
+      # Samples older than the open bucket are kept in raw only
+
+  def flush(self):
+    for _, f in self.files.values():
+      f.flush()
+
+  def close(self):
+    for res in ROLLUPS:
+      for (rname, fid), bucket in list(self.open_buckets.items()):
+        if rname == res.name:
+          self.append(res, bucket.start, bucket.pack(fid))
+    self.open_buckets.clear()
+
+    for _, f in self.files.values():
+      f.close()
+    self.files.clear()
+
+  def segments(self, res, start, end):
+    """Segment start times of `res` which may hold data in [start, end)"""
+    first = res.segment_start(start)
+    for fname in sorted(os.listdir(os.path.join(self.path, res.name))):
+      if fname.endswith(".seg"):
+        seg = int(fname[:-4])
+        if first <= seg < end:
+          yield seg
+
+  def expire(self, now):
+    for res in (RAW,) + ROLLUPS:
+      current = self.files.get(res.name)
+      for seg in self.segments(res, 0, now - res.retention_s - res.segment_s):
+        if current is None or current[0] != seg:
+          os.remove(self.segment_path(res, seg))
+
+  def read_rollup(self, res, start, end):
+    """
+    Yield (bucket_start, field_id, count, min, max, mean) in [start, end),
+    the buckets still open included. A bucket may come in several parts,
+    as one is written on close() and continued after a restart.
+    """
+    size = res.rec.size
+
+    for seg in self.segments(res, start, end):
+      with open(self.segment_path(res, seg), "rb") as f:
+        n = os.fstat(f.fileno()).st_size // size
+        if n == 0:
+          continue
+
+        with mmap.mmap(f.fileno(), n * size, access=mmap.ACCESS_READ) as mm:
+          # Not sorted across fields, so every record has to be looked at
+          for i in range(n):
+            rec = res.rec.unpack_from(mm, i * size)
+            if start <= rec[0] < end:
+              yield rec
+
+    for (rname, fid), bucket in list(self.open_buckets.items()):
+      if rname == res.name and start <= bucket.start < end:
+        yield bucket.as_record(fid)
+
+
+class HistoryStore:
+  """
+  Embedded time-series store holding the numeric readings of every device,
+  along with 1 minute and 1 hour min/max/mean rollups. Range queries are
+  answered from the rollups only.
+  """
+
+  def __init__(self, root, flush_interval_s=10):
+    self.root = root
+    self.flush_interval_s = flush_interval_s
+    self.devices = {}
+    self.last_flush_at = 0
+    os.makedirs(root, exist_ok=True)
+
+  def device(self, name):
+    dev = self.devices.get(name)
+    if dev is None:
+      dev = DeviceHistory(os.path.join(self.root, name))
+      self.devices[name] = dev
+    return dev
+
+  def known_devices(self):
+    return sorted(
+      d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d))
+    )
+
+  def record(self, devname, readings, at):
+    """Record a dict of field -> numeric value for `devname`"""
+    dev = self.device(devname)
+    for name, value in readings.items():
+      value = float(value)
+      # An f32 can't hold it, and NaN would poison the rollups
+      if math.isfinite(value) and abs(value) <= F32_MAX:
+        dev.record(name, value, at)
+
+    if at - self.last_flush_at > self.flush_interval_s:
+      self.flush()
+      self.last_flush_at = at
+
+  def flush(self):
+    for dev in self.devices.values():
+      dev.flush()
+
+  def expire(self, now=None):
+    """Drop expired segments of every device on disk, configured or not"""
+    now = now or time.time()
+    for name in self.known_devices():
+      dev = self.devices.get(name) or DeviceHistory(os.path.join(self.root, name))
+      dev.expire(now)
+
+  def close(self):
+    for dev in self.devices.values():
+      dev.close()
+
+  def query(self, devname, start, end, step, fields=None):
+    """
+    Return {field: [(t, count, min, max, mean), ...]} for `devname` over
+    [start, end), grouped into buckets of `step` seconds. The coarsest
+    rollup which still fits `step` is used.
+    """
+    res = HOUR if step >= HOUR.bucket_s else MINUTE
+    step = max(step, res.bucket_s)
+
+    dev = self.device(devname)
+    dev.flush()
+
+    out = {}
+    for t, fid, count, vmin, vmax, vmean in dev.read_rollup(res, start, end):
+      name = dev.field_names.get(fid)
+      if name is None or (fields and name not in fields):
+        continue
+
+      slot = int((t - start) // step) * step + int(start)
+      series = out.setdefault(name, {})
+      prev = series.get(slot)
+      if prev is None:
+        series[slot] = [count, vmin, vmax, vmean * count]
+      else:
+        prev[0] += count
+        prev[1] = min(prev[1], vmin)
+        prev[2] = max(prev[2], vmax)
+        prev[3] += vmean * count
+
+    return {
+      name: [
+        (t, c, round(lo, 3), round(hi, 3), round(total / c, 3))
+        for t, (c, lo, hi, total) in sorted(series.items())
+      ]
+      for name, series in out.items()
+    }
+
+  def routes(self):
+    """aiohttp routes serving `/history?device=..&from=..&to=..&step=..`"""
+
+    async def handle_history(request):
+      q = request.query
+      now = time.time()
+
+      device = q.get("device")
+      if not device:
+        return web.json_response({"devices": self.known_devices()})
+
+      if device not in self.known_devices():
+        raise web.HTTPNotFound(text=f"No history for {device}")
+
+      try:
+        # Negative times are relative to now
+        start = float(q.get("from", -DAY_S))
+        end = float(q.get("to", now))
+        step = max(int(q.get("step", 300)), MINUTE.bucket_s)
+      except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+      if not (math.isfinite(start) and math.isfinite(end)):
+        raise web.HTTPBadRequest(text="from and to must be finite")
+
+      start = now + start if start < 0 else start
+      end = now + end if end <= 0 else end
+      fields = set(q.getall("field", ())) or None
+
+      return web.json_response({
+        "device": device,
+        "from": round(start),
+        "to": round(end),
+        "step": step,
+        "fields": self.query(device, start, end, step, fields),
+      })
+
+    return [web.get("/history", handle_history)]
@@ -0,0 +1,81 @@
+import time
+from collections import deque
+from statistics import median
+
+
+# Upper bounds of the advert inter-arrival buckets, in seconds
+INTERARRIVAL_BUCKETS_S = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300, float("inf"))
+
+ACTIONS = ("decoded", "throttled", "ignored")
+
+
+class LinkStats:
+  """
+  Link quality of one device, updated in constant time per advert: smoothed
+  RSSI, a histogram of the time between adverts, an estimate of the adverts
+  missed, and how the adverts that did arrive were handled.
+
+  Missed adverts are estimated from the device's nominal interval, the
+  median of the last `window` gaps. A gap of n intervals means n - 1
+  adverts never made it. Adverts closer than `min_gap_s` to the previous
+  one, like the scan response to an active scan, are the same broadcast.
+  """
+
+  def __init__(self, observer, alpha=0.2, window=15, min_gap_s=0.05):
+    self.alpha = alpha
+    self.min_gap_s = min_gap_s
+    self.last_at = 0
+    self.gaps = deque(maxlen=window)
+    self.nominal_s = None
+    self.rssi_ewma = None
+    self.counts = dict.fromkeys(ACTIONS, 0)
+
+    self.rssi = observer.gauge("rssi_ewma", "Smoothed RSSI of adverts, dBm")
+    self.interval = observer.gauge("interval_s", "Estimated advertising interval")
+    self.missed = observer.counter("missed", "Adverts estimated to have been missed")
+    self.interarrival = observer.histogram(
+      "interarrival_s", "Time between adverts", INTERARRIVAL_BUCKETS_S
+    )
+
+    adverts = observer.counter("adverts", "Adverts by how they were handled")
+    self.actions = {a: adverts.labeled("action", a) for a in ACTIONS}
+
+    fraction = observer.gauge("fraction", "Fraction of adverts handled each way")
+    for a in ACTIONS:
+      fraction.labeled("action", a).set_fn(lambda a=a: self.fraction(a))
+
+  def fraction(self, action):
+    total = sum(self.counts.values())
+    return round(self.counts[action] / total, 4) if total else 0
+
+  def on_advert(self, rssi, now=None):
+    now = now or time.time()
+
+    if rssi is not None:
+      if self.rssi_ewma is None:
+        self.rssi_ewma = float(rssi)
+      else:
+        self.rssi_ewma += self.alpha * (rssi - self.rssi_ewma)
+      self.rssi.set(round(self.rssi_ewma, 1), now)
+
+    if self.last_at:
+      gap = now - self.last_at
+      if gap < self.min_gap_s:
+        return
+      self.interarrival.observe(gap, now)
+
+      # Lost adverts make some gaps multiples of the interval; as long as
+      # most arrive, the median is the interval itself
+      self.gaps.append(gap)
+      self.nominal_s = median(self.gaps)
+      missed = round(gap / self.nominal_s) - 1
+      if missed > 0:
+        self.missed.inc(missed)
+
+      self.interval.set(round(self.nominal_s, 3), now)
+
+    self.last_at = now
+
+  def handled(self, action):
+    self.counts[action] += 1
+    self.actions[action].inc()
@@ -1,13 +1,68 @@
 #!/usr/bin/env python3
 import asyncio
+import atexit
+import importlib
+import multiprocessing
+import os
+import signal
+import struct
+from collections import deque
 from enum import Enum, Flag
 from bleak import BleakScanner
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 import time
 
-from obs import reporter
-from consumers import MqttPublisher, OpenMetricPublisher
+from obs import observer, RUNTIME
+from obs.snapshot import save_snapshot, load_snapshot, restore_snapshot
+from obs.data import ObsKind
+from obs.metric import HistSample, INF
+from consumers import MqttSink, MqttPublisher, OpenMetricPublisher, PushExporter
+from history import HistoryStore
+from spool import Spool
+from scheduler import PublishScheduler
+from discovery import Discovery
+from linkstats import LinkStats
+from scanfilter import start_scanner, scan_filters
+from dutycycle import DutyCycler
+from hass import HassDiscovery
+from watchdog import ScannerWatchdog, DEFAULT_ADAPTER_RESET, run_commands
+from derived import DerivedMetrics
+from aggregate import WindowAggregator, STATS
+import sharedring
+
+# Rates are taken over this window, from this many marks across it
+RATE_WINDOW_S = 60
+RATE_MARKS = 12
+
+def mqtt_sinks(config_map, observer):
+  """
+  The brokers to publish to: each entry of `mqtt_sinks`, or the single
+  broker of the top level mqtt_* keys. Unset sink keys default to those.
+  """
+  defaults = {
+    "broker": config_map.get("mqtt_broker_addr"),
+    "username": config_map.get("mqtt_user"),
+    "password": config_map.get("mqtt_pass"),
+    "codec": config_map.get("mqtt_codec", "json"),
+    "bulk": config_map.get("mqtt_bulk", False),
+    "spool_dir": config_map.get("mqtt_spool_dir"),
+    "drain_rate_per_s": config_map.get("mqtt_drain_rate_per_s", 10),
+    "retain": config_map.get("mqtt_retain", False),
+    "hass_prefix": config_map.get("hass_discovery_prefix"),
+  }
+  specs = config_map.get("mqtt_sinks") or [{"name": "default"}]
+
+  sinks = []
+  for spec in specs:
+    spec = dict(defaults, **spec)
+    spool_dir = spec.pop("spool_dir")
+    if spool_dir and len(specs) > 1:
+      spool_dir = os.path.join(spool_dir, spec["name"])
+    sinks.append(MqttSink(
+      spool=Spool(spool_dir=spool_dir), observer=observer, **spec
+    ))
+  return sinks
 
 
 class Ble2Mqtt:
@@ -16,28 +71,59 @@ class Ble2Mqtt:
   publishes those to mqtt, providing some deduping and rate limiting
   """
 
-  def __init__(self, config_map, reporter=reporter()):
-    self.known_devices = config_map["devices"]
+  def __init__(self, config_map, reporter=observer()):
+    self.config_map = config_map
+    self.known_devices = {}
     self.metric_path = tuple(config_map.get("metric_path", ()))
 
+    self.int_metrics = reporter.scoped("ble2mqtt")
+
     self.mqtt_pub_interval_s = config_map["mqtt_pub_interval_s"]
     self.mqtt_exporter = MqttPublisher(
-      broker=config_map["mqtt_broker_addr"],
-      username=config_map.get("mqtt_user"),
-      password=config_map.get("mqtt_pass"),
+      mqtt_sinks(config_map, self.int_metrics.scoped("mqtt")),
       prefix=self.metric_path,
       registry=reporter.registry,
+      observer=self.int_metrics.scoped("mqtt"),
+      discovery=HassDiscovery(
+        lambda: {d.name: d for d in self.known_devices.values()},
+        cache_path=config_map.get("hass_cache_path"),
+        observer=self.int_metrics.scoped("hass"),
+      ),
     )
 
-    self.om_server = OpenMetricPublisher(reporter.registry, port=8088)
-    self.bs_callback = lambda dev, data: self.on_advertise(dev, data)
+    self.mqtt_scheduler = PublishScheduler(
+      self.mqtt_exporter,
+      default_interval_s=self.mqtt_pub_interval_s,
+      msg_rate=config_map.get("mqtt_max_msgs_per_s"),
+      byte_rate=config_map.get("mqtt_max_bytes_per_s"),
+      observer=self.int_metrics.scoped("mqtt", "scheduler"),
+      before_publish=self.flush_aggregates,
+    )
 
-    ## TODO: Make this NOT per-device?
-    for device in self.known_devices.values():
-      device.throttle_s = config_map["ble_throttle_s"]
+    self.om_server = OpenMetricPublisher(
+      reporter.registry, port=8088, observer=self.int_metrics.scoped("stream")
+    )
+
+    self.pusher = None
+    if config_map.get("push_url"):
+      self.pusher = PushExporter(
+        config_map["push_url"],
+        reporter.registry,
+        format=config_map.get("push_format", "influx"),
+        headers=config_map.get("push_headers"),
+        flush_interval_s=config_map.get("push_interval_s", 30),
+        observer=self.int_metrics.scoped("push"),
+      )
+
+    self.history = None
+    if config_map.get("history_dir"):
+      self.history = HistoryStore(config_map["history_dir"])
+      self.om_server.app.add_routes(self.history.routes())
+
+    self.bs_callback = lambda dev, data: self.on_advertise(dev, data)
 
-    self.int_metrics = reporter.scoped("ble2mqtt")
     self.reporter = reporter.scoped(*self.metric_path)
+    self.registry = reporter.registry
 
     bctr = self.int_metrics.counter("beacons", "How each beacon was processed")
     self.bc_h = bctr.labeled("action", "handled")
@@ -48,56 +134,623 @@ class Ble2Mqtt:
       "unhandled", "BLE Beacon data that could not become a metric"
     )
 
+    scan_obs = self.int_metrics.scoped("scan")
+    self.scanner = None
+    self.scanner_passive = None
+    self.scan_paused = False
+    self.scan_passive = config_map.get("ble_passive_scan", True)
+    self.scan_filters = None
+    self.scan_mode = scan_obs.state("mode", "How the scanner is filtering adverts")
+    self.scan_log = scan_obs.log("scan")
+    self.callbacks_ctr = scan_obs.counter("callbacks", "Advert callbacks delivered by bleak")
+    # (at, callbacks) a few times per window, for a rate however often it's
+    # read; seeded once the snapshot has restored the count
+    self.callback_marks = deque(maxlen=RATE_MARKS + 1)
+    scan_obs.gauge(
+      "callbacks_per_s", f"Advert callback rate over the last {RATE_WINDOW_S}s"
+    ).set_fn(self.callback_rate)
+
+    self.duty = None
+    if config_map.get("ble_duty_cycle"):
+      self.duty = DutyCycler(
+        self.resume_scanner,
+        self.pause_scanner,
+        lambda name: self.link_stats[name].nominal_s,
+        observer=scan_obs.scoped("duty"),
+        log=self.scan_log,
+      )
+
+    self.link_obs = self.int_metrics.scoped("link")
+    self.link_stats = {}
+
+    self.last_advert_at = 0
+    self.watchdog = None
+    if config_map.get("ble_watchdog", True):
+      reset_cmds = config_map.get("ble_adapter_reset")
+      if reset_cmds is True:
+        reset_cmds = DEFAULT_ADAPTER_RESET
+      self.watchdog = ScannerWatchdog(
+        lambda: self.link_stats.values(),
+        self.restart_scanner,
+        (lambda: run_commands(reset_cmds)) if reset_cmds else None,
+        observer=scan_obs.scoped("watchdog"),
+        log=self.scan_log,
+        heard_at=lambda: self.last_advert_at,
+      )
+
+    self.derived = DerivedMetrics(self.reporter, self.int_metrics.scoped("derived"))
+
+    # With aggregation, throttled adverts are still decoded and folded into
+    # the window's aggregates rather than dropped
+    agg_stats = config_map.get("ble_aggregate")
+    self.agg_stats = STATS if agg_stats is True else tuple(agg_stats or ())
+    self.aggregators = {}
+
+    reload_obs = self.int_metrics.scoped("reload")
+    self.reload_ctr = reload_obs.counter("reloads", "Config reloads by outcome")
+    self.reload_duration = reload_obs.gauge("duration_s", "How long the last config reload took")
+    self.reload_log = reload_obs.log("reload")
+    reload_obs.gauge("devices", "Devices currently configured").set_fn(
+      lambda: len(self.known_devices)
+    )
+
+    self.apply_devices(config_map["devices"], config_map)
+
+    snap_obs = self.int_metrics.scoped("snapshot")
+    self.snapshot_path = config_map.get("snapshot_path")
+    self.snapshot_bytes = snap_obs.gauge("bytes", "Size of the last registry snapshot")
+    self.snapshot_duration = snap_obs.gauge("duration_s", "How long the last snapshot took")
+    self.snapshot_restored = snap_obs.gauge("restored", "Metrics restored at startup")
+    self.snapshot_log = snap_obs.log("snapshot")
+    if self.snapshot_path:
+      self.load_state()
+    self.callback_marks.append((time.time(), self.callbacks_ctr.value))
+
+  def load_state(self):
+    """Warm start from the last snapshot: counters, readings and what was published"""
+    start = time.perf_counter()
+    snapshot = load_snapshot(self.snapshot_path)
+    if snapshot is None:
+      return
+
+    # This process's own gauges (timings, sizes, states) start afresh
+    restored = restore_snapshot(
+      self.registry, snapshot, local=(self.int_metrics.key.scope, ("runtime",), ("obs",))
+    )
+    if "mqtt" in snapshot.extras:
+      self.mqtt_exporter.restore_state(snapshot.extras["mqtt"])
+    self.snapshot_restored.set(restored)
+    self.snapshot_log.inf(
+      "Restored {} metrics saved {:.0f}s ago in {:.1f}ms", restored,
+      time.time() - snapshot.saved_at, (time.perf_counter() - start) * 1000,
+    )
+
+  def save_state(self):
+    start = time.perf_counter()
+    try:
+      size = save_snapshot(
+        self.snapshot_path, self.registry, {"mqtt": self.mqtt_exporter.state()}
+      )
+    except (OSError, struct.error) as e:
+      self.snapshot_log.err("Couldn't save a snapshot: {!r}", e)
+      return
+    self.snapshot_bytes.set(size)
+    self.snapshot_duration.set(round(time.perf_counter() - start, 4))
+
+  def _check_device_(self, device):
+    """Raise ValueError if `device` can't be set up, before anything is"""
+    interval = device.publish_interval_s or self.mqtt_pub_interval_s
+    if not isinstance(interval, (int, float)) or interval <= 0:
+      raise ValueError(f"{device.name}: publish_interval_s must be positive, not {interval!r}")
+    if not isinstance(device.priority, (int, float)):
+      raise ValueError(f"{device.name}: priority must be a number, not {device.priority!r}")
+
+  def _setup_device_(self, device, config_map):
+    ## TODO: Make this NOT per-device?
+    device.throttle_s = config_map["ble_throttle_s"]
+
+    self.mqtt_scheduler.add(
+      device.name,
+      device.publish_interval_s or self.mqtt_pub_interval_s,
+      device.priority,
+    )
+
+    # Devices that drop out of range stop reporting instead of repeating
+    # their last value forever, and no device can grow the registry unbounded.
+    # Stale metrics are freed, not just hidden, unless metric_evict is off
+    self.registry.limit(
+      self.metric_path + (device.name,),
+      ttl_s=config_map.get("metric_ttl_s"),
+      evict=config_map.get("metric_evict", True),
+      max_metrics=config_map.get("metric_max_per_device", 256),
+    )
+
+    if device.name not in self.link_stats:
+      self.link_stats[device.name] = LinkStats(self.link_obs.labeled("device", device.name))
+
+    if self.duty:
+      self.duty.add(device.name, device.publish_interval_s or self.mqtt_pub_interval_s)
+
+    if self.agg_stats:
+      self.aggregators[device.name] = WindowAggregator(
+        self.reporter.scoped(device.name), self.agg_stats
+      )
+
+  def apply_devices(self, devices, config_map):
+    """
+    Make `devices` the set of known devices, and compile their derived
+    values along with the configured ones. Decoders whose spec did not
+    change are kept as they are, with their throttle state and metrics;
+    the dispatch table is swapped in one assignment so on_advertise sees
+    either the old or the new one. Returns (added, changed, removed).
+
+    Everything is checked before anything changes, so a bad config leaves
+    the old one in place rather than half applied.
+    """
+    throttle_s = config_map["ble_throttle_s"]
+    for key in ("metric_ttl_s", "metric_max_per_device"):
+      value = config_map.get(key)
+      if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+        raise ValueError(f"{key} must be positive, not {value!r}")
+
+    definitions = {d.name: dict(d.derived) for d in devices.values() if d.derived}
+    for name, fields in config_map.get("derived", {}).items():
+      definitions.setdefault(name, {}).update(fields)
+    derivations = self.derived.compile(definitions)
+
+    old = self.known_devices
+    for addr, device in devices.items():
+      current = old.get(addr.upper())
+      if not (current and current.spec == device.spec):
+        self._check_device_(device)
+
+    self.derived.install(derivations)
+    new = {}
+    added, changed = [], []
+
+    for addr, device in devices.items():
+      addr = addr.upper()
+      current = old.get(addr)
+      if current and current.spec == device.spec:
+        new[addr] = current
+        current.throttle_s = throttle_s
+        continue
+
+      (changed if current else added).append(device.name)
+      self._setup_device_(device, config_map)
+      new[addr] = device
+
+    removed = [d.name for a, d in old.items() if a not in new]
+    remaining = {d.name for d in new.values()}
+    for name in removed:
+      if name not in remaining:
+        self.mqtt_scheduler.remove(name)
+        self.aggregators.pop(name, None)
+        self.link_stats.pop(name, None)
+        if self.duty:
+          self.duty.remove(name)
+
+    self.known_devices = new
+    return added, changed, removed
+
+  def reload(self):
+    """Re-import config.py and apply its devices, leaving the scanner running"""
+    start = time.perf_counter()
+    try:
+      import config
+      config_map = importlib.reload(config).CurrentConfig
+      added, changed, removed = self.apply_devices(config_map["devices"], config_map)
+    except Exception as e:
+      self.reload_ctr.labeled("outcome", "error").inc()
+      self.reload_log.err("Config reload failed, keeping the old config: {!r}", e)
+      return False
+    finally:
+      self.reload_duration.set(round(time.perf_counter() - start, 4))
+
+    self.config_map = config_map
+    self.reload_ctr.labeled("outcome", "ok").inc()
+    if self.scanner and scan_filters(self.known_devices.values()) != self.scan_filters:
+      # The controller has to be told about the new patterns
+      if self.scan_paused:
+        self.scanner = None
+      else:
+        asyncio.get_running_loop().create_task(self.start_scanner())
+    self.reload_log.inf(
+      "Config reloaded: added={} changed={} removed={}", added, changed, removed
+    )
+    return True
+
+  async def watch_config(self, path, interval_s):
+    """Reload whenever the config file's mtime changes"""
+    mtime = os.stat(path).st_mtime
+    while True:
+      await asyncio.sleep(interval_s)
+      try:
+        new_mtime = os.stat(path).st_mtime
+      except OSError:
+        continue
+      if new_mtime != mtime:
+        mtime = new_mtime
+        self.reload()
+
+  def callback_rate(self):
+    now = time.time()
+    count = self.callbacks_ctr.value
+    marks = self.callback_marks
+    while len(marks) > 1 and now - marks[1][0] >= RATE_WINDOW_S:
+      marks.popleft()
+    if now - marks[-1][0] >= RATE_WINDOW_S / RATE_MARKS:
+      marks.append((now, count))
+    at, seen = marks[0]
+    return round((count - seen) / max(now - at, 1e-3), 2)
+
+  async def start_scanner(self, passive=None):
+    """(Re)start the scanner with filters derived from the known devices"""
+    if self.scanner and not self.scan_paused:
+      await self.scanner.stop()
+
+    passive = self.scan_passive if passive is None else passive
+    devices = self.known_devices.values()
+    filters = scan_filters(devices)
+    # Before starting, so the watchdog notices if it fails to
+    if self.watchdog:
+      self.watchdog.scanning_started()
+    self.scanner, mode = await start_scanner(
+      self.bs_callback, devices, passive=passive, log=self.scan_log
+    )
+    self.scanner_passive = passive
+    self.scan_paused = False
+    if mode != self.scan_mode.value or filters != self.scan_filters:
+      self.scan_log.inf("Scanning in {} mode with filters {}", mode, filters)
+    self.scan_filters = filters
+    self.scan_mode.set(mode)
+    return mode
+
+  async def stop_scanner(self):
+    """Stop scanning on purpose; the watchdog stops expecting adverts"""
+    if self.watchdog:
+      self.watchdog.scanning_stopped()
+    if self.scanner and not self.scan_paused:
+      await self.scanner.stop()
+    self.scanner = None
+    self.scan_paused = False
+
+  async def restart_scanner(self, timeout_s=10):
+    """
+    Watchdog recovery, which keeps the watchdog expecting adverts. A wedged
+    BlueZ can hang stopping; give up on the old scanner if so.
+    """
+    scanner, self.scanner = self.scanner, None
+    if scanner and not self.scan_paused:
+      try:
+        await asyncio.wait_for(scanner.stop(), timeout_s)
+      except Exception as e:
+        self.scan_log.err("Scanner didn't stop cleanly: {!r}", e)
+    await self.start_scanner()
+
+  async def pause_scanner(self):
+    """Between duty cycle windows: stop the scanner, but keep it to resume"""
+    if self.watchdog:
+      self.watchdog.scanning_stopped()
+    if self.scanner and not self.scan_paused:
+      await self.scanner.stop()
+      self.scan_paused = True
+    # The idle gap isn't lost adverts; don't let the link stats count it as such
+    for link in self.link_stats.values():
+      link.last_at = 0
+
+  async def resume_scanner(self):
+    """Start the paused scanner again, unless it has to be rebuilt"""
+    if self.scanner is None or self.scanner_passive != self.scan_passive:
+      await self.start_scanner()
+      return
+    if self.watchdog:
+      self.watchdog.scanning_started()
+    if self.scan_paused:
+      await self.scanner.start()
+      self.scan_paused = False
+
+  async def check_passive(self, grace_s):
+    """Passive scans can start fine and still deliver nothing; go active if so"""
+    await asyncio.sleep(grace_s)
+    if self.scan_mode.value == "passive" and self.bc_h.value == 0:
+      self.scan_log.err("No adverts decoded in {}s of passive scanning, going active", grace_s)
+      self.scan_passive = False
+      # While paused, resuming the next duty cycle window rebuilds it
+      if not self.scan_paused:
+        await self.start_scanner()
+
   def on_advertise(self, device: BLEDevice, advertisement: AdvertisementData):
+    self.callbacks_ctr.inc()
+    self.last_advert_at = time.time()
     addr = device.address.upper()
     found_device = self.known_devices.get(addr)
 
     if found_device:
-      if found_device.should_throttle():
+      link = self.link_stats[found_device.name]
+      link.on_advert(advertisement.rssi)
+      if self.duty:
+        self.duty.saw(found_device.name)
+
+      throttled = found_device.should_throttle()
+      aggregator = self.aggregators.get(found_device.name)
+      if throttled and not aggregator:
         self.bc_t.inc()
+        link.handled("throttled")
         return
 
       readings_dict = found_device.decode(device, advertisement)
+      if readings_dict:
+        self.on_readings(found_device.name, readings_dict, throttled, time.time())
+
+      if throttled:
+        self.bc_t.inc()
+        link.handled("throttled")
+        return
+
       if readings_dict:
         self.bc_h.inc()
-        self.update_metrics_from_readings(found_device.name, readings_dict)
+        link.handled("decoded")
         return
 
+      link.handled("ignored")
+
     self.bc_i.inc()
 
-  def update_metrics_from_readings(self, devname, readings):
-    when = time.time()
+  def on_readings(self, devname, readings, throttled, when):
+    """
+    Decoded readings of one advert. Throttled ones only feed the aggregates.
+    In split mode, the scanner process replaces this with a ring writer.
+    """
+    aggregator = self.aggregators.get(devname)
+    if aggregator:
+      aggregator.add({
+        k: v for k, v in readings.items()
+        if isinstance(v, (int, float)) and not isinstance(v, (bool, Enum))
+      })
+
+    if not throttled:
+      self.update_metrics_from_readings(devname, readings, when)
+
+  def update_metrics_from_readings(self, devname, readings, when=None):
+    when = when or time.time()
     scoped = self.reporter.scoped(devname)
+    numeric = {}
     for key, val in readings.items():
       match val:
         case float() | int():
           val = round(val, 3)
+          numeric[key] = val
           scoped.gauge(key).set(val, when)
         case Enum() | Flag():
           scoped.state(key).set(val.name.lower(), when)
+        case str():
+          scoped.state(key).set(val, when)
         case _:
           self.unhandled_ctr.inc()
 
+    if numeric:
+      numeric.update(self.derived.update(devname, numeric, when))
+
+    if self.history and numeric:
+      self.history.record(devname, numeric, when)
+
+  def flush_aggregates(self, names):
+    """Close the aggregation window of the devices about to be published"""
+    now = time.time()
+    for name in names:
+      aggregator = self.aggregators.get(name)
+      if aggregator:
+        aggregator.flush(now)
+
   def prepare(self, loop):
+    self.prepare_scanning(loop)
+    self.prepare_exporting(loop)
+    self.prepare_upkeep(loop)
+
+  def prepare_scanning(self, loop):
     async def scan():
-      self.scanner = BleakScanner(detection_callback=self.bs_callback)
-      await self.scanner.start()
+      if await self.start_scanner() == "passive":
+        await self.check_passive(self.config_map.get("ble_passive_grace_s", 120))
 
-    async def export_mqtt():
+    loop.create_task(scan())
+    if self.duty:
+      loop.create_task(self.duty.run())
+    if self.watchdog:
+      loop.create_task(self.watchdog.run())
+
+  def prepare_exporting(self, loop):
+    async def expire_history():
       while True:
-        await asyncio.sleep(self.mqtt_pub_interval_s)
-        await self.mqtt_exporter.publish()
+        self.history.expire()
+        await asyncio.sleep(3600)
 
-    loop.create_task(scan())
-    self.om_server.setup_aiohttp(loop)
+    async def save_state():
+      interval_s = self.config_map.get("snapshot_interval_s", 60)
+      while True:
+        await asyncio.sleep(interval_s)
+        self.save_state()
 
-    loop.create_task(export_mqtt())
+    self.om_server.setup_aiohttp(loop)
+    loop.create_task(self.mqtt_scheduler.run())
+    if self.pusher:
+      loop.create_task(self.pusher.run())
+    if self.history:
+      loop.create_task(expire_history())
+    if self.snapshot_path:
+      loop.create_task(save_state())
+
+  def prepare_upkeep(self, loop):
+    async def expire_metrics():
+      while True:
+        await asyncio.sleep(60)
+        self.registry.expire()
+
+    loop.create_task(expire_metrics())
+    loop.add_signal_handler(signal.SIGHUP, self.reload)
+    RUNTIME.start(loop)
+
+    watch_s = self.config_map.get("config_watch_s")
+    if watch_s:
+      import config
+      loop.create_task(self.watch_config(config.__file__, watch_s))
+
+  async def forward_metrics(self, writer, interval_s=5):
+    """
+    Split mode, scanner side: copy the internal metrics into the ring.
+    Counters go as deltas, which the exporter adds to its own, restored
+    from its snapshot; so they keep counting up when the scanner restarts.
+    """
+    kinds = {
+      ObsKind.COUNTER: sharedring.COUNTER,
+      ObsKind.STATE: sharedring.STATE,
+      ObsKind.HIST: sharedring.HISTOGRAM,
+    }
+    sent = {}
+    while True:
+      await asyncio.sleep(interval_s)
+      await self.registry.refresh(self.int_metrics.key.scope)
+      for r in self.registry.snapshot(prefix=self.int_metrics.key.scope):
+        # The publishing side's metrics are the exporter's to report
+        if not r.at or r.scope[0] in ("mqtt", "push", "hass"):
+          continue
+        kind = kinds.get(r.kind, sharedring.GAUGE)
+        value = r.value
+        if kind == sharedring.COUNTER:
+          value, sent[r.scope, r.labels] = value - sent.get((r.scope, r.labels), 0), value
+          if not value:
+            continue
+        writer.write_metric(kind, "/".join(r.scope), r.labels, value, r.at)
+
+  async def consume_ring(self, reader, interval_s=0.05):
+    """
+    Split mode, exporter side: feed the scanner's readings through the
+    usual path, and its internal metrics in under <internal>/scanner
+    """
+    scanner_obs = self.int_metrics.scoped("scanner")
+    batch, batch_dev = {}, None
+    hist_buckets = {}
+    while True:
+      for kind, flags, at, scope, labels, value in reader.read():
+        if flags & sharedring.LOST:
+          # The rest of the advert being collected may have been overwritten
+          batch, batch_dev = {}, None
+          hist_buckets = {}
+
+        if kind <= sharedring.READING_TEXT:
+          devname, _, field = scope.partition("/")
+          if devname != batch_dev:
+            # Another device's END was lost; its fields aren't this one's
+            batch, batch_dev = {}, devname
+          batch[field] = value
+          if flags & sharedring.END:
+            self.on_readings(devname, batch, bool(flags & sharedring.THROTTLED), at)
+            batch, batch_dev = {}, None
+          continue
+
+        if kind == sharedring.HISTOGRAM:
+          le, value = value
+          if le != "sum":
+            hist_buckets.setdefault((scope, labels), []).append((le, int(value)))
+            continue
+
+        *path, name = scope.split("/")
+        parent = scanner_obs.scoped(*path)
+        for pair in filter(None, labels.split(",")):
+          parent = parent.labeled(*pair.split("=", 1))
+        if kind == sharedring.HISTOGRAM:
+          buckets = hist_buckets.pop((scope, labels), ())
+          bounds = tuple(INF if le == "+Inf" else float(le) for le, _ in buckets)
+          hist = parent.histogram(name, buckets=bounds)
+          # Buckets lost to an overrun leave nothing consistent to set
+          if buckets and hist.bounds == bounds:
+            counts = tuple(c for _, c in buckets)
+            hist.set(HistSample(bounds, counts, value, counts[-1]), at)
+        elif kind == sharedring.COUNTER:
+          counter = parent.counter(name)
+          with counter.lock:
+            counter.set((counter.value or 0) + value, at)
+        elif kind == sharedring.STATE:
+          parent.state(name).set(value, at)
+        else:
+          parent.gauge(name).set(value, at)
+
+      await asyncio.sleep(interval_s)
 
   async def stop(self):
-    await self.scanner.stop()
-    await self.om_server.stop()
-    loop.stop()
-    loop.close()
+    """Stop scanning, and write out everything a restart should pick up"""
+    await self.stop_scanner()
+    if self.om_server.runner:
+      await self.om_server.stop()
+    await self.mqtt_exporter.close()
+    if self.pusher:
+      await self.pusher.stop()
+    if self.history:
+      self.history.close()
+    if self.snapshot_path:
+      self.save_state()
+
+
+def stop_on_signals(loop, app, signals=(signal.SIGINT, signal.SIGTERM)):
+  """Stop `app`, then the loop, on any of `signals`"""
+  async def shutdown():
+    try:
+      if app:
+        await asyncio.wait_for(app.stop(), 30)
+    finally:
+      loop.stop()
+
+  for sig in signals:
+    loop.add_signal_handler(sig, lambda: loop.create_task(shutdown()))
+
+
+def run_exporter(ring_name):
+  """Split mode: the exporter process, publishing what the scanner decodes"""
+  from config import CurrentConfig
+
+  # Ctrl-C goes to the whole process group; the scanner shuts this down
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+
+  app = Ble2Mqtt(CurrentConfig)
+  reader = sharedring.RingReader(sharedring.SharedRing.attach(ring_name), app.int_metrics)
+  app.prepare_exporting(loop)
+  app.prepare_upkeep(loop)
+  loop.create_task(app.consume_ring(reader))
+  stop_on_signals(loop, app, (signal.SIGTERM,))
+  loop.run_forever()
+
+
+def split(loop, config_map):
+  """
+  Scan and decode in this process, and export from a child process, so
+  that scrapes, publishing and their GC pauses don't delay adverts. Decoded
+  readings cross over a shared memory ring.
+  """
+  ring = sharedring.SharedRing.create(config_map.get("split_ring_records", 4096))
+  exporter = multiprocessing.get_context("spawn").Process(
+    target=run_exporter, args=(ring.name,), name="ble2mqtt-exporter", daemon=True
+  )
+  exporter.start()
+
+  # Everything that writes to disk or the network belongs to the exporter
+  app = Ble2Mqtt(dict(
+    config_map, mqtt_spool_dir=None, history_dir=None, push_url=None, snapshot_path=None,
+    hass_cache_path=None,
+  ))
+  writer = sharedring.RingWriter(ring, app.int_metrics)
+  app.on_readings = writer.write_readings
+  app.prepare_scanning(loop)
+  app.prepare_upkeep(loop)
+  loop.create_task(app.forward_metrics(writer))
+
+  def reload():
+    app.reload()
+    os.kill(exporter.pid, signal.SIGHUP)
+
+  loop.add_signal_handler(signal.SIGHUP, reload)
+  return app, exporter, ring
 
 
 def dump_names(loop):
@@ -112,27 +765,53 @@ def dump_names(loop):
   loop.create_task(scan())
 
 
+def discover(loop, port=8088, report_interval_s=30):
+  """Aggregate every advertiser in range, printing a top-N table and serving /discover"""
+  disco = Discovery()
+  server = OpenMetricPublisher(observer().registry, port=port)
+  server.app.add_routes(disco.routes())
+
+  async def scan():
+    scanner = BleakScanner(detection_callback=disco.on_advertise)
+    await scanner.start()
+
+  async def report():
+    while True:
+      await asyncio.sleep(report_interval_s)
+      print(disco.table(), end="\n\n")
+
+  loop.create_task(scan())
+  server.setup_aiohttp(loop)
+  loop.create_task(report())
+
+
 if __name__ == "__main__":
   from config import CurrentConfig
   import sys
-  import signal
 
   loop = asyncio.new_event_loop()
   asyncio.set_event_loop(loop)
-  ble2mqtt = None
-
-  def ctrl_c(sig, frame):
-    print("\nBye!")
-    sys.exit(0)
-
-  signal.signal(signal.SIGINT, ctrl_c)
+  ble2mqtt = exporter = None
 
   cmd = sys.argv[1] if len(sys.argv) > 1 else None
 
   if cmd == "scan":
+    discover(loop)
+  elif cmd == "names":
     dump_names(loop)
+  elif cmd == "split":
+    ble2mqtt, exporter, ring = split(loop, CurrentConfig)
+    atexit.register(ring.close, unlink=True)
   else:
     ble2mqtt = Ble2Mqtt(CurrentConfig)
     ble2mqtt.prepare(loop)
 
+  # systemd stops with SIGTERM; both close the spool, history and snapshot
+  stop_on_signals(loop, ble2mqtt)
   loop.run_forever()
+  print("\nBye!")
+
+  if exporter:
+    # Its SIGTERM handler does the same shutdown as ours
+    exporter.terminate()
+    exporter.join(35)
@@ -1,11 +1,18 @@
-from .registry import Registry
+from .registry import Registry, ConcurrentRegistry
 from .observer import Observer
 from .data import ObsKey
+from .logger import BufferedLogger, SINK
+from .runtime import RuntimeCollector
 from time import time
 
-REGISTRY = Registry()
+REGISTRY = ConcurrentRegistry(logger=BufferedLogger)
 OBSERVER = Observer(REGISTRY)
 
+SINK.observe(OBSERVER.scoped("obs", "log"))
+
+# Event loop lag is only probed once `RUNTIME.start(loop)` is called
+RUNTIME = RuntimeCollector(OBSERVER.scoped("runtime"))
+
 OBSERVER.gauge(
   "started_s", desc="Unix epoch timestamp of module initialization"
 ).set(round(time()))
@@ -82,20 +82,7 @@ class ObsKey:
     return ObsKey(self.scope, new_labels)
 
   def scope_startswith(self, prefix):
-    prefix = to_scope(prefix)
-    # This is always true - an empty prefix matches any scope
-    if not prefix:
-      return True
-
-    if not self.scope:
-      return False
-
-    l_prefix = len(prefix)
-    l_scope = len(self.scope)
-
-    return \
-      l_prefix > l_scope and \
-      all(scope[i] == prefix[i] for i in range(l_prefix))
+    return scope_startswith(self.scope, to_scope(prefix))
 
   def scope_lstripped(self, prefix):
     if self.scope_startswith(prefix):
@@ -107,9 +94,7 @@ class ObsKey:
       self.labels == other.labels
 
   def __lt__(self, other):
-    return \
-      self.scope < other.scope or \
-      self.labels < other.labels
+    return (self.scope, self.labels) < (other.scope, other.labels)
 
   def scope_str(self, joiner='/'):
     return joiner.join(self.scope)
@@ -141,6 +126,7 @@ class Reading:
   value: any
   desc: str
   at: float
+  generation: int = 0
 
   @property
   def dir(self):
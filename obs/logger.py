@@ -1,5 +1,7 @@
 from enum import Enum
 from collections import namedtuple
+import threading
+import atexit
 import time
 import sys
 
@@ -9,31 +11,54 @@ from .data import ObsKey, to_scope, ObsLevel
 LogEntry = namedtuple('LogEntry', ('level', 'at', 'key', 'text', 'values'))
 
 
+FORMAT = "{level} {hh:02d}:{mm:02d}:{ss:02d}{tag} {text}\n"
+
+
+def format_entry(level, at, tag, text, values):
+  message_text = text.format(*values) if values else text
+  ts = time.localtime(at)
+  return FORMAT.format(
+    level=level.name,
+    hh=ts.tm_hour, mm=ts.tm_min, ss=ts.tm_sec,
+    tag=tag,
+    text=message_text
+  )
+
+
+def level_threshold(level):
+  """Messages at or above this are logged. OFF logs nothing at all"""
+  return float("inf") if level is ObsLevel.OFF else level.value
+
+
+def key_tag(key):
+  return f" [{key.om_name()}]" if key.scope else ""
+
+
 class BaseLogger:
   def __init__(self, key=ObsKey.Root, registry=None):
     self.registry = registry
     self.key = key
-    self._level_val = registry.level.value if registry else ObsLevel.INF.value
+    self._level_val = level_threshold(registry.level if registry else ObsLevel.INF)
 
   def set_level(self, new_level):
-    self._level_val = new_level.value
+    self._level_val = level_threshold(new_level)
 
   def handle(self, level, at, text, values):
     pass
 
   def __call__(self, msg, *vals):
-    self.info(text, values)
+    self.inf(msg, *vals)
 
   def dbg(self, msg, *vals):
-    if self._level_val >= ObsLevel.DBG.value:
+    if ObsLevel.DBG.value >= self._level_val:
       self.handle(ObsLevel.DBG, time.time(), msg, vals)
 
   def inf(self, msg, *vals):
-    if self._level_val >= ObsLevel.INF.value:
+    if ObsLevel.INF.value >= self._level_val:
       self.handle(ObsLevel.INF, time.time(), msg, vals)
 
   def err(self, msg, *vals):
-    if self._level_val >= ObsLevel.ERR.value:
+    if ObsLevel.ERR.value >= self._level_val:
       self.handle(ObsLevel.ERR, time.time(), msg, vals)
 
 
@@ -48,21 +73,170 @@ class EntryLogger(BaseLogger):
 
 class TextLogger(BaseLogger):
 
-  FORMAT = "{level} {hh:02d}:{mm:02d}:{ss:02d}{tag} {text}\n"
+  FORMAT = FORMAT
 
   def __init__(self, writeable=sys.stderr, key=ObsKey.Root, registry=None):
     self.writeable = writeable
-    self.tag = f" [{key.om_name()}]" if key.scope else ""
+    self.tag = key_tag(key)
     super().__init__(key=key, registry=registry)
 
   def handle(self, level, at, text, values):
-    message_text = text.format(values)
-    ts = time.localtime(at)
-    self.writeable.write(self.FORMAT.format(
-      level=level.name,
-      hh=ts.tm_hour, mm=ts.tm_min, ss=ts.tm_sec,
-      tag=self.tag,
-      text=message_text
-    ))
+    self.writeable.write(format_entry(level, at, self.tag, text, values))
+
 
+class LogSink:
+  """
+  Preallocated ring of log entries, formatted and written in batches by a
+  background thread so that logging never blocks the caller on I/O. When
+  the ring is full, new entries are dropped and counted. The same thread
+  logs the summaries of rate limited loggers whose windows have ended.
+  """
 
+  def __init__(self, writeable=sys.stderr, capacity=4096, flush_interval_s=0.25):
+    self.writeable = writeable
+    self.capacity = capacity
+    self.flush_interval_s = flush_interval_s
+    self.ring = [None] * capacity
+    self.head = 0
+    self.tail = 0
+    self.lock = threading.Lock()
+    self.wake = threading.Event()
+    self.thread = None
+    self.watched = set()
+    self.dropped = 0
+    self.suppressed = 0
+    self.written = 0
+
+  def push(self, entry):
+    with self.lock:
+      if self.tail - self.head >= self.capacity:
+        self.dropped += 1
+        return
+      self.ring[self.tail % self.capacity] = entry
+      self.tail += 1
+
+    if self.thread is None:
+      self.start()
+
+  def pending(self):
+    return self.tail - self.head
+
+  def take(self):
+    with self.lock:
+      head, tail = self.head, self.tail
+      batch = [self.ring[i % self.capacity] for i in range(head, tail)]
+      for i in range(head, tail):
+        self.ring[i % self.capacity] = None
+      self.head = tail
+    return batch
+
+  def watch(self, logger, watching=True):
+    """Have the sink thread call `logger.summarize` while watching"""
+    with self.lock:
+      if watching:
+        self.watched.add(logger)
+      else:
+        self.watched.discard(logger)
+
+  def summarize(self, now):
+    with self.lock:
+      loggers = list(self.watched)
+    for logger in loggers:
+      logger.summarize(now)
+
+  def flush(self):
+    self.write(self.take())
+
+  def write(self, batch):
+    if batch:
+      self.writeable.write("".join(
+        format_entry(e.level, e.at, key_tag(e.key), e.text, e.values) for e in batch
+      ))
+      self.writeable.flush()
+      self.written += len(batch)
+
+  def run(self):
+    while True:
+      self.wake.wait(self.flush_interval_s)
+      self.wake.clear()
+      self.summarize(time.time())
+      batch = self.take()
+      try:
+        self.write(batch)
+      except Exception:
+        # A broken writeable must not take the process down with it
+        self.dropped += len(batch)
+
+  def start(self):
+    with self.lock:
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, name="obs-log", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+  def observe(self, observer):
+    """Export log sink counts on `observer`"""
+    observer.gauge("dropped", "Log entries dropped with the buffer full or the writer failing").set_fn(
+      lambda: self.dropped
+    )
+    observer.gauge("suppressed", "Log entries suppressed by rate limits").set_fn(
+      lambda: self.suppressed
+    )
+    observer.gauge("pending", "Log entries waiting to be written").set_fn(self.pending)
+
+
+SINK = LogSink()
+
+
+class BufferedLogger(EntryLogger):
+  """
+  Hands entries to a LogSink instead of writing them. Each call site,
+  identified by its format string, may log at most `burst` entries per
+  `window_s`. The rest are counted, and a summary is logged when the
+  window ends, by the sink thread if the call site has gone quiet.
+  """
+
+  def __init__(self, key=ObsKey.Root, registry=None, sink=None, burst=20, window_s=10):
+    super().__init__(key=key, registry=registry)
+    self.sink = sink or SINK
+    self.burst = burst
+    self.window_s = window_s
+    # msg -> [window start, logged, suppressed, level]
+    self.sites = {}
+    self.lock = threading.Lock()
+
+  def report(self, msg, site, at):
+    self.sink.push(LogEntry(
+      site[3], at, self.key, "suppressed {} entries like: {}", (site[2], msg)
+    ))
+    site[2] = 0
+
+  def summarize(self, now):
+    """Report sites whose window ended with entries suppressed"""
+    with self.lock:
+      left = False
+      for msg, site in self.sites.items():
+        if site[2] and now - site[0] >= self.window_s:
+          self.report(msg, site, now)
+        elif site[2]:
+          left = True
+      if not left:
+        self.sink.watch(self, False)
+
+  def handle(self, level, at, msg, vals):
+    with self.lock:
+      site = self.sites.get(msg)
+      if site is None or at - site[0] >= self.window_s:
+        if site and site[2]:
+          self.report(msg, site, at)
+        site = self.sites[msg] = [at, 0, 0, level]
+
+      if site[1] >= self.burst:
+        if not site[2]:
+          self.sink.watch(self)
+        site[2] += 1
+        self.sink.suppressed += 1
+        return
+
+      site[1] += 1
+      self.sink.push(LogEntry(level, at, self.key, msg, vals))
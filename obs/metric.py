@@ -1,9 +1,17 @@
 import time
+from bisect import bisect_left
 from enum import Enum
 from dataclasses import dataclass
 from collections import namedtuple
+from contextlib import nullcontext
 
 from .data import Reading, ObsKey, ObsKind
+from .valuefn import ValueFn, DEFAULT_MAX_AGE_S
+
+
+NOLOCK = nullcontext()
+
+INF = float("inf")
 
 
 class Metric:
@@ -16,26 +24,46 @@ class Metric:
     'key',
     'observer',
     'desc',
-    'value',
+    'sample',
     'value_fn',
-    'last_sample_at',
     'level',
-    'kwargs'
+    'kwargs',
+    'lock',
+    'clock',
   )
 
-  def __init__(self, key, observer, level, desc="", **kwargs):
+  def __init__(self, key, observer, level, desc="", lock=NOLOCK, clock=None, **kwargs):
     self.key = key
     self.observer = observer
     self.desc = desc
     self.kwargs = kwargs
     self.level = level
+    self.lock = lock
+    self.clock = clock
 
-    self.value = None
+    # (value, last_sample_at, generation), always replaced as a whole so a
+    # reader on another thread never sees a value with the wrong time
+    self.sample = (None, 0, 0)
     self.value_fn = None
-    self.last_sample_at = 0
 
     self._init_metric_(**kwargs)
 
+  @property
+  def value(self):
+    return self.sample[0]
+
+  @value.setter
+  def value(self, value):
+    self.sample = (value,) + self.sample[1:]
+
+  @property
+  def last_sample_at(self):
+    return self.sample[1]
+
+  @property
+  def generation(self):
+    return self.sample[2]
+
   def _init_metric_(self, **kwargs):
     pass
 
@@ -49,8 +77,6 @@ class Metric:
       **self.kwargs
     )
 
-    return ret
-
   def peek(self):
     """Peek at the value of this metric. Sometimes this is not possible
     Like in histograms, etc.
@@ -64,22 +90,28 @@ class Metric:
 
     return self.default
 
-  def set_fn(self, value_fn):
-    """Have this metric use `value_fn` to retrieve the value when collected"""
+  def set_fn(self, value_fn, timeout_s=1.0, max_age_s=DEFAULT_MAX_AGE_S, blocking=False):
+    """
+    Have this metric use `value_fn` to retrieve the value when collected.
+    It may be a coroutine function; see ValueFn.
+    """
     assert self.last_sample_at == 0, "Cannot set a function once a metric has been used"
-    self.last_sample_at = 0
-    self.value_fn = value_fn
+    self.value_fn = ValueFn(value_fn, timeout_s, max_age_s, blocking)
 
-  def set(self, value):
+  def _store_(self, value, at):
+    with self.lock:
+      gen = next(self.clock) if self.clock else self.sample[2] + 1
+      self.sample = (value, at or time.time(), gen)
+
+  def set(self, value, at=None):
     assert self.value_fn is None, "Cannot set a metric with a value_fn"
-    self.value = value
-    self.last_sample_at = time.time()
+    self._store_(value, at)
 
   def update(self):
     """ Update this metric from the given function if it has one. Noop if not """
-    if self.value_fn:
-      self.value = self.value_fn()
-      self.last_sample_at = time.time()
+    vf = self.value_fn
+    if vf and vf.inline and not vf.fresh(self.last_sample_at):
+      self._store_(vf.fn(), None)
 
   def read(self):
     self.update()
@@ -98,7 +130,8 @@ class Counter(Metric):
 
   def inc(self, amt=1):
     assert amt > 0, "Amount must be positive"
-    self.set(self.value + amt)
+    with self.lock:
+      self.set(self.value + amt)
 
 
 class Gauge(Metric):
@@ -108,10 +141,12 @@ class Gauge(Metric):
     self.value = value
 
   def inc(self, amt=1.0):
-    self.set(self.value + amt)
+    with self.lock:
+      self.set(self.value + amt)
 
   def dec(self, amt=1.0):
-    self.set(self.value - amt)
+    with self.lock:
+      self.set(self.value - amt)
 
 
 class State(Metric):
@@ -120,13 +155,13 @@ class State(Metric):
   def _init_metric_(self, states=[], **kwargs):
     self.allowed_states = set(states) if states else None
 
-  def set(self, new_state):
+  def set(self, new_state, at=None):
     assert isinstance(new_state, str)
 
     if self.allowed_states and new_state not in self.allowed_states:
-      raise Exception(f"State {new_state} is not in {self.states}")
+      raise Exception(f"State {new_state} is not in {self.allowed_states}")
 
-    super().set(new_state)
+    super().set(new_state, at)
 
 
 class Stat(Metric):
@@ -134,6 +169,51 @@ class Stat(Metric):
   pass
 
 
+class HistSample(namedtuple("HistSample", ("bounds", "counts", "sum", "count"))):
+  """Cumulative: counts[i] observations were <= bounds[i]"""
+
+  __slots__ = ()
+
+  def buckets(self):
+    """(le label, cumulative count) per bucket"""
+    return tuple(
+      ("+Inf" if b == INF else f"{b:g}", c) for b, c in zip(self.bounds, self.counts)
+    )
+
+  def as_dict(self):
+    d = {f"le_{le}": c for le, c in self.buckets()}
+    d["sum"] = round(self.sum, 6)
+    d["count"] = self.count
+    return d
+
+
+class BucketHistogram(Metric):
+  """
+  A Prometheus histogram: cumulative counts per upper bound `buckets`, plus
+  the sum and count of what was observed. Each observation swaps in a
+  whole new HistSample, so readers never see one half updated.
+  """
+
+  kind = ObsKind.HIST
+
+  def _init_metric_(self, buckets=(), **kwargs):
+    bounds = tuple(sorted(buckets))
+    if not bounds or bounds[-1] != INF:
+      bounds += (INF,)
+    self.bounds = bounds
+    self.value = HistSample(bounds, (0,) * len(bounds), 0.0, 0)
+
+  def set_fn(self, value_fn):
+    raise NotImplementedError("Histograms do not use functions")
+
+  def observe(self, value, at=None):
+    i = bisect_left(self.bounds, value)
+    with self.lock:
+      s = self.value
+      counts = s.counts[:i] + tuple(c + 1 for c in s.counts[i:])
+      self._store_(HistSample(self.bounds, counts, s.sum + value, s.count + 1), at)
+
+
 class NullMetric(Metric):
   """Does nothing successfully"""
 
@@ -155,6 +235,9 @@ class NullMetric(Metric):
   def rec(*args, **kwargs):
     pass
 
+  def observe(*args, **kwargs):
+    pass
+
   def get(self):
     return (None, 0)
 
@@ -1,7 +1,8 @@
 from .data import ObsKey, ObsLevel
 
 from .timeseries import Histogram, BucketCounters
-from .metric import Gauge, Counter, Stat, State
+from .metric import Gauge, Counter, Stat, State, BucketHistogram, NullMetric
+from .logger import BaseLogger
 
 
 class Observer:
@@ -10,6 +11,7 @@ class Observer:
     self.registry = registry
     self.level = ObsLevel.INF
     self.children = set()
+    self.child_obs = {}
 
   def _get_(self, klass, key, desc, level, **kwargs):
     metric = self.registry.find_or_create(
@@ -29,23 +31,28 @@ class Observer:
     for c in self.children:
       c.set_level(new_level)
 
+  def _child_(self, new_key):
+    # Children are reused, so scoping on every advert doesn't grow this set
+    child = self.child_obs.get(new_key)
+    if child is None:
+      child = Observer(self.registry, new_key)
+      self.child_obs[new_key] = child
+      self.children.add(child)
+    return child
+
   def labeled(self, lname, lval):
     new_key = self.key.labeled(lname, lval)
     if new_key == self.key:
       return self
     else:
-      new_obs = Observer(self.registry, new_key)
-      self.children.add(new_obs)
-      return new_obs
+      return self._child_(new_key)
 
   def scoped(self, *scope):
     new_key = self.key.scoped(*scope)
     if new_key == self.key:
       return self
     else:
-      new_obs = Observer(self.registry, new_key)
-      self.children.add(new_obs)
-      return new_obs
+      return self._child_(new_key)
 
   def counter(self, name, desc=""):
     key = self.key.scoped(name)
@@ -63,6 +70,11 @@ class Observer:
     key = self.key.scoped(name)
     return self._get_(State, key, desc, self.level, state=state, states=states, **kwargs)
 
+  def histogram(self, name, desc="", buckets=()):
+    """Cumulative counts of observations <= each of `buckets`, with sum and count"""
+    key = self.key.scoped(name)
+    return self._get_(BucketHistogram, key, desc, self.level, buckets=tuple(buckets))
+
   def hist(self, name, desc="", sample_count=5000, time_window_s=60, **kwargs):
     key = self.key.scoped(name)
     return self._get_(BucketCounters,
@@ -79,13 +91,16 @@ class Observer:
 
 class NullObserver(Observer):
   def __init__(self):
-    self.null_metric = NullMetric(reporter=self, path=Path.of("null"), desc="NullMetric")
+    self.key = ObsKey.Root
+    self.null_metric = NullMetric(
+      key=self.key, observer=self, level=ObsLevel.OFF, desc="NullMetric"
+    )
 
   def scoped(self, *args, **kwargs):
-    return self.null_metric
+    return self
 
   def labeled(self, *args, **kwargs):
-    return self.null_metric
+    return self
 
   def counter(self, *args, **kwargs):
     return self.null_metric
@@ -101,3 +116,9 @@ class NullObserver(Observer):
 
   def state(self, *args, **kwargs):
     return self.null_metric
+
+  def histogram(self, *args, **kwargs):
+    return self.null_metric
+
+  def log(self, *args, **kwargs):
+    return BaseLogger()
@@ -1,14 +1,18 @@
 from .metric import *
 from .data import Reading, to_scope
 from .logger import TextLogger, ObsLevel
-from threading import RLock
+from .retention import ScopePolicy, find_policy
+from threading import Lock, RLock
+import itertools
+import asyncio
 import time
 
 
 class Readings:
-  def __init__(self, items, at=time.time()):
+  def __init__(self, items, at=None, generation=0):
     self.items = items
-    self.at = at
+    self.at = at or time.time()
+    self.generation = generation
 
   def filtered(self, prefix=(), after=0):
     if not prefix or after:
@@ -28,14 +32,20 @@ class Readings:
         at=r.at
       ) for r in self.items if inc(r.scope, r.at)
     )
-    return Readings(items=new_items, at=self.at)
+    return Readings(items=new_items, at=self.at, generation=self.generation)
 
   def as_dict(self):
+    """
+    Readings grouped by their directory: { dir: { name: Reading } }. The
+    name of a labeled reading has its label values appended, `name_v1_v2`,
+    so labeled siblings don't overwrite each other.
+    """
     ret = {}
     for r in self.items:
-      group = r.scope
+      group = r.dir
       ret.setdefault(group, {})
-      ret[group][r.labels] = r
+      name = "_".join((r.name,) + tuple(str(v) for _, v in r.labels))
+      ret[group][name] = r
 
     return ret
 
@@ -54,6 +64,68 @@ class Registry:
     self.logs = dict()
     self.logger = logger
     self.level = ObsLevel.INF
+    self.policies = dict()
+
+  def limit(self, scope, ttl_s=None, evict=False, max_metrics=None):
+    """
+    Apply a staleness TTL and/or a cardinality cap to every metric under
+    `scope`. The most specific scope with a policy wins.
+    """
+    scope = to_scope(scope)
+    policy = ScopePolicy(scope, ttl_s=ttl_s, evict=evict, max_metrics=max_metrics)
+    policy.overflow = self.find_or_create(
+      Counter, None, ObsKey(("obs", "evicted"), (("scope", "/".join(scope)),)),
+      "Metrics evicted to stay under a cardinality cap", ObsLevel.INF
+    )
+    if scope in self.policies:
+      policy.members = self.policies[scope].members
+    else:
+      for key in self.metrics:
+        if key.scope_startswith(scope) and find_policy(self.policies, key.scope) is None:
+          policy.members.add(key)
+    self.policies[scope] = policy
+    return policy
+
+  def _admit_(self, key):
+    """Account for a new metric, evicting the least recently sampled if over the cap"""
+    policy = find_policy(self.policies, key.scope)
+    if policy is None:
+      return
+
+    policy.members.add(key)
+    if policy.max_metrics and len(policy.members) > policy.max_metrics:
+      victim = min(
+        (k for k in policy.members if k != key),
+        key=lambda k: self.metrics[k].last_sample_at
+      )
+      self._remove_(victim)
+      policy.overflow.inc()
+
+  def _remove_(self, key):
+    metric = self.metrics.pop(key, None)
+    if metric:
+      self._forget_(key, metric)
+
+  def _forget_(self, key, metric):
+    policy = find_policy(self.policies, key.scope)
+    if policy:
+      policy.members.discard(key)
+    if metric.observer:
+      metric.observer.children.discard(metric)
+
+  def holds(self, metric):
+    """Whether `metric` is still registered; whoever caches one can check"""
+    return self.metrics.get(metric.key) is metric
+
+  def expire(self, now=None):
+    """Evict stale metrics of every scope whose policy asks for it"""
+    now = now or time.time()
+    for policy in self.policies.values():
+      if policy.evict and policy.ttl_s:
+        for key in [
+          k for k in policy.members if policy.is_stale(self.metrics[k].last_sample_at, now)
+        ]:
+          self._remove_(key)
 
   def find_or_create_log(self, key, level):
     if key not in self.logs:
@@ -69,21 +141,19 @@ class Registry:
       return self.metrics[key].peek()
 
   def get(self, klass, key):
-    metric = self.metric.get(key)
+    metric = self.metrics.get(key)
     if metric and klass != metric.__class__:
       raise Exception("Metric class mismatch")
 
     return metric
 
+  def _new_metric_(self, klass, observer, key, desc, level, **kwargs):
+    return klass(key=key, observer=observer, level=level, desc=desc, **kwargs)
+
   def find_or_create(self, klass, observer, key, desc, level, **kwargs):
     if key not in self.metrics:
-      self.metrics[key] = klass(
-        key=key,
-        observer=observer,
-        level=level,
-        desc=desc,
-        **kwargs
-      )
+      self.metrics[key] = self._new_metric_(klass, observer, key, desc, level, **kwargs)
+      self._admit_(key)
 
     metric = self.metrics[key]
 
@@ -92,39 +162,193 @@ class Registry:
 
     return metric
 
+  async def refresh(self, prefix=()):
+    """
+    Evaluate every stale value function under `prefix` concurrently. An
+    evaluation already in flight, started by another exporter, is awaited
+    rather than repeated.
+    """
+    prefix = to_scope(prefix)
+    now = time.time()
+    due = [
+      m for k, m in self.metrics.items()
+      if m.value_fn and k.scope_startswith(prefix)
+      and not m.value_fn.fresh(m.last_sample_at, now)
+    ]
+    if due:
+      await asyncio.gather(*(self._evaluate_(m) for m in due))
+
+  async def _evaluate_(self, metric):
+    vf = metric.value_fn
+    if vf.pending is None:
+      vf.pending = asyncio.ensure_future(self._run_fn_(metric))
+      vf.pending.add_done_callback(lambda _: setattr(vf, "pending", None))
+    await asyncio.shield(vf.pending)
+
+  def _fn_metric_(self, klass, name, metric, desc):
+    key = ObsKey(("obs", "fn", name), (("metric", metric.key.om_name()),))
+    return self.find_or_create(klass, None, key, desc, ObsLevel.INF)
+
+  async def _run_fn_(self, metric):
+    start = time.perf_counter()
+    try:
+      metric._store_(await metric.value_fn.evaluate(), None)
+    except asyncio.TimeoutError:
+      self._fn_metric_(Counter, "timeouts", metric, "Value functions that ran out of time").inc()
+    except Exception:
+      self._fn_metric_(Counter, "errors", metric, "Value functions that raised").inc()
+    finally:
+      self._fn_metric_(Gauge, "eval_s", metric, "Time the last value function evaluation took") \
+        .set(round(time.perf_counter() - start, 6))
+
   def collect(self):
     return Readings(tuple(self.readings()))
 
-  def readings(self, level=ObsLevel.INF, prefix=(), after=0):
+  def read(self, prefix=(), after=0, after_gen=0):
+    return Readings(tuple(self.readings(prefix=prefix, after=after, after_gen=after_gen)))
+
+  def readings(self, level=ObsLevel.INF, prefix=(), after=0, after_gen=0):
     """ Gather all readings in this registry, optionally filtering """
     lv = level.value
     prefix = to_scope(prefix)
+    policies = self.policies
+    now = time.time()
 
     for key, metric in sorted(self.metrics.items()):
       if lv >= metric.level.value and key.scope_startswith(prefix):
         metric.update()
-        if metric.last_sample_at >= after:
+        value, at, gen = metric.sample
+        if policies:
+          policy = find_policy(policies, key.scope)
+          if policy and policy.is_stale(at, now):
+            continue
+        if at >= after and (not after_gen or gen > after_gen):
           yield Reading(
-            value=metric.value,
+            value=value,
             scope=key.scope_lstripped(prefix),
             labels=key.labels,
             kind=metric.kind,
             desc=metric.desc,
-            at=metric.last_sample_at
+            at=at,
+            generation=gen
           )
 
+  def snapshot(self, level=ObsLevel.INF, prefix=(), after=0, after_gen=0):
+    return Readings(tuple(self.readings(level, prefix, after, after_gen)))
 
-class ThreadsafeRegistry:
-  def __init__(self):
-    self._reg = Registry()
+
+class ThreadsafeRegistry(Registry):
+  """
+  Registry behind a single lock: every write to any metric and every
+  snapshot hold it. Simple, but scrapes stall all writers.
+  """
+
+  def __init__(self, logger=TextLogger):
+    super().__init__(logger)
     self.lock = RLock()
 
-  def find_or_create(self, klass, reporter, path, desc, labels, **kwargs):
+  def _new_metric_(self, klass, observer, key, desc, level, **kwargs):
+    return klass(
+      key=key, observer=observer, level=level, desc=desc, lock=self.lock, **kwargs
+    )
+
+  def find_or_create(self, klass, observer, key, desc, level, **kwargs):
     with self.lock:
-      return self._reg.find_or_create(klass, reporter, path, desc, labels, **kwargs)
+      return super().find_or_create(klass, observer, key, desc, level, **kwargs)
 
-  def collect(self):
-    # Materialize items into a list right away and release the lock
+  def limit(self, *args, **kwargs):
+    with self.lock:
+      return super().limit(*args, **kwargs)
+
+  def expire(self, now=None):
     with self.lock:
-      return self._reg.collect()
+      super().expire(now)
+
+  def snapshot(self, level=ObsLevel.INF, prefix=(), after=0, after_gen=0):
+    # Materialize items into a tuple right away and release the lock
+    with self.lock:
+      return super().snapshot(level, prefix, after, after_gen)
+
+  def collect(self):
+    return self.snapshot()
+
+  def read(self, prefix=(), after=0, after_gen=0):
+    return self.snapshot(prefix=prefix, after=after, after_gen=after_gen)
+
+
+class ConcurrentRegistry(Registry):
+  """
+  Registry safe to write from many threads while readers take snapshots.
+
+  Metrics are spread over `shards` locks, which only serialize the
+  read-modify-write of inc/dec. Every write swaps in a whole
+  (value, at, generation) tuple, so readers never lock and never see a torn
+  sample. The metrics dict is copied on write, as new metrics are rare,
+  which lets readers iterate it while other threads create metrics.
+
+  Generations come from one registry-wide clock. A snapshot takes its
+  generation before reading any metric, so every write it missed has a
+  newer one, and is picked up by reading on from there. Writes made while
+  it is taken may be in it too, with generations newer than its own: each
+  sample is consistent, but the snapshot as a whole is not one instant.
+  """
+
+  def __init__(self, logger=TextLogger, shards=16):
+    super().__init__(logger)
+    self.create_lock = RLock()
+    self.shards = tuple(RLock() for _ in range(shards))
+    self.clock = itertools.count(1)
+
+  def _new_metric_(self, klass, observer, key, desc, level, **kwargs):
+    return klass(
+      key=key, observer=observer, level=level, desc=desc,
+      lock=self.shards[hash(key) % len(self.shards)],
+      clock=self.clock,
+      **kwargs
+    )
+
+  def find_or_create(self, klass, observer, key, desc, level, **kwargs):
+    metric = self.metrics.get(key)
+    if metric is None:
+      with self.create_lock:
+        metric = self.metrics.get(key)
+        if metric is None:
+          metric = self._new_metric_(klass, observer, key, desc, level, **kwargs)
+          metrics = dict(self.metrics)
+          metrics[key] = metric
+          self.metrics = metrics
+          self._admit_(key)
+
+    if klass != metric.__class__:
+      raise Exception("Metric class mismatch")
+
+    return metric
+
+  def limit(self, *args, **kwargs):
+    with self.create_lock:
+      return super().limit(*args, **kwargs)
+
+  def _remove_(self, key):
+    # Readers may be iterating the published dict; only ever swap it whole
+    with self.create_lock:
+      metrics = dict(self.metrics)
+      metric = metrics.pop(key, None)
+      if metric:
+        self.metrics = metrics
+        self._forget_(key, metric)
+
+  def expire(self, now=None):
+    with self.create_lock:
+      super().expire(now)
+
+  def snapshot(self, level=ObsLevel.INF, prefix=(), after=0, after_gen=0):
+    # Before reading, so nothing written meanwhile is older than this
+    gen = next(self.clock)
+    return Readings(tuple(self.readings(level, prefix, after, after_gen)), generation=gen)
+
+  def collect(self):
+    return self.snapshot()
+
+  def read(self, prefix=(), after=0, after_gen=0):
+    return self.snapshot(prefix=prefix, after=after, after_gen=after_gen)
 
@@ -0,0 +1,29 @@
+class ScopePolicy:
+  """
+  Limits on the metrics under a scope. Metrics not written for `ttl_s` are
+  stale: they are left out of readings, and removed entirely by
+  `Registry.expire` when `evict` is set. At most `max_metrics` may exist
+  under the scope; creating one more evicts the least recently sampled.
+  """
+
+  __slots__ = ("scope", "ttl_s", "evict", "max_metrics", "members", "overflow")
+
+  def __init__(self, scope, ttl_s=None, evict=False, max_metrics=None):
+    self.scope = scope
+    self.ttl_s = ttl_s
+    self.evict = evict
+    self.max_metrics = max_metrics
+    self.members = set()
+    self.overflow = None
+
+  def is_stale(self, at, now):
+    return bool(self.ttl_s and at and now - at > self.ttl_s)
+
+
+def find_policy(policies, scope):
+  """The policy with the longest scope that `scope` starts with, if any"""
+  for i in range(len(scope), -1, -1):
+    policy = policies.get(scope[:i])
+    if policy:
+      return policy
+  return None
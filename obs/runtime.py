@@ -0,0 +1,162 @@
+import asyncio
+import gc
+import os
+import sys
+import time
+from collections import deque
+
+
+# Upper bounds of the histogram buckets, in seconds; +Inf is implied
+LAG_BUCKETS_S = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+GC_PAUSE_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+# How many marks (heap block counts, GC pause maxima) cover a window
+WINDOW_SLOTS = 12
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes():
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * PAGE_SIZE
+  except OSError:
+    import resource
+    # Peak rather than current, but the best there is off Linux (kB there)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds():
+  try:
+    return len(os.listdir("/proc/self/fd"))
+  except OSError:
+    return None
+
+
+class RuntimeCollector:
+  """
+  Health of the process itself: how late the event loop runs callbacks,
+  GC collections and their pauses per generation, resident memory, heap
+  blocks, open file descriptors and asyncio tasks.
+
+  Loop lag is measured by a probe that sleeps `probe_interval_s` and
+  records how much later than that it woke up. GC pauses are timed from
+  `gc.callbacks`. The rest is only read when metrics are collected, so
+  the cost between scrapes is one probe wakeup per interval.
+
+  The worst lag and the heap growth cover the last `window_s`, however
+  often or by however many exporters they are read.
+  """
+
+  def __init__(self, observer, probe_interval_s=0.25, window_s=60):
+    self.observer = observer
+    self.probe_interval_s = probe_interval_s
+    self.window_s = window_s
+    self.loop = None
+    self.probe = None
+    self.gc_started = None
+    self.lags = deque(maxlen=max(1, round(window_s / probe_interval_s)))
+    self.heap_marks = deque([(time.monotonic(), sys.getallocatedblocks())], maxlen=WINDOW_SLOTS + 1)
+    # [slot start, longest pause in it]
+    self.pause_slots = deque(maxlen=WINDOW_SLOTS + 1)
+
+    loop_obs = observer.scoped("loop")
+    self.lag = loop_obs.gauge("lag_s", "How late the last loop probe woke up")
+    loop_obs.gauge("lag_max_s", f"Worst loop lag over the last {window_s}s").set_fn(self.lag_max)
+    self.lag_hist = loop_obs.histogram("probe_lag_s", "Loop probes by lag", LAG_BUCKETS_S)
+    loop_obs.gauge("tasks", "Asyncio tasks not yet done").set_fn(self.task_count)
+
+    gc_obs = observer.scoped("gc")
+    self.gc_gens = tuple(
+      (
+        gc_obs.labeled("generation", str(g)).counter("collections", "GC collections"),
+        gc_obs.labeled("generation", str(g)).counter("collected", "Objects GC collected"),
+        # Its _sum is the time spent paused in this generation
+        gc_obs.labeled("generation", str(g)).histogram(
+          "pause_s", "GC pauses by duration", GC_PAUSE_BUCKETS_S
+        ),
+      )
+      for g in range(3)
+    )
+    gc_obs.gauge("pause_max_s", f"Longest GC pause over the last {window_s}s").set_fn(
+      self.pause_max
+    )
+
+    mem_obs = observer.scoped("memory")
+    mem_obs.gauge("rss_bytes", "Resident set size").set_fn(rss_bytes)
+    mem_obs.gauge("heap_blocks", "Memory blocks allocated by the interpreter").set_fn(
+      sys.getallocatedblocks
+    )
+    mem_obs.gauge(
+      "heap_growth_blocks", f"Change in heap blocks over the last {window_s}s"
+    ).set_fn(self.heap_growth)
+    observer.gauge("open_fds", "Open file descriptors").set_fn(open_fds)
+
+    gc.callbacks.append(self.on_gc)
+
+  def on_gc(self, phase, info):
+    if phase == "start":
+      self.gc_started = time.perf_counter()
+      return
+
+    if self.gc_started is None:
+      return
+    pause = time.perf_counter() - self.gc_started
+    self.gc_started = None
+
+    collections, collected, pauses = self.gc_gens[info["generation"]]
+    collections.inc()
+    if info["collected"]:
+      collected.inc(info["collected"])
+    pauses.observe(pause)
+
+    now = time.monotonic()
+    slots = self.pause_slots
+    if slots and now - slots[-1][0] < self.window_s / WINDOW_SLOTS:
+      slots[-1][1] = max(slots[-1][1], pause)
+    else:
+      slots.append([now, pause])
+
+  def lag_max(self):
+    return round(max(self.lags, default=0.0), 6)
+
+  def pause_max(self):
+    since = time.monotonic() - self.window_s
+    return round(max((p for at, p in self.pause_slots if at >= since), default=0.0), 6)
+
+  def heap_growth(self):
+    return sys.getallocatedblocks() - self.heap_marks[0][1]
+
+  def mark_heap(self, now):
+    if now - self.heap_marks[-1][0] >= self.window_s / WINDOW_SLOTS:
+      self.heap_marks.append((now, sys.getallocatedblocks()))
+
+  def task_count(self):
+    if self.loop is None or self.loop.is_closed():
+      return None
+    return len(asyncio.all_tasks(self.loop))
+
+  async def run_probe(self):
+    interval = self.probe_interval_s
+    while True:
+      before = time.perf_counter()
+      await asyncio.sleep(interval)
+      lag = max(0.0, time.perf_counter() - before - interval)
+
+      self.lag.set(round(lag, 6))
+      self.lags.append(lag)
+      self.lag_hist.observe(lag)
+      self.mark_heap(time.monotonic())
+
+  def start(self, loop):
+    """Probe `loop`'s lag; GC is watched from construction"""
+    self.loop = loop
+    if self.probe is None:
+      self.probe = loop.create_task(self.run_probe())
+
+  def stop(self):
+    if self.on_gc in gc.callbacks:
+      gc.callbacks.remove(self.on_gc)
+    if self.probe:
+      self.probe.cancel()
+      self.probe = None
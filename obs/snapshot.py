@@ -0,0 +1,229 @@
+import mmap
+import os
+import struct
+import time
+
+from .data import ObsKind, to_scope, scope_startswith
+from .observer import Observer
+
+
+MAGIC = b"OBSS"
+VERSION = 1
+
+# magic, version, record count, saved at
+HEADER = struct.Struct("<4sHId")
+# kind, value type, at
+RECORD = struct.Struct("<BBd")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+F64 = struct.Struct("<d")
+I64 = struct.Struct("<q")
+
+# Value types
+V_FLOAT, V_INT, V_STR = 1, 2, 3
+
+# Only metrics that hold their own value are worth keeping
+KINDS = (ObsKind.COUNTER, ObsKind.GAUGE, ObsKind.STATE)
+
+SEP = "\x1f"
+
+
+def _pack_str(s, wide=False):
+  raw = s.encode()
+  return (U32 if wide else U16).pack(len(raw)) + raw
+
+
+def _unpack_str(buf, off, wide=False):
+  size = U32 if wide else U16
+  (n,) = size.unpack_from(buf, off)
+  off += size.size
+  return bytes(buf[off:off + n]), off + n
+
+
+class SnapshotRecord:
+  __slots__ = ("kind", "scope", "labels", "desc", "value", "at")
+
+  def __init__(self, kind, scope, labels, desc, value, at):
+    self.kind = kind
+    self.scope = scope
+    self.labels = labels
+    self.desc = desc
+    self.value = value
+    self.at = at
+
+
+class Snapshot:
+  """The saved metrics of a registry, plus named blobs of other state"""
+
+  def __init__(self, records, extras, saved_at):
+    self.records = records
+    self.extras = extras
+    self.saved_at = saved_at
+
+
+def encode_snapshot(registry, extras=None, now=None):
+  parts = []
+  count = 0
+  for key, metric in sorted(registry.metrics.items()):
+    value, at, _ = metric.sample
+    if metric.kind not in KINDS or metric.value_fn or not at or value is None:
+      continue
+
+    labels = SEP.join(f"{k}{SEP}{v}" for k, v in key.labels)
+    try:
+      if isinstance(value, str):
+        vtype, raw = V_STR, _pack_str(value)
+      elif isinstance(value, int):
+        vtype, raw = V_INT, I64.pack(int(value))
+      elif isinstance(value, float):
+        vtype, raw = V_FLOAT, F64.pack(value)
+      else:
+        continue
+
+      parts.append(
+        RECORD.pack(metric.kind.value, vtype, at)
+        + _pack_str(SEP.join(key.scope))
+        + _pack_str(labels)
+        + _pack_str(metric.desc or "")
+        + raw
+      )
+    except struct.error:
+      # A string over 64KB or an int beyond 64 bits; not worth failing the rest
+      continue
+    count += 1
+
+  extras = extras or {}
+  parts.append(U32.pack(len(extras)))
+  for name, blob in extras.items():
+    parts.append(_pack_str(name) + U32.pack(len(blob)) + blob)
+
+  header = HEADER.pack(MAGIC, VERSION, count, now or time.time())
+  return header + b"".join(parts)
+
+
+def save_snapshot(path, registry, extras=None):
+  """
+  Write the registry's counters, gauges and states, with `extras`
+  ({name: bytes}), to `path`. The file is replaced atomically, so a crash
+  mid-write leaves the previous snapshot intact.
+  """
+  data = encode_snapshot(registry, extras)
+  tmp = f"{path}.tmp"
+  with open(tmp, "wb") as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp, path)
+
+  dirfd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+  try:
+    os.fsync(dirfd)
+  finally:
+    os.close(dirfd)
+  return len(data)
+
+
+def load_snapshot(path):
+  """Read a snapshot through mmap. Returns None if there is none, or it is unreadable"""
+  try:
+    with open(path, "rb") as f:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except (OSError, ValueError):
+    return None
+
+  try:
+    return decode_snapshot(buf)
+  except (struct.error, UnicodeDecodeError, ValueError):
+    return None
+  finally:
+    buf.close()
+
+
+def decode_snapshot(buf):
+  magic, version, count, saved_at = HEADER.unpack_from(buf, 0)
+  if magic != MAGIC or version != VERSION:
+    raise ValueError("Not a registry snapshot")
+
+  off = HEADER.size
+  records = []
+  for _ in range(count):
+    kind, vtype, at = RECORD.unpack_from(buf, off)
+    off += RECORD.size
+    scope, off = _unpack_str(buf, off)
+    labels, off = _unpack_str(buf, off)
+    desc, off = _unpack_str(buf, off)
+
+    if vtype == V_STR:
+      raw, off = _unpack_str(buf, off)
+      value = raw.decode()
+    elif vtype == V_INT:
+      (value,) = I64.unpack_from(buf, off)
+      off += I64.size
+    else:
+      (value,) = F64.unpack_from(buf, off)
+      off += F64.size
+
+    flat = labels.decode().split(SEP) if labels else []
+    records.append(SnapshotRecord(
+      ObsKind(kind),
+      tuple(scope.decode().split(SEP)),
+      tuple(zip(flat[::2], flat[1::2])),
+      desc.decode(),
+      value,
+      at,
+    ))
+
+  extras = {}
+  (n,) = U32.unpack_from(buf, off)
+  off += U32.size
+  for _ in range(n):
+    name, off = _unpack_str(buf, off)
+    blob, off = _unpack_str(buf, off, wide=True)
+    extras[name.decode()] = blob
+
+  return Snapshot(records, extras, saved_at)
+
+
+def restore_snapshot(registry, snapshot, local=()):
+  """
+  Put the snapshot's values back into `registry`, keeping their original
+  timestamps, so retention policies still expire readings that are old.
+  Counters that already counted something since startup add it on top,
+  so they never go backwards. Gauges and states under a `local` scope
+  describe the process that saved them and are left out, as are any this
+  process has set already. Returns how many metrics were restored.
+  """
+  local = tuple(to_scope(s) for s in local)
+  root = Observer(registry)
+  makers = {
+    ObsKind.COUNTER: Observer.counter,
+    ObsKind.GAUGE: Observer.gauge,
+    ObsKind.STATE: Observer.state,
+  }
+
+  restored = 0
+  for rec in snapshot.records:
+    if rec.kind != ObsKind.COUNTER and any(scope_startswith(rec.scope, s) for s in local):
+      continue
+    obs = root.scoped(*rec.scope[:-1])
+    for k, v in rec.labels:
+      obs = obs.labeled(k, v)
+
+    try:
+      metric = makers[rec.kind](obs, rec.scope[-1], rec.desc)
+    except Exception:
+      # Something else owns this name now
+      continue
+    if metric.value_fn:
+      continue
+
+    value = rec.value
+    if rec.kind == ObsKind.COUNTER:
+      if metric.value:
+        value += metric.value
+    elif metric.last_sample_at:
+      continue
+    metric._store_(value, rec.at)
+    restored += 1
+
+  return restored
@@ -0,0 +1,45 @@
+import asyncio
+import inspect
+import time
+
+
+# How long a value from a function is reused before it is evaluated again.
+# Every exporter reading within this window shares one evaluation.
+DEFAULT_MAX_AGE_S = 1.0
+
+
+class ValueFn:
+  """
+  A function a metric gets its value from when collected. Plain functions
+  are called inline when read. Coroutine functions, and plain functions
+  marked `blocking`, are only evaluated by `Registry.refresh`. They run
+  concurrently there, each bounded by `timeout_s`.
+  """
+
+  __slots__ = ("fn", "is_async", "blocking", "timeout_s", "max_age_s", "pending")
+
+  def __init__(self, fn, timeout_s=1.0, max_age_s=DEFAULT_MAX_AGE_S, blocking=False):
+    self.fn = fn
+    self.is_async = inspect.iscoroutinefunction(fn)
+    self.blocking = blocking
+    self.timeout_s = timeout_s
+    self.max_age_s = max_age_s
+    self.pending = None
+
+  @property
+  def inline(self):
+    return not (self.is_async or self.blocking)
+
+  def fresh(self, at, now=None):
+    return bool(at) and (now or time.time()) - at < self.max_age_s
+
+  async def evaluate(self):
+    if self.is_async:
+      return await asyncio.wait_for(self.fn(), self.timeout_s)
+    if self.blocking:
+      loop = asyncio.get_running_loop()
+      return await asyncio.wait_for(loop.run_in_executor(None, self.fn), self.timeout_s)
+    return self.fn()
+
+  def __call__(self):
+    return self.fn()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Round trips of the binary payload formats at the edges of their fields:
+ints and floats too big for the schema codec's i32/f32, and bulk frames
+with entries too long for their u8/u16 length fields.
+
+  python payload_tester.py
+"""
+import json
+import struct
+
+from payloads import SchemaCodec, pack_bulk, unpack_bulk
+
+
+def decode_schema(schema_payload, payload):
+  """What a subscriber does with a topic's $schema and a payload"""
+  fields = json.loads(schema_payload)["fields"]
+  numeric = [(n, t) for n, t in fields if t != "s"]
+  fixed = struct.Struct("<H" + "".join(t for _, t in numeric))
+  values = dict(zip((n for n, _ in numeric), fixed.unpack_from(payload)[1:]))
+  pos = fixed.size
+  for name, t in fields:
+    if t == "s":
+      size = payload[pos]
+      values[name] = payload[pos + 1:pos + 1 + size].decode()
+      pos += 1 + size
+  return values
+
+
+def schema_wide_numbers():
+  codec = SchemaCodec()
+  small = codec.encode("ble/dev", {"count": 7, "v": 1.5})
+  values = {"count": 2 ** 40, "v": 1e300, "name": "x"}
+  big = codec.encode("ble/dev", values)
+  announced = dict(codec.announcements())
+  # A new schema, announced, since the types changed
+  assert len(big) > len(small)
+  assert decode_schema(announced["ble/dev/$schema"], big) == values
+
+
+def bulk_long_entries():
+  messages = [
+    ("ble/short", b"1"),
+    ("ble/" + "t" * 300, b"2"),
+    ("ble/big", bytes(range(256)) * 300),
+    ("ble/edge", b"e" * 0xFFFF),
+  ]
+  assert list(unpack_bulk(pack_bulk(messages))) == messages
+
+
+def main():
+  for check in (schema_wide_numbers, bulk_long_entries):
+    check()
+    print(f"{check.__name__}: ok")
+
+
+if __name__ == "__main__":
+  main()
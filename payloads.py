@@ -0,0 +1,196 @@
+import json
+import zlib
+import struct
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+try:
+  import cbor2
+except ImportError:
+  cbor2 = None
+
+
+SCHEMA_SUFFIX = "/$schema"
+BULK_SUFFIX = "/$bulk"
+
+
+class PayloadCodec:
+  """Turns the dict of values of one group into the bytes of an MQTT payload"""
+
+  name = None
+
+  def encode(self, topic, values):
+    raise NotImplementedError
+
+  def announcements(self):
+    """(topic, payload) messages to publish retained before any others"""
+    return ()
+
+
+class JsonCodec(PayloadCodec):
+  name = "json"
+
+  def encode(self, topic, values):
+    return json.dumps(values, separators=(",", ":")).encode()
+
+
+class MsgpackCodec(PayloadCodec):
+  name = "msgpack"
+
+  def __init__(self):
+    if msgpack is None:
+      raise ImportError("MessagePack payloads need the msgpack package")
+
+  def encode(self, topic, values):
+    return msgpack.packb(values, use_single_float=True)
+
+
+class CborCodec(PayloadCodec):
+  name = "cbor"
+
+  def __init__(self):
+    if cbor2 is None:
+      raise ImportError("CBOR payloads need the cbor2 package")
+
+  def encode(self, topic, values):
+    return cbor2.dumps(values, canonical=True)
+
+
+class CompiledSchema:
+  """
+  Fixed layout for one topic's fields, compiled once. The payload is a
+  2 byte schema id, the numeric fields packed as i32/f32 in field order,
+  then each string field as a length-prefixed UTF-8 run. Ints beyond i32
+  get an i64 ("q") and floats beyond f32 an f64 ("d") instead, which
+  makes a schema of its own.
+  """
+
+  TYPES = {int: "i", float: "f", str: "s"}
+  I32_MIN, I32_MAX = -2 ** 31, 2 ** 31 - 1
+  F32_MAX = 3.4028234663852886e38
+
+  def __init__(self, signature):
+    self.signature = signature
+    self.names = tuple(name for name, _ in signature)
+    self.numeric = tuple(name for name, t in signature if t != "s")
+    self.strings = tuple(name for name, t in signature if t == "s")
+
+    desc = json.dumps(signature, separators=(",", ":")).encode()
+    self.id = zlib.crc32(desc) & 0xFFFF
+    self.fixed = struct.Struct(
+      "<H" + "".join(t for _, t in signature if t != "s")
+    )
+
+  @classmethod
+  def type_of(cls, value):
+    t = cls.TYPES.get(type(value), "s")
+    if t == "i" and not cls.I32_MIN <= value <= cls.I32_MAX:
+      return "q"
+    if t == "f" and abs(value) > cls.F32_MAX and abs(value) != float("inf"):
+      return "d"
+    return t
+
+  @classmethod
+  def signature_of(cls, values):
+    return tuple((name, cls.type_of(v)) for name, v in sorted(values.items()))
+
+  def describe(self):
+    return json.dumps({"id": self.id, "fields": self.signature}).encode()
+
+  def pack(self, values):
+    parts = [self.fixed.pack(self.id, *(values[n] for n in self.numeric))]
+    for name in self.strings:
+      raw = str(values[name]).encode()[:255]
+      parts.append(bytes((len(raw),)))
+      parts.append(raw)
+    return b"".join(parts)
+
+
+class SchemaCodec(PayloadCodec):
+  """
+  Fixed-schema binary payloads. A schema is compiled per topic from the
+  fields and types of its values, and recompiled only when those change.
+  Every new schema is announced retained on `<topic>/$schema` so that
+  subscribers can decode the payloads.
+  """
+
+  name = "schema"
+
+  def __init__(self):
+    self.schemas = {}
+    self.pending = []
+
+  def encode(self, topic, values):
+    signature = CompiledSchema.signature_of(values)
+    schema = self.schemas.get(topic)
+
+    if schema is None or schema.signature != signature:
+      schema = CompiledSchema(signature)
+      self.schemas[topic] = schema
+      self.pending.append((topic + SCHEMA_SUFFIX, schema.describe()))
+
+    return schema.pack(values)
+
+  def announcements(self):
+    pending, self.pending = self.pending, []
+    return pending
+
+
+CODECS = {c.name: c for c in (JsonCodec, MsgpackCodec, CborCodec, SchemaCodec)}
+
+
+def codec_for(name):
+  if name not in CODECS:
+    raise ValueError(f"Unknown payload codec {name}, expected one of {list(CODECS)}")
+  return CODECS[name]()
+
+
+BULK_ENTRY_HDR = struct.Struct("<BH")
+# A length field of all ones means the real length follows, wider
+BULK_LONG_TOPIC = 0xFF
+BULK_LONG_PAYLOAD = 0xFFFF
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+
+
+def pack_bulk(messages, level=6):
+  """
+  Pack [(topic, payload), ...] into one zlib compressed frame of
+  (topic length u8, payload length u16, topic, payload) entries. A topic
+  of 255 bytes or more has its length as a u16 after the header, and a
+  payload of 65535 bytes or more as a u32 after that.
+  """
+  parts = []
+  for topic, payload in messages:
+    raw_topic = topic.encode()
+    tlen = min(len(raw_topic), BULK_LONG_TOPIC)
+    plen = min(len(payload), BULK_LONG_PAYLOAD)
+    parts.append(BULK_ENTRY_HDR.pack(tlen, plen))
+    if tlen == BULK_LONG_TOPIC:
+      parts.append(U16.pack(len(raw_topic)))
+    if plen == BULK_LONG_PAYLOAD:
+      parts.append(U32.pack(len(payload)))
+    parts.append(raw_topic)
+    parts.append(payload)
+  return zlib.compress(b"".join(parts), level)
+
+
+def unpack_bulk(frame):
+  data = zlib.decompress(frame)
+  pos = 0
+  while pos < len(data):
+    tlen, plen = BULK_ENTRY_HDR.unpack_from(data, pos)
+    pos += BULK_ENTRY_HDR.size
+    if tlen == BULK_LONG_TOPIC:
+      (tlen,) = U16.unpack_from(data, pos)
+      pos += U16.size
+    if plen == BULK_LONG_PAYLOAD:
+      (plen,) = U32.unpack_from(data, pos)
+      pos += U32.size
+    topic = data[pos:pos + tlen].decode()
+    pos += tlen
+    yield topic, data[pos:pos + plen]
+    pos += plen
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Runs PushExporter against a local stub HTTP server that answers with
+whatever status each scenario scripts: a server that takes everything, one
+that is down for a while, one that rejects a batch outright, and a
+remote-write receiver.
+
+  python push_sim.py
+"""
+import asyncio
+
+from aiohttp import web
+
+from consumers import PushExporter
+from obs.observer import Observer
+from obs.registry import ConcurrentRegistry, Registry
+
+
+class StubServer:
+  """Answers each request with the next of `statuses`, then with the last"""
+
+  def __init__(self, statuses=(204,)):
+    self.statuses = list(statuses)
+    self.requests = []
+    self.runner = None
+    self.url = None
+
+  async def handle(self, request):
+    self.requests.append((dict(request.headers), await request.read()))
+    status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+    return web.Response(status=status)
+
+  async def start(self):
+    app = web.Application()
+    app.add_routes([web.post("/write", self.handle)])
+    self.runner = web.AppRunner(app)
+    await self.runner.setup()
+    site = web.TCPSite(self.runner, "127.0.0.1", 0)
+    await site.start()
+    port = self.runner.addresses[0][1]
+    self.url = f"http://127.0.0.1:{port}/write"
+
+  async def stop(self):
+    await self.runner.cleanup()
+
+
+async def make(statuses, format="influx", registry=None, **kwargs):
+  server = StubServer(statuses)
+  await server.start()
+  registry = registry or Registry()
+  observer = Observer(registry)
+  pusher = PushExporter(
+    server.url, registry, format=format, flush_interval_s=0,
+    observer=observer.scoped("push"), **kwargs
+  )
+  return server, observer.scoped("sim"), pusher
+
+
+async def push(pusher, gauge, value):
+  gauge.set(value)
+  pusher.collect()
+  return await pusher.flush()
+
+
+async def accepted():
+  server, obs, pusher = await make((204,))
+  assert await push(pusher, obs.gauge("temp"), 21.5)
+  assert not pusher.buffer and pusher.points_ctr.value > 0
+  _, body = server.requests[0]
+  assert b"sim_temp" in body and b"21.5" in body, body
+  await pusher.stop()
+  await server.stop()
+
+
+async def server_down():
+  server, obs, pusher = await make((503, 503, 204))
+  gauge = obs.gauge("temp")
+  assert not await push(pusher, gauge, 1)
+  # Kept for a retry, once the backoff is up
+  assert pusher.buffer and pusher.retry_at and not pusher.should_flush(0)
+  assert not await pusher.flush()
+  assert pusher.failures_in_row == 2
+  assert await pusher.flush()
+  assert not pusher.buffer and pusher.failures_in_row == 0 and pusher.retry_at == 0
+  await pusher.stop()
+  await server.stop()
+
+
+async def rejected():
+  server, obs, pusher = await make((400, 204))
+  gauge = obs.gauge("temp")
+  assert await push(pusher, gauge, 1)
+  # Dropped, and the next batch doesn't wait on a backoff
+  assert pusher.drop_ctr.value > 0 and pusher.retry_at == 0
+  assert await push(pusher, gauge, 2)
+  assert len(server.requests) == 2 and pusher.points_ctr.value > 0
+  await pusher.stop()
+  await server.stop()
+
+
+async def remote_write():
+  server, obs, pusher = await make((200,), format="remote_write")
+  assert await push(pusher, obs.gauge("temp"), 3)
+  headers, body = server.requests[0]
+  assert headers["Content-Encoding"] == "snappy", headers
+  assert headers["Content-Type"] == "application/x-protobuf", headers
+  assert b"sim_temp" in body, body
+  await pusher.stop()
+  await server.stop()
+
+
+async def written_mid_snapshot():
+  registry = ConcurrentRegistry()
+  server, obs, pusher = await make((204,), registry=registry)
+  first, second = obs.gauge("a"), obs.gauge("b")
+  first.set(1)
+  second.set(1)
+  readings = registry.readings
+
+  def racing(*args, **kwargs):
+    # "sim_b" is set again after the snapshot took its generation
+    for r in readings(*args, **kwargs):
+      if r.scope == ("sim", "a"):
+        second.set(2)
+      yield r
+
+  def pushed():
+    return [point[:3] for point in pusher.buffer if point[0].startswith("sim_")]
+
+  registry.readings = racing
+  pusher.collect()
+  registry.readings = readings
+  assert pushed() == [("sim_a", {}, 1), ("sim_b", {}, 2)], pushed()
+  pusher.collect()
+  assert len(pushed()) == 2, pushed()
+  first.set(2)
+  pusher.collect()
+  assert pushed()[2:] == [("sim_a", {}, 2)], pushed()
+  await pusher.stop()
+  await server.stop()
+
+
+def main():
+  for scenario in (accepted, server_down, rejected, remote_write, written_mid_snapshot):
+    asyncio.run(scenario())
+    print(f"{scenario.__name__}: ok")
+
+
+if __name__ == "__main__":
+  main()
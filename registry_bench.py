@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Multi-threaded stress benchmark of the registry implementations. Writer
+threads hammer gauges and counters while a reader thread takes snapshots,
+the way scrapes and MQTT publishing do while bleak delivers callbacks.
+
+  python registry_bench.py [writers] [seconds]
+"""
+import sys
+import time
+import threading
+
+from obs.data import ObsKind
+from obs.observer import Observer
+from obs.registry import ThreadsafeRegistry, ConcurrentRegistry
+
+
+METRICS_PER_WRITER = 50
+
+
+def run(registry_class, writers, duration_s):
+  reg = registry_class()
+  obs = Observer(reg).scoped("bench")
+  stop = threading.Event()
+  writes = [0] * writers
+  snapshots = [0]
+  torn = [0]
+
+  def writer(i):
+    scoped = obs.scoped(f"dev{i}")
+    gauges = [scoped.gauge(f"g{j}") for j in range(METRICS_PER_WRITER)]
+    ctr = scoped.counter("n")
+    n = 0
+    while not stop.is_set():
+      for g in gauges:
+        g.set(n, n + 1)
+      ctr.inc()
+      n += 1
+    writes[i] = n * (METRICS_PER_WRITER + 1)
+
+  def reader():
+    while not stop.is_set():
+      for r in reg.snapshot():
+        # Every gauge is written with at == value + 1
+        if r.kind == ObsKind.GAUGE and r.at and r.at != r.value + 1:
+          torn[0] += 1
+      snapshots[0] += 1
+
+  threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+  threads.append(threading.Thread(target=reader))
+
+  for t in threads:
+    t.start()
+  time.sleep(duration_s)
+  stop.set()
+  for t in threads:
+    t.join()
+
+  return sum(writes) / duration_s, snapshots[0] / duration_s, torn[0]
+
+
+if __name__ == "__main__":
+  writers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+  duration_s = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+  print(f"{writers} writers, 1 reader, {duration_s}s each")
+  for klass in (ThreadsafeRegistry, ConcurrentRegistry):
+    w, s, torn = run(klass, writers, duration_s)
+    print(f"{klass.__name__:>20}: {w:12,.0f} writes/s {s:8,.1f} snapshots/s {torn} torn")
@@ -0,0 +1,71 @@
+import struct
+
+try:
+  import snappy
+except ImportError:
+  snappy = None
+
+
+# Hand-rolled protobuf for the Prometheus remote-write WriteRequest:
+#
+#   WriteRequest { repeated TimeSeries timeseries = 1; }
+#   TimeSeries   { repeated Label labels = 1; repeated Sample samples = 2; }
+#   Label        { string name = 1; string value = 2; }
+#   Sample       { double value = 1; int64 timestamp = 2; }
+
+def _varint(n):
+  out = bytearray()
+  while True:
+    b = n & 0x7F
+    n >>= 7
+    if n:
+      out.append(b | 0x80)
+    else:
+      out.append(b)
+      return bytes(out)
+
+
+def _field(num, payload):
+  """A length-delimited field"""
+  return _varint((num << 3) | 2) + _varint(len(payload)) + payload
+
+
+def encode_sample(value, timestamp_ms):
+  return b"\x09" + struct.pack("<d", value) + b"\x10" + _varint(timestamp_ms & 0xFFFFFFFFFFFFFFFF)
+
+
+def encode_timeseries(labels, samples):
+  """`labels` is [(name, value)] including __name__, `samples` is [(value, ts_ms)]"""
+  parts = [
+    _field(1, _field(1, name.encode()) + _field(2, str(value).encode()))
+    for name, value in sorted(labels)
+  ]
+  parts.extend(_field(2, encode_sample(v, ts)) for v, ts in samples)
+  return b"".join(parts)
+
+
+def encode_write_request(series):
+  return b"".join(_field(1, ts) for ts in series)
+
+
+def snappy_block(data):
+  """
+  Snappy block format, as remote-write requires. Without python-snappy
+  this is the uncompressed (all literal) encoding, which any decoder
+  accepts.
+  """
+  if snappy:
+    return snappy.compress(data)
+
+  out = [_varint(len(data))]
+  for i in range(0, len(data), 65536):
+    chunk = data[i:i + 65536]
+    n = len(chunk) - 1
+    if n < 60:
+      out.append(bytes((n << 2,)))
+    elif n < 0x100:
+      out.append(bytes((60 << 2, n)))
+    else:
+      out.append(bytes((61 << 2,)) + struct.pack("<H", n))
+    out.append(chunk)
+  return b"".join(out)
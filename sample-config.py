@@ -7,14 +7,44 @@ SampleConfig = {
     "FB:23:8C:6C:8C:B0": MokoH4Decoder("h4_8cb0"),
     "D3:EF:7F:F0:46:3D": MokoH4Decoder("h4_463d"),
     "AA:BB:CC:DD:EE:FF": VTDecoder(
-      "solar", SolarCharger, "00000000000000000000000000000000"
+      "solar", SolarCharger, "00000000000000000000000000000000",
+      publish_interval_s=10,
     ),
     "AA:BB:CC:DD:EE:00": VTDecoder(
       "bms", BatteryMonitor, "11111111111111111111111111111111"
     ),
   },
+  # Scan passively, letting the controller drop adverts no decoder can use.
+  # Falls back to active scanning if BlueZ can't, or nothing arrives in time
+  "ble_passive_scan": True,
+  "ble_passive_grace_s": 120,
+  # Scan in windows just long enough to hear every device once per publish
+  # interval, idling the radio in between (optional)
+  "ble_duty_cycle": False,
+  # Values computed from readings, {device: {field: expression}}. A bare name
+  # is a field of the same device, `device.field` one of another device;
+  # "site" here isn't a device, just a scope to publish under (optional)
+  "derived": {
+    "site": {
+      "temperature_avg_c": "(h4_8cb0.temperature_c + h4_463d.temperature_c) / 2",
+      "dew_point_max_c": "max(h4_8cb0.dew_point_c, h4_463d.dew_point_c)",
+    },
+  },
+  # Restart the scanner when nothing at all is heard for far longer than
+  # the devices' usual advert intervals. With ble_adapter_reset, the adapter
+  # is also power cycled once per stall if restarting doesn't help (optional;
+  # True runs bluetoothctl power off/on)
+  "ble_watchdog": True,
+  "ble_adapter_reset": [["bluetoothctl", "power", "off"], ["bluetoothctl", "power", "on"]],
   # If a device broadcasts faster than this, the reading is discarded
   "ble_throttle_s": 5,
+  # Aggregate every advert between publishes, throttled or not, into these
+  # per-field stats, published with an `agg` label. True means count, min,
+  # max, mean and last; variance and stddev can be added (optional)
+  "ble_aggregate": ["count", "min", "max", "mean", "last"],
+  # Readings older than this are treated as absent, and freed unless
+  # metric_evict is False (optional)
+  "metric_ttl_s": 600,
   # The prefix on the MQTT broadcast to apply to all messages
   "mqtt_prefix": "room/sensor/",
   # MQTT Broker address
@@ -25,6 +55,49 @@ SampleConfig = {
   "mqtt_pass": "hunter2",
   # Publish a batch of MQTT messages on this interval
   "mqtt_pub_interval_s": 30,
+  # Reload devices when config.py changes, checked on this interval (optional).
+  # SIGHUP always reloads. Other settings need a restart.
+  "config_watch_s": 5,
+  # Retain readings on the broker, so subscribers get them as they connect
+  "mqtt_retain": True,
+  # Announce sensors to Home Assistant with MQTT discovery under this prefix,
+  # remembering what was announced in hass_cache_path (optional)
+  "hass_discovery_prefix": "homeassistant",
+  "hass_cache_path": "./hass-discovery.json",
+  # Publish to several brokers at once, each with its own queue and
+  # connection. Keys left out default to the mqtt_* settings (optional)
+  # "mqtt_sinks": [
+  #   {"name": "local", "broker": "localhost", "qos": 0},
+  #   {"name": "site", "broker": "mqtt.site.example.com", "qos": 1,
+  #    "topic_prefix": "sites/home", "codec": "msgpack", "bulk": True,
+  #    "retain": False, "hass_prefix": None},
+  # ],
+  # Broker budget shared by all devices; the highest priority goes first (optional)
+  "mqtt_max_msgs_per_s": 5,
+  "mqtt_max_bytes_per_s": 2048,
+  # Payload encoding: json, msgpack, cbor or schema (fixed-schema binary)
+  "mqtt_codec": "json",
+  # Pack every changed group into one compressed message on <prefix>/$bulk
+  "mqtt_bulk": False,
+  # Messages that could not be published overflow to here (optional)
+  "mqtt_spool_dir": "./spool",
+  # How many spooled messages per second to send once the broker is back
+  "mqtt_drain_rate_per_s": 10,
+  # Push readings to InfluxDB (line protocol) or a Prometheus remote-write
+  # endpoint as well (optional)
+  "push_url": None,
+  "push_format": "influx",
+  "push_headers": {},
+  "push_interval_s": 30,
+  # `main.py split` scans in one process and exports from another; this is
+  # how many decoded readings the shared memory ring between them holds
+  "split_ring_records": 4096,
+  # Save counters, readings and publish state here, and resume from it at
+  # startup (optional)
+  "snapshot_path": "./ble2mqtt.snap",
+  "snapshot_interval_s": 60,
+  # Keep an on-disk history of readings here, served on /history (optional)
+  "history_dir": "./history",
 }
 
 CurrentConfig = SampleConfig
@@ -0,0 +1,62 @@
+from bleak import BleakScanner
+
+try:
+  from bleak.assigned_numbers import AdvertisementDataType
+  from bleak.backends.bluezdbus.advertisement_monitor import OrPattern
+  from bleak.backends.bluezdbus.scanner import BlueZScannerArgs
+except ImportError:
+  # Not on BlueZ (or an old bleak): only active scanning is available
+  OrPattern = None
+
+
+def scan_filters(decoders):
+  """
+  The advertisement patterns and service UUIDs the configured decoders
+  care about. UUIDs are only returned when every decoder has one, since
+  BlueZ drops every advert that matches none of them.
+  """
+  decoders = list(decoders)
+  patterns = sorted({p for d in decoders for p in d.scan_patterns()})
+
+  uuids = set()
+  for d in decoders:
+    if not d.service_uuids:
+      uuids = set()
+      break
+    uuids.update(d.service_uuids)
+
+  return patterns, sorted(uuids)
+
+
+def passive_scanner(callback, patterns):
+  return BleakScanner(
+    detection_callback=callback,
+    scanning_mode="passive",
+    bluez=BlueZScannerArgs(or_patterns=[
+      OrPattern(offset, AdvertisementDataType(ad_type), data)
+      for ad_type, offset, data in patterns
+    ]),
+  )
+
+
+async def start_scanner(callback, decoders, passive=True, log=None):
+  """
+  Start a scanner which only wakes Python for adverts the decoders can use.
+  Passive scanning with controller-side pattern matching is tried first;
+  if BlueZ can't do that, this falls back to active scanning, filtered by
+  service UUID where possible. Returns (scanner, mode).
+  """
+  patterns, uuids = scan_filters(decoders)
+
+  if passive and OrPattern and patterns:
+    try:
+      scanner = passive_scanner(callback, patterns)
+      await scanner.start()
+      return scanner, "passive"
+    except Exception as e:
+      if log:
+        log.err("Passive scanning unavailable, falling back to active: {!r}", e)
+
+  scanner = BleakScanner(detection_callback=callback, service_uuids=uuids or None)
+  await scanner.start()
+  return scanner, "active"
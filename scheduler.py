@@ -0,0 +1,184 @@
+import time
+import zlib
+import socket
+import asyncio
+
+
+class TokenBucket:
+  """Refills `rate` tokens per second, holding at most `burst`. No rate means no limit"""
+
+  def __init__(self, rate=None, burst=None):
+    self.rate = rate
+    self.burst = burst if burst is not None else rate
+    self.tokens = self.burst
+    self.updated_at = time.monotonic()
+
+  def refill(self):
+    now = time.monotonic()
+    if self.rate:
+      self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+    self.updated_at = now
+
+  def available(self):
+    if not self.rate:
+      return float("inf")
+    self.refill()
+    return self.tokens
+
+  def take(self, amount):
+    """Consume `amount` tokens, going into debt if there are not enough"""
+    if self.rate:
+      self.refill()
+      self.tokens -= amount
+
+  def wait_s(self, amount):
+    """Seconds until `amount` tokens are available"""
+    missing = amount - self.available()
+    return max(0.0, missing / self.rate) if self.rate else 0.0
+
+
+def jitter_offset(node, name, interval_s):
+  """A stable offset into the interval for `name` on this `node`"""
+  h = zlib.crc32(f"{node}/{name}".encode()) / 0x100000000
+  return h * interval_s
+
+
+class ScheduledGroup:
+  __slots__ = ("name", "interval_s", "priority", "offset_s", "next_at", "est_bytes")
+
+  def __init__(self, name, interval_s, priority, offset_s):
+    self.name = name
+    self.interval_s = interval_s
+    self.priority = priority
+    self.offset_s = offset_s
+    self.est_bytes = 0
+    self.next_at = self.slot_after(time.time())
+
+  def slot_after(self, now):
+    """The first publish slot of this group strictly after `now`"""
+    n = (now - self.offset_s) // self.interval_s + 1
+    return n * self.interval_s + self.offset_s
+
+
+class PublishScheduler:
+  """
+  Publishes each device group on its own interval, at a slot offset by a
+  deterministic per-gateway jitter so that neither the devices of one
+  gateway nor several gateways booted together publish in lockstep.
+
+  A global message and byte budget is enforced with token buckets. When a
+  slot comes due without budget, groups are admitted by priority (highest
+  first) and the rest are deferred until tokens refill. A group needs at
+  most a full byte burst, so one bigger than that still goes out once the
+  bucket is full, leaving a debt, rather than holding up everything below
+  it forever. Groups that don't belong to a scheduled device are published
+  on `default_interval_s`. `before_publish(names)` is called with the
+  groups about to be published.
+  """
+
+  def __init__(self, publisher, default_interval_s, msg_rate=None, byte_rate=None,
+      burst_s=5, node=None, observer=None, before_publish=None):
+    self.publisher = publisher
+    self.before_publish = before_publish
+    self.node = node or socket.gethostname()
+    self.msgs = TokenBucket(msg_rate, msg_rate * burst_s if msg_rate else None)
+    self.bytes = TokenBucket(byte_rate, byte_rate * burst_s if byte_rate else None)
+    self.groups = {}
+    self.observer = observer
+    self.log = None
+
+    if observer:
+      self.log = observer.log("publish")
+      observer.gauge("tokens_messages", "Message budget left").set_fn(
+        lambda: round(min(self.msgs.available(), 1e12), 2)
+      )
+      observer.gauge("tokens_bytes", "Byte budget left").set_fn(
+        lambda: round(min(self.bytes.available(), 1e12), 2)
+      )
+      self.deferred = observer.counter("deferred", "Publish slots deferred for lack of budget")
+      self.lag = observer.gauge("lag_s", "How late the last publish of a group was")
+
+    self.add(None, default_interval_s)
+
+  def add(self, name, interval_s, priority=0):
+    self.groups[name] = ScheduledGroup(
+      name, interval_s, priority, jitter_offset(self.node, name, interval_s)
+    )
+
+  def remove(self, name):
+    self.groups.pop(name, None)
+
+  def owner(self, group):
+    """The scheduled name responsible for a registry group"""
+    return group[0] if group and group[0] in self.groups else None
+
+  def cost(self, group):
+    """Bytes `group` needs available, which is never more than the bucket holds"""
+    if self.bytes.rate:
+      return min(group.est_bytes, self.bytes.burst)
+    return group.est_bytes
+
+  def due(self, now):
+    due = [g for g in self.groups.values() if g.next_at <= now]
+    due.sort(key=lambda g: (-g.priority, g.next_at))
+    return due
+
+  async def tick(self):
+    now = time.time()
+    admitted = []
+    msgs_left = self.msgs.available()
+    bytes_left = self.bytes.available()
+
+    for g in self.due(now):
+      cost = self.cost(g)
+      if msgs_left < 1 or bytes_left < cost:
+        if self.observer:
+          self.deferred.labeled("group", str(g.name)).inc()
+        # Lower priorities don't get to jump the queue
+        break
+
+      msgs_left -= 1
+      bytes_left -= cost
+      admitted.append(g)
+
+    if not admitted:
+      return
+
+    names = {g.name for g in admitted}
+    if self.before_publish:
+      self.before_publish(names)
+    try:
+      rendered = await self.publisher.publish(
+        include=lambda group: self.owner(group) in names
+      )
+    except Exception as e:
+      # A bad render shouldn't stop publishing for good; these groups come
+      # due again on their next slot
+      if self.log:
+        self.log.err("Publishing {} failed: {!r}", sorted(map(str, names)), e)
+      for g in admitted:
+        g.next_at = g.slot_after(now)
+      return
+
+    sent_bytes = sum(len(payload) for _, payload, _ in rendered)
+    self.msgs.take(len(rendered))
+    self.bytes.take(sent_bytes)
+
+    for g in admitted:
+      g.est_bytes = sent_bytes / len(admitted)
+      if self.observer:
+        self.lag.labeled("group", str(g.name)).set(round(now - g.next_at, 3))
+      g.next_at = g.slot_after(now)
+
+  def next_wake_at(self):
+    now = time.time()
+    due = self.due(now)
+    if due:
+      # The first in line is waiting on the budget
+      return now + max(0.1, self.msgs.wait_s(1), self.bytes.wait_s(self.cost(due[0])))
+    return min(g.next_at for g in self.groups.values())
+
+  async def run(self):
+    while True:
+      await self.tick()
+      await asyncio.sleep(max(0.0, self.next_wake_at() - time.time()))
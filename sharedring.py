@@ -0,0 +1,210 @@
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+
+MAGIC = 0xB1E2A001
+
+# magic, record size, capacity, write seq
+HEADER = struct.Struct("<IIQQ")
+HEADER_BYTES = 64
+SEQ = struct.Struct("<Q")
+
+# seq, at, value, kind, flags, scope, labels, text
+RECORD = struct.Struct("<QddBB96s80s54s")
+
+# Record kinds
+READING = 0
+READING_TEXT = 1
+GAUGE = 2
+# How much a counter grew since it was last written, not its value
+COUNTER = 3
+STATE = 4
+# One record per cumulative bucket, its bound in the text, then one of the sum
+HISTOGRAM = 5
+
+# Record flags
+THROTTLED = 1
+END = 2
+# Set by the reader on the first record after ones it lost to an overrun
+LOST = 4
+
+
+def _text(raw):
+  return raw.rstrip(b"\0").decode(errors="replace")
+
+
+class SharedRing:
+  """
+  A single-producer, single-consumer ring of fixed-size records in shared
+  memory. There are no locks: the writer fills a slot with its sequence
+  number zeroed, then stamps the sequence number, then advances the write
+  sequence in the header. A reader that finds a slot's sequence number is
+  not the one it expected knows the writer lapped it.
+  """
+
+  def __init__(self, shm, create=False, capacity=0):
+    self.shm = shm
+    self.buf = shm.buf
+    if create:
+      HEADER.pack_into(self.buf, 0, MAGIC, RECORD.size, capacity, 0)
+
+    magic, size, self.capacity, _ = HEADER.unpack_from(self.buf, 0)
+    if magic != MAGIC or size != RECORD.size:
+      raise ValueError(f"{shm.name} is not a ring of {RECORD.size} byte records")
+
+  @classmethod
+  def create(cls, capacity=4096):
+    shm = shared_memory.SharedMemory(create=True, size=HEADER_BYTES + capacity * RECORD.size)
+    return cls(shm, create=True, capacity=capacity)
+
+  @classmethod
+  def attach(cls, name):
+    return cls(shared_memory.SharedMemory(name=name))
+
+  @property
+  def name(self):
+    return self.shm.name
+
+  @property
+  def write_seq(self):
+    return SEQ.unpack_from(self.buf, 16)[0]
+
+  def offset(self, seq):
+    return HEADER_BYTES + (seq % self.capacity) * RECORD.size
+
+  def close(self, unlink=False):
+    self.buf = None
+    self.shm.close()
+    if unlink:
+      self.shm.unlink()
+
+
+class RingWriter:
+  """
+  The producing side; overwrites the oldest records when the reader falls
+  behind. It is the ring's single producer: callers on other threads are
+  serialised, and an advert's records are always written together.
+  """
+
+  def __init__(self, ring, observer=None):
+    self.ring = ring
+    self.seq = ring.write_seq
+    self.lock = threading.RLock()
+    self.writes_ctr = observer.counter("ring_writes", "Records written to the ring") \
+      if observer else None
+    self.unhandled_ctr = observer.counter(
+      "ring_unhandled", "Readings of a type the ring can't carry, and dropped"
+    ) if observer else None
+
+  def put(self, kind, scope, value=0.0, at=0.0, labels="", text="", flags=0):
+    ring = self.ring
+    with self.lock:
+      seq = self.seq + 1
+      off = ring.offset(seq)
+      RECORD.pack_into(
+        ring.buf, off, 0, at, value, kind, flags,
+        scope.encode()[:96], labels.encode()[:80], text.encode()[:54],
+      )
+      SEQ.pack_into(ring.buf, off, seq)
+      SEQ.pack_into(ring.buf, 16, seq)
+      self.seq = seq
+    if self.writes_ctr:
+      self.writes_ctr.inc()
+
+  def write_readings(self, devname, readings, throttled, at):
+    """
+    One advert's readings; the reader gets them back as one dict. Takes
+    what update_metrics_from_readings does: numbers, enums and strings
+    (cut to the record's 54 bytes of text).
+    """
+    items = []
+    for key, val in readings.items():
+      if isinstance(val, (int, float)):
+        items.append((READING, f"{devname}/{key}", float(val), ""))
+      elif isinstance(val, str):
+        items.append((READING_TEXT, f"{devname}/{key}", 0.0, val))
+      elif hasattr(val, "name"):
+        items.append((READING_TEXT, f"{devname}/{key}", 0.0, val.name.lower()))
+      elif self.unhandled_ctr:
+        self.unhandled_ctr.inc()
+
+    flags = THROTTLED if throttled else 0
+    with self.lock:
+      for i, (kind, scope, value, text) in enumerate(items):
+        end = END if i == len(items) - 1 else 0
+        self.put(kind, scope, value, at, text=text, flags=flags | end)
+
+  def write_metric(self, kind, scope, labels, value, at):
+    labels = ",".join(f"{k}={v}" for k, v in labels)
+    if kind == HISTOGRAM:
+      with self.lock:
+        for le, count in value.buckets():
+          self.put(HISTOGRAM, scope, float(count), at, labels, text=le)
+        self.put(HISTOGRAM, scope, float(value.sum), at, labels, text="sum")
+    elif isinstance(value, str):
+      self.put(STATE, scope, 0.0, at, labels, text=value)
+    elif value is not None:
+      self.put(kind, scope, float(value), at, labels)
+
+
+class RingReader:
+  """
+  The consuming side. Records the writer overwrote before they were read
+  are counted as overruns, and the next record read is flagged LOST;
+  `lag` is how many records are waiting.
+  """
+
+  def __init__(self, ring, observer):
+    self.ring = ring
+    self.seq = ring.write_seq
+    self.last_at = 0
+
+    self.records_ctr = observer.counter("ring_records", "Records read from the ring")
+    self.overruns_ctr = observer.counter(
+      "ring_overruns", "Records overwritten before they could be read"
+    )
+    self.lag = observer.gauge("ring_lag", "Records written but not yet read")
+    self.lag_s = observer.gauge("ring_lag_s", "Age of the newest reading when it was read")
+
+  def read(self, max_records=None):
+    """Yields (kind, flags, at, scope, labels, value) of the unread records"""
+    ring = self.ring
+    head = ring.write_seq
+    lost = head - self.seq > ring.capacity
+    if lost:
+      self.overruns_ctr.inc(head - self.seq - ring.capacity)
+      self.seq = head - ring.capacity
+
+    end = head if max_records is None else min(head, self.seq + max_records)
+    count = 0
+    while self.seq < end:
+      seq = self.seq + 1
+      off = ring.offset(seq)
+      rec = RECORD.unpack_from(ring.buf, off)
+      # Both stamps must match, or the writer was in this slot meanwhile
+      if rec[0] != seq or SEQ.unpack_from(ring.buf, off)[0] != seq:
+        self.overruns_ctr.inc()
+        self.seq = seq
+        lost = True
+        continue
+
+      self.seq = seq
+      count += 1
+      _, at, value, kind, flags, scope, labels, text = rec
+      if lost:
+        flags |= LOST
+        lost = False
+      if kind in (READING_TEXT, STATE):
+        value = _text(text)
+      elif kind == HISTOGRAM:
+        value = (_text(text), value)
+      if kind <= READING_TEXT:
+        self.last_at = at
+      yield kind, flags, at, _text(scope), _text(labels), value
+
+    if count:
+      self.records_ctr.inc(count)
+      self.lag_s.set(round(max(0.0, time.time() - self.last_at), 3))
+    self.lag.set(ring.write_seq - self.seq)
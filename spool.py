@@ -0,0 +1,297 @@
+import os
+import time
+import struct
+from collections import OrderedDict, deque, namedtuple
+
+
+SpoolEntry = namedtuple("SpoolEntry", ("seq", "at", "topic", "payload"))
+
+# Entry header on disk: seq (u64), at (f64), topic length (u16), payload length (u32)
+DISK_HDR = struct.Struct("<QdHI")
+
+
+def entry_size(entry):
+  return DISK_HDR.size + len(entry.topic) + len(entry.payload)
+
+
+class SpoolSegment:
+  """A file of spilled entries, written once and read back whole"""
+
+  def __init__(self, path, count=0, nbytes=0):
+    self.path = path
+    self.count = count
+    self.nbytes = nbytes
+    self.first_at = None
+    self.file = None
+
+  def append(self, entry):
+    if self.file is None:
+      self.file = open(self.path, "ab")
+    if self.first_at is None:
+      self.first_at = entry.at
+    topic = entry.topic.encode()
+    self.file.write(DISK_HDR.pack(entry.seq, entry.at, len(topic), len(entry.payload)))
+    self.file.write(topic)
+    self.file.write(entry.payload)
+    self.count += 1
+    self.nbytes += entry_size(entry)
+
+  def close(self):
+    if self.file:
+      self.file.close()
+      self.file = None
+
+  def load(self):
+    self.close()
+    with open(self.path, "rb") as f:
+      data = f.read()
+
+    entries = []
+    pos = 0
+    while pos + DISK_HDR.size <= len(data):
+      seq, at, tlen, plen = DISK_HDR.unpack_from(data, pos)
+      pos += DISK_HDR.size
+      if pos + tlen + plen > len(data):
+        # Torn write at the tail; whatever is complete is kept
+        break
+      topic = data[pos:pos + tlen].decode()
+      pos += tlen
+      entries.append(SpoolEntry(seq, at, topic, data[pos:pos + plen]))
+      pos += plen
+
+    return entries
+
+  def remove(self):
+    self.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+class Spool:
+  """
+  Bounded store-and-forward queue for messages that could not be published.
+
+  State-like messages (the whole current state of a topic) are kept one per
+  topic, so a newer value supersedes whatever was queued before it; beyond
+  `mem_entries` topics, the oldest spill over into segment files. Other
+  messages are appended to segment files under `spool_dir`, or kept in a
+  memory ring of `mem_entries` without one. Once the disk exceeds
+  `max_disk_bytes`, the oldest segment is dropped.
+
+  `sync()` writes the queued state to `state.dat` and flushes the open
+  segment, so the spool survives a restart or a crash. Segment files are
+  only removed once everything in them was sent.
+  """
+
+  def __init__(self, spool_dir=None, mem_entries=1000, max_disk_bytes=16 << 20,
+      segment_bytes=1 << 20):
+    self.spool_dir = spool_dir
+    self.mem_entries = mem_entries
+    self.max_disk_bytes = max_disk_bytes
+    self.segment_bytes = segment_bytes
+
+    self.seq = 0
+    self.state = OrderedDict()
+    self.ring = deque()
+    self.mem_bytes = 0
+
+    self.disk_head = deque()
+    self.disk_head_bytes = 0
+    self.head_seg = None
+    self.segments = deque()
+    self.state_dirty = False
+    self.dropped = 0
+
+    if spool_dir:
+      os.makedirs(spool_dir, exist_ok=True)
+      self.state_path = os.path.join(spool_dir, "state.dat")
+      if os.path.exists(self.state_path):
+        for e in SpoolSegment(self.state_path).load():
+          self.state[e.topic] = e
+          self.mem_bytes += entry_size(e)
+          self.seq = max(self.seq, e.seq)
+
+      for fname in sorted(os.listdir(spool_dir)):
+        if fname.endswith(".spool"):
+          seg = SpoolSegment(os.path.join(spool_dir, fname))
+          entries = seg.load()
+          seg.count = len(entries)
+          seg.nbytes = sum(entry_size(e) for e in entries)
+          if entries:
+            seg.first_at = entries[0].at
+            self.seq = max(self.seq, entries[-1].seq)
+          self.segments.append(seg)
+
+  def _next_seq(self):
+    self.seq = max(time.time_ns(), self.seq + 1)
+    return self.seq
+
+  def put(self, topic, payload, at=None, state=True):
+    """Queue `payload` for `topic`. `at` is when the payload was produced"""
+    if isinstance(payload, str):
+      payload = payload.encode()
+
+    entry = SpoolEntry(self._next_seq(), at or time.time(), topic, payload)
+
+    if state:
+      self.supersede(topic)
+      self.state[topic] = entry
+      self.mem_bytes += entry_size(entry)
+      self.state_dirty = True
+      if len(self.state) > self.mem_entries:
+        _, oldest = self.state.popitem(last=False)
+        self.mem_bytes -= entry_size(oldest)
+        self._spill(oldest)
+    elif self.spool_dir:
+      self._spill(entry)
+    else:
+      self.ring.append(entry)
+      self.mem_bytes += entry_size(entry)
+      if len(self.ring) > self.mem_entries:
+        oldest = self.ring.popleft()
+        self.mem_bytes -= entry_size(oldest)
+        self._spill(oldest)
+
+  def supersede(self, topic):
+    """Forget any queued state for `topic`, as a newer one has been sent"""
+    old = self.state.pop(topic, None)
+    if old:
+      self.mem_bytes -= entry_size(old)
+      self.state_dirty = True
+
+  def _spill(self, entry):
+    if not self.spool_dir:
+      self.dropped += 1
+      return
+
+    seg = self.segments[-1] if self.segments else None
+    if seg is None or seg.file is None or seg.nbytes >= self.segment_bytes:
+      if seg:
+        seg.close()
+      seg = SpoolSegment(os.path.join(self.spool_dir, f"{entry.seq:020d}.spool"))
+      self.segments.append(seg)
+    seg.append(entry)
+
+    while self.disk_bytes() > self.max_disk_bytes and len(self.segments) > 1:
+      old = self.segments.popleft()
+      self.dropped += old.count
+      old.remove()
+
+  def _disk_peek(self):
+    # The segment stays on disk until all of it was sent
+    while not self.disk_head and self.segments:
+      if self.head_seg:
+        self.head_seg.remove()
+      self.head_seg = self.segments.popleft()
+      self.disk_head.extend(self.head_seg.load())
+      self.disk_head_bytes = sum(entry_size(e) for e in self.disk_head)
+    return self.disk_head[0] if self.disk_head else None
+
+  def peek(self):
+    """The oldest queued entry, or None. Nothing is removed until `pop`"""
+    candidates = []
+    if self.state:
+      candidates.append(next(iter(self.state.values())))
+    queued = self._disk_peek() or (self.ring[0] if self.ring else None)
+    if queued:
+      candidates.append(queued)
+    return min(candidates, key=lambda e: e.seq) if candidates else None
+
+  def pop(self, entry):
+    """Remove `entry`, previously returned by `peek`, once it was sent"""
+    if self.state.get(entry.topic) is entry:
+      self.supersede(entry.topic)
+    elif self.disk_head and self.disk_head[0] is entry:
+      self.disk_head.popleft()
+      self.disk_head_bytes -= entry_size(entry)
+      if not self.disk_head:
+        self.head_seg.remove()
+        self.head_seg = None
+    elif self.ring and self.ring[0] is entry:
+      self.ring.popleft()
+      self.mem_bytes -= entry_size(entry)
+
+  def sync(self):
+    """Write the queued state and buffered segment data to disk"""
+    if not self.spool_dir:
+      return
+    if self.segments and self.segments[-1].file:
+      self.segments[-1].file.flush()
+    if not self.state_dirty:
+      return
+
+    self.state_dirty = False
+    if not self.state:
+      SpoolSegment(self.state_path).remove()
+      return
+    # Replaced whole, so a crash mid-write leaves the previous state
+    seg = SpoolSegment(f"{self.state_path}.tmp")
+    seg.remove()
+    for e in self.state.values():
+      seg.append(e)
+    seg.close()
+    os.replace(seg.path, self.state_path)
+
+  def close(self):
+    """Write out everything still queued, so a restart can send it"""
+    if not self.spool_dir:
+      return
+
+    for seg in self.segments:
+      seg.close()
+
+    # The disk head's file still holds what was already sent from it.
+    # Segments are named after their first entry, so the rest sorts first
+    if self.head_seg:
+      if self.disk_head:
+        path = os.path.join(self.spool_dir, f"{self.disk_head[0].seq:020d}.spool")
+        seg = SpoolSegment(f"{path}.tmp")
+        seg.remove()
+        for e in self.disk_head:
+          seg.append(e)
+        seg.close()
+        self.head_seg.remove()
+        os.replace(seg.path, path)
+      else:
+        self.head_seg.remove()
+      self.head_seg = None
+
+    self.sync()
+    self.disk_head.clear()
+    self.state.clear()
+    self.ring.clear()
+    self.mem_bytes = 0
+    self.disk_head_bytes = 0
+
+  def disk_bytes(self):
+    return sum(s.nbytes for s in self.segments)
+
+  def depth(self):
+    return len(self.state) + len(self.ring) + len(self.disk_head) + \
+      sum(s.count for s in self.segments)
+
+  def nbytes(self):
+    return self.mem_bytes + self.disk_head_bytes + self.disk_bytes()
+
+  def oldest_age_s(self):
+    """Without loading anything from disk, so reading it has no side effects"""
+    heads = [q[0].at for q in (self.ring, self.disk_head) if q]
+    if self.state:
+      heads.append(next(iter(self.state.values())).at)
+    if self.segments and self.segments[0].first_at:
+      heads.append(self.segments[0].first_at)
+    return round(time.time() - min(heads), 3) if heads else 0
+
+  def __len__(self):
+    return self.depth()
+
+  def observe(self, observer):
+    """Export spool depth, size and age on `observer`"""
+    observer.gauge("spool_depth", "Messages waiting to be published").set_fn(self.depth)
+    observer.gauge("spool_bytes", "Size of messages waiting to be published").set_fn(self.nbytes)
+    observer.gauge(
+      "spool_oldest_age_s", "Age of the oldest message waiting to be published"
+    ).set_fn(self.oldest_age_s)
+    observer.gauge(
+      "spool_dropped", "Messages dropped because the spool was full"
+    ).set_fn(lambda: self.dropped)
@@ -0,0 +1,214 @@
+import json
+import asyncio
+from collections import OrderedDict
+from aiohttp import web, WSMsgType
+
+from obs.data import to_scope, scope_startswith
+from obs.metric import HistSample
+from obs.observer import NullObserver
+
+
+class Change:
+  """One changed metric, serialised once for every client that wants it"""
+
+  __slots__ = ("key", "scope", "text", "sse")
+
+  def __init__(self, key, value, at):
+    self.key = key
+    self.scope = key.scope
+    if isinstance(value, HistSample):
+      value = value.as_dict()
+    self.text = json.dumps({
+      "path": "/".join(key.scope),
+      "labels": dict(key.labels),
+      "value": value,
+      "at": at,
+    }, default=str)
+    self.sse = f"data: {self.text}\n\n".encode()
+
+
+class StreamClient:
+  """
+  A subscriber's pending changes, coalesced by key so a reading that
+  changes faster than `max_rate` only sends its latest value. At most
+  `max_pending` keys are held; beyond that the oldest are dropped.
+  """
+
+  def __init__(self, prefix, max_rate, max_pending):
+    self.prefix = prefix
+    self.min_gap_s = 1.0 / max_rate if max_rate else 0.0
+    self.max_pending = max_pending
+    self.pending = OrderedDict()
+    self.dropped = 0
+    self.wake = asyncio.Event()
+
+  def offer(self, change):
+    if not scope_startswith(change.scope, self.prefix):
+      return 0
+    self.pending[change.key] = change
+    self.pending.move_to_end(change.key)
+    dropped = 0
+    while len(self.pending) > self.max_pending:
+      self.pending.popitem(last=False)
+      dropped += 1
+    self.dropped += dropped
+    self.wake.set()
+    return dropped
+
+  def take(self):
+    pending, self.pending = self.pending, OrderedDict()
+    self.wake.clear()
+    return pending.values()
+
+
+class ReadingStream:
+  """
+  Pushes registry changes to subscribers of /stream, over Server-Sent
+  Events or a WebSocket. While anyone is subscribed, one task looks for
+  metrics whose generation stamp moved every `interval_s`, serialises each
+  change under some client's prefix once, and offers it to those clients;
+  each client then sends at its own pace.
+
+  Samples are taken as they are. Value functions are not run, since some
+  reset on read and belong to the exporters that evaluate them; their
+  changes show up once one of those has.
+
+  Query parameters: `prefix` (a/b/c), `max_rate` (sends per second) and
+  `max_pending` (changes buffered before the oldest are dropped).
+  """
+
+  def __init__(self, registry, interval_s=0.25, max_pending=1000, observer=None):
+    self.registry = registry
+    self.interval_s = interval_s
+    self.max_pending = max_pending
+    self.clients = set()
+    self.last = {}
+    self.poller = None
+
+    observer = observer or NullObserver()
+    observer.gauge("clients", "Subscribers of /stream").set_fn(lambda: len(self.clients))
+    self.changes_ctr = observer.counter("changes", "Changed readings serialised for /stream")
+    self.sent_ctr = observer.counter("sent", "Changes sent to /stream subscribers")
+    self.dropped_ctr = observer.counter(
+      "dropped", "Changes dropped because a subscriber fell behind"
+    )
+
+  def samples(self, prefixes):
+    """(key, value, at, generation) of the set metrics under any of `prefixes`"""
+    for key, metric in self.registry.metrics.items():
+      value, at, gen = metric.sample
+      if value is not None and any(scope_startswith(key.scope, p) for p in prefixes):
+        yield key, value, at, gen
+
+  def poll(self):
+    changes = []
+    last = self.last
+    for key, value, at, gen in self.samples({c.prefix for c in self.clients}):
+      if last.get(key) != gen:
+        last[key] = gen
+        changes.append(Change(key, value, at))
+
+    if changes:
+      self.changes_ctr.inc(len(changes))
+    for client in self.clients:
+      dropped = sum(client.offer(c) for c in changes)
+      if dropped:
+        self.dropped_ctr.inc(dropped)
+
+  async def run(self):
+    while self.clients:
+      self.poll()
+      await asyncio.sleep(self.interval_s)
+    self.poller = None
+
+  def subscribe(self, request):
+    q = request.query
+    try:
+      max_rate = float(q.get("max_rate", 0))
+      max_pending = int(q.get("max_pending", self.max_pending))
+    except ValueError:
+      raise web.HTTPBadRequest(text="max_rate must be a number and max_pending an integer")
+    if not max_rate >= 0 or max_pending < 1:
+      raise web.HTTPBadRequest(text="max_rate must be >= 0 and max_pending >= 1")
+
+    client = StreamClient(
+      to_scope(tuple(filter(None, q.get("prefix", "").split("/")))), max_rate, max_pending
+    )
+    # Start from the current values, not just what changes next
+    for key, value, at, _ in self.samples((client.prefix,)):
+      client.offer(Change(key, value, at))
+
+    self.clients.add(client)
+    if self.poller is None:
+      # Only what changes from here on; everyone already has the rest
+      self.last = {key: gen for key, _, _, gen in self.samples(((),))}
+      self.poller = asyncio.get_running_loop().create_task(self.run())
+    return client
+
+  async def pump(self, client, send):
+    """Send `client`'s changes with `send(changes, dropped)` until it goes away"""
+    reported = 0
+    while True:
+      await client.wake.wait()
+      changes = client.take()
+      dropped, reported = client.dropped - reported, client.dropped
+      await send(changes, dropped)
+      self.sent_ctr.inc(len(changes))
+      if client.min_gap_s:
+        await asyncio.sleep(client.min_gap_s)
+
+  async def handle_sse(self, request):
+    client = self.subscribe(request)
+    response = web.StreamResponse(headers={
+      "Content-Type": "text/event-stream",
+      "Cache-Control": "no-cache",
+    })
+
+    async def send(changes, dropped):
+      frame = b"".join(c.sse for c in changes)
+      if dropped:
+        frame += f"event: dropped\ndata: {dropped}\n\n".encode()
+      await response.write(frame)
+
+    try:
+      await response.prepare(request)
+      await self.pump(client, send)
+    except (ConnectionResetError, asyncio.CancelledError):
+      pass
+    finally:
+      self.clients.discard(client)
+    return response
+
+  async def handle_ws(self, request):
+    client = self.subscribe(request)
+    ws = web.WebSocketResponse()
+
+    async def send(changes, dropped):
+      # One frame per batch: a JSON array of the already serialised changes
+      frame = "[" + ",".join(c.text for c in changes) + "]"
+      await ws.send_str(frame)
+      if dropped:
+        await ws.send_str(json.dumps({"dropped": dropped}))
+
+    try:
+      await ws.prepare(request)
+    except Exception:
+      self.clients.discard(client)
+      raise
+    pump = asyncio.get_running_loop().create_task(self.pump(client, send))
+    try:
+      async for msg in ws:
+        if msg.type in (WSMsgType.CLOSE, WSMsgType.ERROR):
+          break
+    finally:
+      pump.cancel()
+      self.clients.discard(client)
+    return ws
+
+  def routes(self):
+    async def handle_stream(request):
+      if request.headers.get("Upgrade", "").lower() == "websocket":
+        return await self.handle_ws(request)
+      return await self.handle_sse(request)
+
+    return [web.get("/stream", handle_stream)]
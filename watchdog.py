@@ -0,0 +1,156 @@
+import asyncio
+import time
+
+
+# Power cycling the adapter unwedges BlueZ when restarting discovery doesn't
+DEFAULT_ADAPTER_RESET = (
+  ("bluetoothctl", "power", "off"),
+  ("bluetoothctl", "power", "on"),
+)
+
+
+async def run_commands(commands, timeout_s=10):
+  for argv in commands:
+    proc = await asyncio.create_subprocess_exec(
+      *argv, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    await asyncio.wait_for(proc.wait(), timeout_s)
+
+
+class ScannerWatchdog:
+  """
+  Notices when the scanner stops delivering adverts, and restarts it.
+
+  Every device whose advert interval has been learned (see LinkStats)
+  should have sent about silence / interval adverts since it was last
+  heard. A device that had already been silent for `gone_after` of its
+  intervals when anything was last heard has left, rather than gone
+  unheard, and isn't counted. When the devices together should have sent
+  `expected_adverts` and no advert at all, from any advertiser, arrived
+  for `min_silence_s`, the scanner is stalled. It is then restarted, with exponential backoff
+  between attempts. With `reset_adapter`, the adapter is reset once per
+  stall as well: after `adapter_after` failed attempts, or as soon as the
+  scanner fails to start. The stall is over when anything is heard again.
+
+  `links()` returns objects with `last_at` and `nominal_s`; `heard_at()`
+  is when the scanner last delivered any advert. `restart` and
+  `reset_adapter` are coroutine functions. `clock` can be replaced, so a
+  fake scanner can drive this (see watchdog_sim.py).
+  """
+
+  def __init__(self, links, restart, reset_adapter=None, observer=None, log=None,
+      clock=time.time, heard_at=lambda: 0, expected_adverts=8, min_silence_s=3,
+      check_interval_s=1, backoff_s=2, max_backoff_s=300, adapter_after=2, gone_after=4):
+    self.links = links
+    self.heard_at = heard_at
+    self.restart = restart
+    self.reset_adapter = reset_adapter
+    self.log = log
+    self.clock = clock
+    self.expected_adverts = expected_adverts
+    self.min_silence_s = min_silence_s
+    self.check_interval_s = check_interval_s
+    self.backoff_s = backoff_s
+    self.max_backoff_s = max_backoff_s
+    self.adapter_after = adapter_after
+    self.gone_after = gone_after
+
+    self.started_at = None
+    self.stalled_at = None
+    self.attempts = 0
+    self.next_attempt_at = 0
+    self.adapter_reset = False
+
+    self.state = observer.state("state", "Whether the scanner is delivering adverts")
+    self.state.set("ok")
+    self.stalls_ctr = observer.counter("stalls", "Scanner stalls detected")
+    self.restarts_ctr = observer.counter("restarts", "Recovery attempts, by what was restarted")
+    self.recovery_s = observer.gauge("recovery_s", "Time from detecting the last stall to an advert")
+    self.silence = observer.gauge("silence_s", "Time since any known device was heard")
+    self.expected = observer.gauge("expected_adverts", "Adverts the silent devices should have sent")
+
+  def scanning_started(self, now=None):
+    """Scanning is wanted from now on, whether or not the scanner starts"""
+    self.started_at = now or self.clock()
+
+  def scanning_stopped(self):
+    """Scanning was stopped on purpose, so silence is expected"""
+    self.started_at = None
+
+  def measure(self, now):
+    """(seconds since any advert was heard, adverts expected in that time)"""
+    links = list(self.links())
+    heard_at = max(self.started_at, self.last_heard_at(links))
+    expected = 0.0
+    for link in links:
+      since = max(link.last_at, self.started_at)
+      if link.nominal_s and heard_at - since <= self.gone_after * link.nominal_s:
+        expected += (now - since) / link.nominal_s
+    return now - heard_at, expected
+
+  def last_heard_at(self, links=None):
+    links = self.links() if links is None else links
+    return max(self.heard_at(), max((link.last_at for link in links), default=0))
+
+  def check(self, now=None):
+    """What to restart now: None, "scanner" or "adapter" """
+    now = now or self.clock()
+    if self.started_at is None:
+      return None
+
+    if self.stalled_at is not None and self.last_heard_at() > self.stalled_at:
+      self.recovery_s.set(round(self.last_heard_at() - self.stalled_at, 3))
+      if self.log:
+        self.log.inf("Scanner recovered after {} attempts", self.attempts)
+      self.stalled_at = None
+      self.attempts = 0
+      self.adapter_reset = False
+      self.state.set("ok")
+
+    silence, expected = self.measure(now)
+    self.silence.set(round(silence, 3))
+    self.expected.set(round(expected, 2))
+
+    if self.stalled_at is None:
+      if silence < self.min_silence_s or expected < self.expected_adverts:
+        return None
+      self.stalled_at = now
+      self.next_attempt_at = now
+      self.stalls_ctr.inc()
+      self.state.set("stalled")
+      if self.log:
+        self.log.err("Scanner stalled: silent {:.1f}s, {:.0f} adverts expected", silence, expected)
+
+    if now < self.next_attempt_at:
+      return None
+
+    self.attempts += 1
+    backoff = min(self.max_backoff_s, self.backoff_s * 2 ** (self.attempts - 1))
+    self.next_attempt_at = now + backoff
+    # Once is enough: if the devices are simply gone, power cycling won't help
+    if self.reset_adapter and not self.adapter_reset and self.attempts > self.adapter_after:
+      self.adapter_reset = True
+      return "adapter"
+    return "scanner"
+
+  async def recover(self, action):
+    self.restarts_ctr.labeled("kind", action).inc()
+    if self.log:
+      self.log.err("Restarting the {} (attempt {})", action, self.attempts)
+    try:
+      if action == "adapter":
+        await self.reset_adapter()
+      await self.restart()
+    except Exception as e:
+      if self.log:
+        self.log.err("Restart failed: {!r}", e)
+      if self.stalled_at is not None and action == "scanner":
+        # A scanner that won't even start is what the adapter reset is for
+        self.attempts = max(self.attempts, self.adapter_after)
+
+  async def run(self):
+    while True:
+      await asyncio.sleep(self.check_interval_s)
+      action = self.check()
+      if action:
+        await self.recover(action)
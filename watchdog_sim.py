@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Drives ScannerWatchdog with a fake scanner and a fake clock through the
+situations it has to tell apart: a healthy scanner, a wedged one that a
+restart fixes, one that won't even start until the adapter is reset,
+devices that are simply gone while other advertisers are still heard, and
+one device of several leaving while only the configured ones are heard.
+
+  python watchdog_sim.py
+"""
+import asyncio
+
+from obs.observer import Observer
+from obs.registry import Registry
+from watchdog import ScannerWatchdog
+
+
+class FakeLink:
+  def __init__(self, nominal_s):
+    self.nominal_s = nominal_s
+    self.last_at = 0
+
+
+class FakeScanner:
+  """Devices advertise every `nominal_s` while the scanner works"""
+
+  def __init__(self, nominal_s=(1.0, 2.0)):
+    self.now = 1000.0
+    self.links = [FakeLink(n) for n in nominal_s]
+    self.working = True
+    self.devices_present = True
+    self.gone = set()
+    self.others_heard_at = 0
+    self.start_fails = 0
+    self.calls = []
+
+  def clock(self):
+    return self.now
+
+  def advance(self, seconds, step_s=0.5):
+    end = self.now + seconds
+    while self.now < end:
+      self.now += step_s
+      if not self.working:
+        continue
+      self.others_heard_at = self.now
+      if self.devices_present:
+        for i, link in enumerate(self.links):
+          if i not in self.gone and self.now - link.last_at >= link.nominal_s:
+            link.last_at = self.now
+
+  async def restart(self):
+    self.calls.append("restart")
+    if self.start_fails:
+      self.start_fails -= 1
+      raise RuntimeError("org.bluez.Error.InProgress")
+    self.working = True
+
+  async def reset_adapter(self):
+    self.calls.append("adapter")
+
+
+def make(scanner):
+  dog = ScannerWatchdog(
+    lambda: scanner.links, scanner.restart, scanner.reset_adapter,
+    observer=Observer(Registry()).scoped("watchdog"),
+    clock=scanner.clock, heard_at=lambda: scanner.others_heard_at,
+  )
+  dog.scanning_started()
+  return dog
+
+
+async def run_for(scanner, dog, seconds):
+  for _ in range(int(seconds)):
+    scanner.advance(1)
+    action = dog.check()
+    if action:
+      await dog.recover(action)
+
+
+async def healthy():
+  scanner = FakeScanner()
+  dog = make(scanner)
+  await run_for(scanner, dog, 60)
+  assert scanner.calls == [], scanner.calls
+  assert dog.state.value == "ok"
+
+
+async def wedged():
+  scanner = FakeScanner()
+  dog = make(scanner)
+  await run_for(scanner, dog, 10)
+  scanner.working = False
+  await run_for(scanner, dog, 30)
+  assert scanner.calls[:1] == ["restart"], scanner.calls
+  assert dog.state.value == "ok" and dog.stalls_ctr.value == 1
+  assert dog.recovery_s.value is not None
+
+
+async def wont_start():
+  scanner = FakeScanner()
+  dog = make(scanner)
+  await run_for(scanner, dog, 10)
+  scanner.working = False
+  scanner.start_fails = 1
+  await run_for(scanner, dog, 60)
+  # The failed start goes straight to the adapter reset, and only once
+  assert scanner.calls[:3] == ["restart", "adapter", "restart"], scanner.calls
+  assert scanner.calls.count("adapter") == 1
+  assert dog.state.value == "ok"
+
+
+async def devices_gone():
+  scanner = FakeScanner()
+  dog = make(scanner)
+  await run_for(scanner, dog, 10)
+  scanner.devices_present = False
+  await run_for(scanner, dog, 600)
+  assert scanner.calls == [], scanner.calls
+
+
+async def nothing_in_range():
+  # Passive scanning with filters only hears the configured devices
+  scanner = FakeScanner()
+  dog = ScannerWatchdog(
+    lambda: scanner.links, scanner.restart, scanner.reset_adapter,
+    observer=Observer(Registry()).scoped("watchdog"), clock=scanner.clock,
+  )
+  dog.scanning_started()
+  await run_for(scanner, dog, 10)
+  scanner.devices_present = False
+  await run_for(scanner, dog, 3600)
+  # Restarts back off to one per max_backoff_s, and the adapter is not
+  # power cycled over and over
+  assert scanner.calls.count("adapter") == 1, scanner.calls
+  assert len(scanner.calls) <= 10 + 3600 / dog.max_backoff_s, scanner.calls
+
+
+async def one_leaves():
+  # A fast device leaves while a slow one stays, with passive filtered
+  # scanning, so the slow one's gaps are the only thing heard
+  scanner = FakeScanner(nominal_s=(1.0, 6.0))
+  dog = ScannerWatchdog(
+    lambda: scanner.links, scanner.restart, scanner.reset_adapter,
+    observer=Observer(Registry()).scoped("watchdog"), clock=scanner.clock,
+  )
+  dog.scanning_started()
+  await run_for(scanner, dog, 30)
+  scanner.gone.add(0)
+  await run_for(scanner, dog, 600)
+  assert scanner.calls == [], scanner.calls
+  assert dog.stalls_ctr.value == 0
+
+
+def main():
+  for scenario in (healthy, wedged, wont_start, devices_gone, nothing_in_range, one_leaves):
+    asyncio.run(scenario())
+    print(f"{scenario.__name__}: ok")
+
+
+if __name__ == "__main__":
+  main()